@@ -0,0 +1,2 @@
+"""Benchmarks for pi_logger. Run individual modules with python -m, or the
+standard suite and its baseline check with python -m benchmarks.suite."""
@@ -0,0 +1,55 @@
+"""
+Measure how long the pi_logger entry points take to import, using python's
+-X importtime, and list the modules that take the longest to import.
+
+Run with:
+    python -m benchmarks.bench_import_time --module pi_logger.api_server
+"""
+
+import sys
+import argparse
+import subprocess
+
+
+def import_times(module):
+    """
+    Import module in a fresh interpreter with -X importtime
+    Returns a dictionary of module name: cumulative import time in seconds
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True,
+    ).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def main():
+    """
+    Print the total import time of each module and its slowest imports
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--module", nargs="+",
+                        default=["pi_logger", "pi_logger.local_db",
+                                 "pi_logger.local_loggers",
+                                 "pi_logger.api_server"])
+    parser.add_argument("--top", type=int, default=10,
+                        help="number of slowest imports to list")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    for module in args.module:
+        runs = [import_times(module) for _ in range(args.repeats)]
+        best = min(runs, key=lambda times: times[module])
+        print(f"{module}: {best[module]:.3f} s")
+        slowest = sorted(best.items(), key=lambda item: -item[1])
+        for name, seconds in slowest[1:args.top + 1]:
+            print(f"    {name:<40} {seconds:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
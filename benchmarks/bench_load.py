@@ -0,0 +1,234 @@
+"""
+Drive the API server with concurrent local clients and report latency
+percentiles and throughput.
+
+Each client thread holds a keep-alive connection and requests the paths in
+turn for the given duration. By default a server is started against a
+synthetic database, with the production settings of pi_logger.serve or,
+with --dev, Flask's development server; with --url, an already running
+server is tested instead. With --conditional, clients send back the ETag
+of their previous response to each path, as a polling dashboard would.
+
+Run with:
+    python -m benchmarks.bench_load --clients 32 --duration 10
+    python -m benchmarks.bench_load --dev --clients 32 --duration 10
+    python -m benchmarks.bench_load --url http://raspberrypi:5003 --clients 8
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+from benchmarks.synthetic_db import generate_database, END
+
+PATHS = ["/get_last", "/get_latest", "/get_recent/{since}"]
+# seconds to wait for a started server to answer
+STARTUP_TIMEOUT = 60
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which fraction of the sorted values fall, by
+    the nearest rank method
+    """
+    if not values:
+        return float("nan")
+    rank = math.ceil(fraction * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def free_port():
+    """
+    Return a TCP port that nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_client(host, port, paths, deadline, conditional, results):
+    """
+    Request paths in turn on one connection until deadline, appending the
+    latency in seconds of each successful request to results["latencies"]
+    and counting failures in results["errors"]
+    """
+    latencies = []
+    errors = 0
+    etags = {}
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        headers = {"Accept-Encoding": "gzip"}
+        if conditional and path in etags:
+            headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+        if response.status in (200, 304):
+            latencies.append(time.perf_counter() - start)
+            if response.getheader("ETag"):
+                etags[path] = response.getheader("ETag")
+        else:
+            errors += 1
+    conn.close()
+    with results["lock"]:
+        results["latencies"].extend(latencies)
+        results["errors"] += errors
+
+
+def load_test(url, paths, clients, duration, conditional=False):
+    """
+    Run clients concurrent clients against the server at url for duration
+    seconds
+    Returns a dictionary of the number of requests and errors, requests per
+    second and the p50, p99 and maximum latencies in ms
+    """
+    parts = urlsplit(url)
+    results = dict(latencies=[], errors=0, lock=threading.Lock())
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=run_client,
+                                args=(parts.hostname, parts.port or 80,
+                                      paths, deadline, conditional, results))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = sorted(results["latencies"])
+    return dict(
+        requests=len(latencies), errors=results["errors"],
+        requests_per_s=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        max_ms=latencies[-1] * 1000 if latencies else float("nan"),
+    )
+
+
+def wait_for_server(url, process, timeout=STARTUP_TIMEOUT):
+    """
+    Wait until the server at url answers /get_last
+    Raises RuntimeError if it exits or does not answer within timeout
+    """
+    parts = urlsplit(url)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port,
+                                              timeout=5)
+            conn.request("GET", "/get_last")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server did not answer within {timeout} s")
+
+
+def start_server(directory, port, dev=False, workers=2, threads=32):
+    """
+    Start pi_logger.serve against the database in directory
+    Returns the server process, which is ready for requests
+    """
+    command = [sys.executable, "-m", "pi_logger.serve", "--host",
+               "127.0.0.1", "--port", str(port)]
+    if dev:
+        command.append("--dev")
+    else:
+        command += ["--workers", str(workers), "--threads", str(threads)]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, LOG_PATH=directory,
+                 CONTROL_SOCKET=os.path.join(directory, "none.sock")),
+    )
+    try:
+        wait_for_server(f"http://127.0.0.1:{port}", process)
+    except RuntimeError:
+        process.kill()
+        raise
+    return process
+
+
+def run_against_synthetic(rows, clients, duration, conditional=False,
+                          dev=False, workers=2, threads=32):
+    """
+    Start a server against a synthetic database of rows readings, load test
+    it and stop it
+    Returns the results of load_test
+    """
+    since = (END - timedelta(days=1)).isoformat()
+    paths = [path.format(since=since) for path in PATHS]
+    with tempfile.TemporaryDirectory() as directory:
+        generate_database(os.path.join(directory, "locallogs.db"), rows)\
+            .dispose()
+        port = free_port()
+        process = start_server(directory, port, dev, workers, threads)
+        try:
+            return load_test(f"http://127.0.0.1:{port}", paths, clients,
+                             duration, conditional)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+def main():
+    """
+    Run the load test and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", default=None,
+                        help="test a running server instead of starting one")
+    parser.add_argument("--rows", type=int, default=200000,
+                        help="rows in the synthetic database")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run for")
+    parser.add_argument("--conditional", action="store_true",
+                        help="send If-None-Match with the last ETag")
+    parser.add_argument("--dev", action="store_true",
+                        help="start the development server")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    args = parser.parse_args()
+    if args.url is None:
+        results = run_against_synthetic(args.rows, args.clients,
+                                        args.duration, args.conditional,
+                                        args.dev, args.workers, args.threads)
+    else:
+        since = (datetime.utcnow() - timedelta(days=1)).isoformat()
+        paths = [path.format(since=since) for path in PATHS]
+        results = load_test(args.url, paths, args.clients, args.duration,
+                            args.conditional)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for metric, result in results.items():
+            print(f"{metric:>16} {result:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
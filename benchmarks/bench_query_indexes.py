@@ -0,0 +1,109 @@
+"""
+Benchmark the localdata range queries against table size, with and without
+the datetime indexes added in schema version 1, and the lookup of the last
+reading through the latest_readings table added in schema version 2.
+
+Run with:
+    python -m benchmarks.bench_query_indexes --sizes 10000 100000 1000000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from pi_logger.local_db import (LocalData, migrate_database,
+                                get_recent_readings, get_last_reading)
+
+LOCATIONS = ["livingroom", "piano", "bedroom", "front"]
+START = datetime(2015, 1, 1)
+
+
+def fill_table(engine, n_rows, chunk_size=50000):
+    """
+    Fill the localdata table with n_rows of one-minute readings spread over
+    LOCATIONS, returning the datetime of the last reading
+    """
+    insert = LocalData.__table__.insert()
+    last = START
+    for chunk_start in range(0, n_rows, chunk_size):
+        rows = []
+        for i in range(chunk_start, min(chunk_start + chunk_size, n_rows)):
+            last = START + timedelta(minutes=i // len(LOCATIONS))
+            rows.append(dict(
+                datetime=last, location=LOCATIONS[i % len(LOCATIONS)],
+                sensortype="dht22", piname="benchpi", piid="0000",
+                temp=20.0 + (i % 100) / 10, humidity=50.0, pressure=None,
+                gasvoc=None, mcdvalue=None, mcdvoltage=None,
+            ))
+        with engine.begin() as conn:
+            conn.execute(insert, rows)
+    return last
+
+
+def time_call(func, *args, repeat=5, **kwargs):
+    """
+    Return the best wall-clock time in ms of repeat calls to func
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def benchmark_size(n_rows, directory):
+    """
+    Time the query functions on a table of n_rows before and after migration
+    Returns a dictionary of timings in ms
+    """
+    path = os.path.join(directory, f"bench_{n_rows}.db")
+    engine = create_engine(f"sqlite:///{path}")
+    # create the table without indexes, as in schema version 0
+    LocalData.__table__.create(engine)
+    for index in LocalData.__table__.indexes:
+        index.drop(engine)
+    last = fill_table(engine, n_rows)
+    last_hour = last - timedelta(hours=1)
+
+    timings = dict(rows=n_rows)
+    timings["recent_before"] = time_call(get_recent_readings, last_hour,
+                                         engine=engine)
+    timings["last_before"] = time_call(get_last_reading, table=LocalData,
+                                       engine=engine)
+    migrate_database(engine)
+    timings["recent_after"] = time_call(get_recent_readings, last_hour,
+                                        engine=engine)
+    timings["last_after"] = time_call(get_last_reading, table=LocalData,
+                                      engine=engine)
+    timings["latest"] = time_call(get_last_reading, engine=engine)
+    engine.dispose()
+    os.remove(path)
+    return timings
+
+
+def main():
+    """
+    Run the benchmark for each table size and print a table of results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000])
+    args = parser.parse_args()
+    header = ("rows", "recent_before", "recent_after",
+              "last_before", "last_after", "latest")
+    print("{:>10} {:>14} {:>14} {:>14} {:>14} {:>14}".format(*header))
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows in args.sizes:
+            timings = benchmark_size(n_rows, directory)
+            print("{:>10}".format(n_rows) + "".join(
+                " {:>12.2f}ms".format(timings[k]) for k in header[1:]
+            ))
+
+
+if __name__ == "__main__":
+    main()
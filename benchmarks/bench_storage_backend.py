@@ -0,0 +1,95 @@
+"""
+Compare the SQLite LocalData table with the memory-mapped ring buffer store
+for high-frequency readings from a single sensor: insert throughput through
+a ReadingWriter, and the latency of reading back a time range.
+
+Run with:
+    python -m benchmarks.bench_storage_backend --rows 200000
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+from pi_logger.local_db import (ReadingWriter, SQLiteBackend,
+                                create_db_engine, set_up_database)
+from pi_logger.ring_store import RingBufferBackend
+
+START = datetime(2020, 1, 1)
+READING = dict(location="soil", sensortype="mcp3008", piname="benchpi",
+               piid="0000")
+
+
+def time_inserts(backend, engine, rows, batch_size):
+    """
+    Write rows readings at 10 Hz through a ReadingWriter in batches
+    Returns inserts per second
+    """
+    start = time.perf_counter()
+    with ReadingWriter(engine, max_rows=batch_size, max_age=3600,
+                       backend=backend) as writer:
+        for i in range(rows):
+            writer.add(dict(READING, mcdvalue=i % 1024,
+                            mcdvoltage=(i % 1024) * 3.3 / 1023,
+                            datetime=START + timedelta(seconds=i / 10)))
+    return rows / (time.perf_counter() - start)
+
+
+def time_range_reads(read, rows, window, repeats):
+    """
+    Time read(start, end) for windows of window readings spread through the
+    data set. Returns the mean latency in milliseconds
+    """
+    span = rows / 10 - window / 10
+    starts = [START + timedelta(seconds=span * i / repeats)
+              for i in range(repeats)]
+    begin = time.perf_counter()
+    for start in starts:
+        read(start, start + timedelta(seconds=window / 10))
+    return (time.perf_counter() - begin) / repeats * 1000
+
+
+def main():
+    """
+    Run the benchmark for both stores and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=3600,
+                        help="readings per range read")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(
+            "sqlite:///{}".format(os.path.join(directory, "bench.db"))
+        )
+        set_up_database(directory, engine)
+        sqlite = SQLiteBackend(engine)
+        ring = RingBufferBackend(os.path.join(directory, "rings"),
+                                 capacity=args.rows)
+        stores = [
+            # the API's path: rows converted to dictionaries
+            ("sqlite", sqlite, sqlite.get_recent_readings),
+            # the zero-copy path: a structured array viewing the file
+            ("ring", ring,
+             lambda start, end: ring.read_range("soil", start, end)),
+            ("ring dicts", None, ring.get_recent_readings),
+        ]
+        print("{:>12} {:>14} {:>16}".format("store", "inserts/s",
+                                            "range read ms"))
+        for name, backend, read in stores:
+            inserts = "" if backend is None else "{:.0f}".format(
+                time_inserts(backend, engine, args.rows, args.batch_size)
+            )
+            latency = time_range_reads(read, args.rows, args.window,
+                                       args.repeats)
+            print(f"{name:>12} {inserts:>14} {latency:>16.3f}")
+        ring.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Stress the local database with simultaneous writer and reader processes,
+as when the logger and the API server share it, and compare the throughput
+and number of lock errors of the SQLite storage profiles.
+
+Run with:
+    python -m benchmarks.bench_storage_profile --seconds 10
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from pi_logger.local_db import (STORAGE_PROFILES, ReadingWriter,
+                                create_db_engine, set_up_database,
+                                get_last_readings, get_recent_readings)
+
+READING = dict(location="bench", sensortype="dht22", piname="benchpi",
+               piid="0000", temp=20.0, humidity=50.0)
+
+
+def writer_process(conn_string, profile, seconds, batch_size, results):
+    """
+    Write batches of readings until time runs out
+    """
+    engine = create_db_engine(conn_string, profile)
+    rows = errors = 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        writer = ReadingWriter(engine, max_rows=batch_size + 1)
+        for _ in range(batch_size):
+            writer.add(dict(READING, datetime=datetime.utcnow()))
+        try:
+            rows += writer.flush()
+        except OperationalError:
+            errors += 1
+    results.put(("write", rows, errors))
+
+
+def reader_process(conn_string, profile, seconds, results):
+    """
+    Run the API's queries until time runs out
+    """
+    engine = create_db_engine(conn_string, profile)
+    queries = errors = 0
+    since = datetime.utcnow()
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        try:
+            get_last_readings(engine=engine)
+            get_recent_readings(since, engine=engine)
+            queries += 1
+        except OperationalError:
+            errors += 1
+    results.put(("read", queries, errors))
+
+
+def run_profile(profile, directory, args):
+    """
+    Run the writers and readers against a fresh database with the given
+    profile and return a dictionary of throughput and error counts
+    """
+    path = os.path.join(directory, f"{profile}.db")
+    conn_string = f"sqlite:///{path}"
+    set_up_database(directory, create_db_engine(conn_string, profile))
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=writer_process,
+            args=(conn_string, profile, args.seconds, args.batch_size,
+                  results)
+        ) for _ in range(args.writers)
+    ] + [
+        multiprocessing.Process(
+            target=reader_process,
+            args=(conn_string, profile, args.seconds, results)
+        ) for _ in range(args.readers)
+    ]
+    for process in processes:
+        process.start()
+    totals = dict(profile=profile, write=0, write_errors=0,
+                  read=0, read_errors=0)
+    for _ in processes:
+        kind, count, errors = results.get()
+        totals[kind] += count
+        totals[f"{kind}_errors"] += errors
+    for process in processes:
+        process.join()
+    totals["rows/s"] = totals["write"] / args.seconds
+    totals["reads/s"] = totals["read"] / args.seconds
+    return totals
+
+
+def main():
+    """
+    Run the stress test for each storage profile and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=10)
+    args = parser.parse_args()
+    header = ("profile", "rows/s", "write_errors", "reads/s", "read_errors")
+    print("{:>10} {:>12} {:>14} {:>12} {:>14}".format(*header))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in STORAGE_PROFILES:
+            results[profile] = run_profile(profile, directory, args)
+            print("{profile:>10} {rows/s:>12.1f} {write_errors:>14} "
+                  "{reads/s:>12.1f} {read_errors:>14}"
+                  .format(**results[profile]))
+    if results["default"]["rows/s"]:
+        print("write throughput gain: {:.1f}x".format(
+            results["pi"]["rows/s"] / results["default"]["rows/s"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
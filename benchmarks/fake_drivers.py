@@ -0,0 +1,189 @@
+"""
+Fake DHT22, BME680 and MCP3008 drivers for running the logger without
+sensors attached, e.g. to benchmark a poll cycle on a development machine.
+
+install() puts stand-ins for the Adafruit_DHT, bme680, board, busio,
+digitalio and adafruit_mcp3xxx modules in sys.modules, where
+local_loggers.import_driver finds them in place of the real drivers. Each
+read can be made to take a given time, to mimic the sensor's own latency.
+"""
+
+import sys
+import math
+import time
+import types
+import functools
+
+DRIVER_MODULES = ["Adafruit_DHT", "bme680", "board", "busio", "digitalio",
+                  "adafruit_mcp3xxx", "adafruit_mcp3xxx.mcp3008",
+                  "adafruit_mcp3xxx.analog_in"]
+
+
+def wave(pin, low, high, period=3600):
+    """
+    Return a value between low and high that varies slowly with time and
+    differs between pins
+    """
+    phase = 2 * math.pi * (time.time() / period + pin / 8)
+    return low + (high - low) * (1 + math.sin(phase)) / 2
+
+
+def make_dht_module(latency):
+    """
+    Return a stand-in for the Adafruit_DHT module
+    """
+    module = types.ModuleType("Adafruit_DHT")
+    module.DHT22 = 22
+
+    def read(sensor, pin):
+        # pylint: disable=W0613
+        time.sleep(latency)
+        return wave(pin, 40, 60), wave(pin, 15, 25)
+
+    module.read = read
+    module.read_retry = read
+    return module
+
+
+class FakeBME680():
+    """
+    Stand-in for bme680.BME680, ignoring its settings
+    """
+    def __init__(self, address=None, latency=0.0):
+        self.address = address
+        self.latency = latency
+        self.data = types.SimpleNamespace(heat_stable=True)
+
+    def __getattr__(self, name):
+        if name.startswith(("set_", "select_")):
+            return lambda *args: None
+        raise AttributeError(name)
+
+    def get_sensor_data(self):
+        """Pretend to read from the sensor"""
+        time.sleep(self.latency)
+        self.data.temperature = wave(0, 15, 25)
+        self.data.humidity = wave(0, 40, 60)
+        self.data.pressure = wave(0, 990, 1030)
+        self.data.gas_resistance = wave(0, 10000, 50000)
+        return True
+
+
+def make_bme680_module(latency):
+    """
+    Return a stand-in for the bme680 module
+    """
+    module = types.ModuleType("bme680")
+    for name in ["I2C_ADDR_PRIMARY", "I2C_ADDR_SECONDARY", "OS_2X", "OS_4X",
+                 "OS_8X", "FILTER_SIZE_3", "ENABLE_GAS_MEAS"]:
+        setattr(module, name, name)
+    module.BME680 = functools.partial(FakeBME680, latency=latency)
+    return module
+
+
+class FakeMCP3008():
+    """
+    Stand-in for adafruit_mcp3xxx.mcp3008.MCP3008
+    pin_values: optional dictionary of pin: list of raw values, returned in
+        turn and repeated (None for a failed read), in place of the slowly
+        varying values
+    Counts the reads and the channels created, for tests
+    """
+    reference_voltage = 3.3
+
+    def __init__(self, spi_bus=None, chip_select=None, pin_values=None,
+                 latency=0.0):
+        self.spi_bus = spi_bus
+        self.chip_select = chip_select
+        self.pin_values = {pin: list(values)
+                           for pin, values in (pin_values or {}).items()}
+        self.latency = latency
+        self.reads = 0
+        self.channels_created = 0
+
+    def read(self, pin):
+        """Return the next raw 16 bit value of pin"""
+        time.sleep(self.latency)
+        self.reads += 1
+        if pin not in self.pin_values:
+            return int(wave(pin, 20000, 40000))
+        values = self.pin_values[pin]
+        values.append(values.pop(0))
+        return values[-1]
+
+
+class FakeAnalogIn():
+    """
+    Stand-in for adafruit_mcp3xxx.analog_in.AnalogIn reading a FakeMCP3008
+    """
+    def __init__(self, chip, pin):
+        self.chip = chip
+        self.pin = pin
+        chip.channels_created += 1
+
+    @property
+    def value(self):
+        """Read the raw 16 bit value of the pin"""
+        return self.chip.read(self.pin)
+
+    @property
+    def voltage(self):
+        """Read the pin and convert to volts"""
+        return self.value * self.chip.reference_voltage / 65535
+
+
+def make_mcp_modules(latency):
+    """
+    Return stand-ins for the adafruit_mcp3xxx, adafruit_mcp3xxx.mcp3008 and
+    adafruit_mcp3xxx.analog_in modules
+    """
+    package = types.ModuleType("adafruit_mcp3xxx")
+    package.__path__ = []
+    mcp3008 = types.ModuleType("adafruit_mcp3xxx.mcp3008")
+    for pin in range(8):
+        setattr(mcp3008, f"P{pin}", pin)
+    mcp3008.MCP3008 = functools.partial(FakeMCP3008, latency=latency)
+    analog_in = types.ModuleType("adafruit_mcp3xxx.analog_in")
+    analog_in.AnalogIn = FakeAnalogIn
+    package.mcp3008 = mcp3008
+    package.analog_in = analog_in
+    return package, mcp3008, analog_in
+
+
+def make_bus_modules():
+    """
+    Return stand-ins for the board, busio and digitalio modules
+    """
+    board = types.ModuleType("board")
+    for name in ["SCK", "MISO", "MOSI", "D5"]:
+        setattr(board, name, name)
+    busio = types.ModuleType("busio")
+    busio.SPI = lambda **pins: types.SimpleNamespace(**pins)
+    digitalio = types.ModuleType("digitalio")
+    digitalio.DigitalInOut = lambda pin: types.SimpleNamespace(pin=pin)
+    return board, busio, digitalio
+
+
+def install(dht_latency=0.0, bme_latency=0.0, mcp_latency=0.0):
+    """
+    Put the fake drivers in sys.modules, replacing any real ones
+    Latencies are the seconds each sensor read takes
+    Returns the previous modules, to pass to uninstall
+    """
+    previous = {name: sys.modules.get(name) for name in DRIVER_MODULES}
+    modules = [make_dht_module(dht_latency), make_bme680_module(bme_latency),
+               *make_bus_modules(), *make_mcp_modules(mcp_latency)]
+    for module in modules:
+        sys.modules[module.__name__] = module
+    return previous
+
+
+def uninstall(previous):
+    """
+    Restore the modules replaced by install
+    """
+    for name, module in previous.items():
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
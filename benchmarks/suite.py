@@ -0,0 +1,235 @@
+"""
+Run the standard benchmarks against fake sensors and a synthetic database
+and compare the results with stored baselines.
+
+Measures the latency of a poll cycle, the insert throughput of a
+ReadingWriter, the latency of get_last_reading and get_recent_readings, and
+the response time and peak memory of the /get_recent API route, with and
+without the response cache. With --check, exits with an error if any result
+is worse than its baseline by more than the tolerance; with --update, stores
+the results as the new baselines.
+
+Run with:
+    python -m benchmarks.suite --check
+    python -m benchmarks.suite --rows 10000000 --update --baselines big.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+from benchmarks import fake_drivers
+from benchmarks.synthetic_db import generate_database, END
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+# a result fails the check if it is this many times worse than its baseline
+TOLERANCE = float(os.getenv("BENCH_TOLERANCE", default="2.0"))
+# metrics where a larger value is better; for all others smaller is better
+HIGHER_IS_BETTER = {"insert_rows_per_s"}
+READING = dict(location="bench", sensortype="dht22", piname="benchpi",
+               piid="0000", temp=20.0, humidity=50.0)
+# run in a separate interpreter so that the API server uses the synthetic
+# database. The first request, which imports pandas, is not measured. The
+# response cache is cleared before each uncached request
+API_WORKER = """
+import sys, json, time, statistics, tracemalloc
+from pi_logger.api_server import app, RESPONSE_CACHE
+client = app.test_client()
+url = "/get_recent/" + sys.argv[1]
+assert client.get(url).status_code == 200
+RESPONSE_CACHE.clear()
+tracemalloc.start()
+client.get(url)
+peak = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+def median_ms(clear):
+    times = []
+    for _ in range(int(sys.argv[2])):
+        if clear:
+            RESPONSE_CACHE.clear()
+        start = time.perf_counter()
+        client.get(url)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+print(json.dumps(dict(get_recent_ms=median_ms(clear=True),
+                      get_recent_cached_ms=median_ms(clear=False),
+                      get_recent_peak_mb=peak / 2 ** 20)))
+"""
+
+
+class NullWriter():
+    """
+    Stand-in for local_db.ReadingWriter that discards readings
+    """
+    def add(self, data):
+        """Discard data"""
+
+
+def median_ms(func, *args, repeat=20, **kwargs):
+    """
+    Return the median wall-clock time in ms of repeat calls to func
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def bench_poll_cycle(repeat):
+    """
+    Time poll cycles of two DHT22, one BME680 and four MCP3008 sensors on
+    the fake drivers, with no sensor latency, i.e. the logger's overhead
+    """
+    previous = fake_drivers.install()
+    try:
+        # pylint: disable=C0415
+        from pi_logger import local_loggers
+        rows = [dict(name="benchpi", location=f"{sensortype}{pin}",
+                     type=sensortype, pin=str(pin))
+                for sensortype, pins in [("dht22", [4, 17]), ("bme680", [0]),
+                                         ("mcp3008", [0, 1, 2, 3])]
+                for pin in pins]
+        plan = local_loggers.compile_sensor_plan(rows, "benchpi")
+        sensors = (local_loggers.set_up_dht22_sensors(), plan.dht22,
+                   local_loggers.set_up_bme680_sensors(), plan.bme680,
+                   local_loggers.set_up_mcp_convertor(), plan.mcp3008)
+        writer = NullWriter()
+        with local_loggers.PollingEngine(*sensors, pi_id="0000",
+                                         pi_name="benchpi") as poller:
+            return median_ms(poller.poll, writer, repeat=repeat)
+    finally:
+        fake_drivers.uninstall(previous)
+
+
+def bench_inserts(engine, n_readings):
+    """
+    Write n_readings through a ReadingWriter in batches of 100
+    Returns inserts per second
+    """
+    from pi_logger.local_db import ReadingWriter  # pylint: disable=C0415
+    start = time.perf_counter()
+    with ReadingWriter(engine, max_rows=100, max_age=3600) as writer:
+        for i in range(n_readings):
+            writer.add(dict(READING, datetime=END + timedelta(seconds=i)))
+    return n_readings / (time.perf_counter() - start)
+
+
+def bench_api(directory, since, repeat):
+    """
+    Time /get_recent/since against the database in directory
+    Returns a dictionary of the median response time and peak memory
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", API_WORKER, str(since), str(repeat)],
+        stdout=subprocess.PIPE, check=True, universal_newlines=True,
+        env=dict(os.environ, LOG_PATH=directory),
+    ).stdout
+    return json.loads(output)
+
+
+def run_suite(rows, years=2, repeat=20):
+    """
+    Run every benchmark, against a synthetic database of rows readings
+    spread over years, and return a dictionary of metric: result
+    """
+    # pylint: disable=C0415
+    from pi_logger.local_db import (get_last_reading, get_recent_readings,
+                                    create_db_engine, set_up_database)
+    results = dict(poll_cycle_ms=bench_poll_cycle(repeat * 5))
+    since = END - timedelta(days=1)
+    with tempfile.TemporaryDirectory() as directory:
+        engine = generate_database(os.path.join(directory, "locallogs.db"),
+                                   rows, years)
+        results["get_last_reading_ms"] = median_ms(
+            get_last_reading, engine=engine, repeat=repeat
+        )
+        results["get_recent_readings_ms"] = median_ms(
+            get_recent_readings, since, engine=engine, repeat=repeat
+        )
+        results.update(bench_api(directory, since, repeat))
+        engine.dispose()
+        engine = create_db_engine("sqlite:///{}".format(
+            os.path.join(directory, "inserts.db")
+        ))
+        set_up_database(directory, engine)
+        results["insert_rows_per_s"] = bench_inserts(engine, 20000)
+        engine.dispose()
+    return results
+
+
+def find_regressions(results, baselines, tolerance=TOLERANCE):
+    """
+    Return a list of messages for the results that are worse than their
+    baselines by more than a factor of tolerance
+    """
+    regressions = []
+    for metric, baseline in baselines.items():
+        result = results.get(metric)
+        if result is None:
+            continue
+        if metric in HIGHER_IS_BETTER:
+            worse = result * tolerance < baseline
+        else:
+            worse = result > baseline * tolerance
+        if worse:
+            regressions.append(f"{metric}: {result:.3f} against a baseline "
+                               f"of {baseline:.3f}")
+    return regressions
+
+
+def main():
+    """
+    Run the suite, print the results and check or update the baselines
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=None,
+                        help="rows in the synthetic database (defaults to "
+                             "the number the baselines were recorded with)")
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--check", action="store_true",
+                        help="fail if a result regressed from its baseline")
+    action.add_argument("--update", action="store_true",
+                        help="store the results as the new baselines")
+    args = parser.parse_args()
+    stored = dict(rows=200000, metrics={})
+    if os.path.exists(args.baselines):
+        with open(args.baselines, "r") as file:
+            stored = json.load(file)
+    rows = stored["rows"] if args.rows is None else args.rows
+    if args.check and rows != stored["rows"]:
+        parser.error(f"the baselines were recorded with {stored['rows']} "
+                     "rows")
+
+    results = run_suite(rows, args.years, args.repeat)
+    for metric, result in results.items():
+        baseline = stored["metrics"].get(metric)
+        baseline = "" if baseline is None else f"{baseline:12.3f}"
+        print(f"{metric:>24} {result:12.3f} {baseline}")
+
+    if args.update:
+        stored = dict(rows=rows, recorded=datetime.utcnow().isoformat(),
+                      metrics=results)
+        with open(args.baselines, "w") as file:
+            json.dump(stored, file, indent=4)
+            file.write("\n")
+    elif args.check:
+        regressions = find_regressions(results, stored["metrics"])
+        for message in regressions:
+            print(f"regression: {message}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
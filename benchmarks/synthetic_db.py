@@ -0,0 +1,119 @@
+"""
+Generate a local database filled with synthetic readings, e.g. several
+years of readings from a handful of sensors, for benchmarking the queries
+and the API against realistically sized tables.
+
+Run with:
+    python -m benchmarks.synthetic_db --rows 10000000 --years 5 --out big.db
+"""
+
+import os
+import math
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+from pi_logger.local_db import (LocalData, LATEST_READING_TRIGGER,
+                                READING_COLUMNS, create_db_engine,
+                                set_up_database)
+
+# the sensors that the readings are spread over, as (location, sensortype)
+SENSORS = [("livingroom", "dht22"), ("piano", "dht22"),
+           ("bedroom", "bme680"), ("bay", "mcp3008")]
+END = datetime(2020, 1, 1)
+YEAR = 365.25 * 86400  # seconds
+COLUMNS = [c.name for c in LocalData.__table__.columns if c.name != "id"]
+
+
+def synthetic_rows(n_rows, start, end, sensors=SENSORS, seed=0):
+    """
+    Yield n_rows tuples of COLUMNS values between start and end, with the
+    sensors taking turns at a regular interval. Temperatures and humidities
+    follow daily and yearly cycles with some noise
+    """
+    rand = random.Random(seed)
+    step = (end - start).total_seconds() / max(n_rows - 1, 1)
+    offset = (start - datetime(start.year, 1, 1)).total_seconds()
+    for i in range(n_rows):
+        seconds = i * step
+        when = start + timedelta(seconds=seconds)
+        location, sensortype = sensors[i % len(sensors)]
+        day = 2 * math.pi * ((offset + seconds) % 86400) / 86400
+        year = 2 * math.pi * ((offset + seconds) % YEAR) / YEAR
+        temp = 15 - 5 * math.cos(year) - 3 * math.cos(day) + rand.gauss(0, 1)
+        humidity = pressure = gasvoc = mcdvalue = mcdvoltage = mcdstd = None
+        if sensortype == "mcp3008":
+            mcdvalue = int(30000 + 8000 * math.sin(year) + rand.gauss(0, 500))
+            mcdvoltage = mcdvalue * 3.3 / 65535
+            mcdstd = abs(rand.gauss(0, 0.01))
+            temp = None
+        else:
+            humidity = 55 + 10 * math.cos(day) + rand.gauss(0, 2)
+        if sensortype == "bme680":
+            pressure = 1013 + 10 * math.sin(year * 12) + rand.gauss(0, 1)
+            gasvoc = 30000 + rand.gauss(0, 3000)
+        yield (when.isoformat(" ", "microseconds"), location, sensortype,
+               "benchpi", "0000", temp, humidity, pressure, gasvoc,
+               mcdvalue, mcdvoltage, mcdstd)
+
+
+def generate_database(path, n_rows, years=2, end=END, chunk_size=100000,
+                      seed=0):
+    """
+    Create a database at path, set it up and fill localdata with n_rows
+    synthetic readings covering the given number of years up to end.
+    Rows are inserted chunk_size at a time through the DBAPI connection,
+    without the latest_readings trigger, which nearly halves the insert
+    rate; latest_readings is filled once all rows are in.
+    Returns an engine for the database
+    """
+    engine = create_db_engine("sqlite:///{}".format(path))
+    set_up_database(os.path.dirname(os.path.abspath(path)), engine)
+    start = end - timedelta(days=365 * years)
+    insert = "INSERT INTO {} ({}) VALUES ({})".format(
+        LocalData.__tablename__, ", ".join(COLUMNS),
+        ", ".join("?" * len(COLUMNS))
+    )
+    rows = synthetic_rows(n_rows, start, end, seed=seed)
+    connection = engine.raw_connection()
+    try:
+        connection.execute("DROP TRIGGER localdata_latest_reading")
+        for _ in range(0, n_rows, chunk_size):
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+            connection.cursor().executemany(insert, chunk)
+            connection.commit()
+        # SQLite takes the bare columns from the row holding MAX(datetime)
+        columns = READING_COLUMNS.replace("datetime", "MAX(datetime)")
+        connection.execute(f"INSERT OR REPLACE INTO latest_readings "
+                           f"({READING_COLUMNS}) SELECT {columns} "
+                           f"FROM {LocalData.__tablename__} GROUP BY location")
+        connection.execute(str(LATEST_READING_TRIGGER.statement))
+        connection.commit()
+    finally:
+        connection.close()
+    return engine
+
+
+def main():
+    """
+    Generate a database and report how long it took
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--out", default="synthetic.db")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.out):
+        parser.error(f"{args.out} already exists")
+    begin = time.perf_counter()
+    generate_database(args.out, args.rows, args.years, seed=args.seed)\
+        .dispose()
+    seconds = time.perf_counter() - begin
+    print(f"wrote {args.rows} rows to {args.out} in {seconds:.1f} s "
+          f"({args.rows / seconds:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
-"""Top-level package for Pi Logger."""
+"""
+Top-level package for Pi Logger.
+
+Importing the package has no side effects beyond reading the .env file:
+entry points create LOG_PATH and configure logging by calling
+set_up_python_logging.
+"""
 
 import os
 import socket
@@ -12,18 +18,17 @@ __email__ = 'corcorf@posteo.net'
 __version__ = '0.1.0'
 
 LOG_PATH = os.getenv("LOG_PATH", default="logs")
-if not os.path.exists(LOG_PATH):
-    os.mkdir(LOG_PATH)
 PINAME = socket.gethostname()
 
 
 def set_up_python_logging(level="DEBUG",
                           log_filename="local_loggers.log",
                           log_path=LOG_PATH,
-                          name="pi_logger"):
+                          name=f"pi_logger_{PINAME}"):
     """
-    Set up the python logging module
+    Set up the python logging module, creating log_path if necessary
     """
+    os.makedirs(log_path, exist_ok=True)
     log = logging.getLogger(name)
     log.setLevel(logging.DEBUG)
 
@@ -48,11 +53,5 @@ def set_up_python_logging(level="DEBUG",
     log.addHandler(console_handler)
     log.addHandler(file_handler)
     log.info("Logging level set at %s based on input %s", log.level, level)
+    log.debug("Path to db: %s", log_path)
     return log
-
-
-LOG = set_up_python_logging(name=f"pi_logger_{PINAME}", level="DEBUG",
-                            log_filename="local_loggers.log",
-                            log_path=LOG_PATH)
-
-LOG.debug("Path to db: %s", LOG_PATH)
@@ -0,0 +1,409 @@
+"""
+Server-side downsampling of sensor readings. Readings in the local SQLite
+database are grouped into fixed-size time buckets per location and reduced
+with an aggregate function in SQL, so that clients plotting hourly or daily
+values do not need to download every raw reading.
+
+Where the bucket size is a multiple of a minute, hour or day the buckets are
+built from the coarsest matching rollup table rather than from the raw
+readings, which may since have been deleted. The rollup tables are kept up
+to date by whatever writes the readings (the logger after each flush, or an
+import), so these queries only ever read the database.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from sqlalchemy import select, func, cast, Integer, and_
+
+from pi_logger import PINAME
+from pi_logger.local_db import (ENGINE, LocalData, LatestReading, ROLLUPS,
+                                ROLLUP_TABLES, DB_QUERY_SECONDS, RollupState,
+                                VALUE_FIELDS)
+from pi_logger.metrics import timed
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.aggregate")
+
+AGGREGATES = {
+    "mean": func.avg,
+    "min": func.min,
+    "max": func.max,
+    "count": func.count,
+    "last": None,  # value from the reading with the latest datetime
+}
+BUCKET_UNITS = {"s": 1, "min": 60, "h": 3600, "d": 86400}
+EPOCH = datetime(1970, 1, 1)
+# most grid times get_filled_readings will fill for each location, so that a
+# short interval over a long range cannot exhaust the pi's memory
+MAX_FILL_POINTS = int(os.getenv("MAX_FILL_POINTS", default="20000"))
+
+
+def parse_bucket(bucket):
+    """
+    Convert a bucket size such as 900, "15min", "1h" or "1d" to seconds
+    Raises ValueError for anything else
+    """
+    if isinstance(bucket, int) or str(bucket).isdigit():
+        seconds = int(bucket)
+    else:
+        match = re.fullmatch(r"(\d+)\s*(s|min|h|d)", str(bucket).strip())
+        if match is None:
+            raise ValueError(f"invalid bucket size: {bucket}")
+        seconds = int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+    if seconds <= 0:
+        raise ValueError(f"bucket size must be positive: {bucket}")
+    return seconds
+
+
+def to_epoch(value):
+    """
+    Return the number of seconds since the epoch for a datetime, taken as
+    UTC if it is naive
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return int((value - EPOCH).total_seconds())
+
+
+def get_changes(since_id, rolled_up=False, engine=ENGINE):
+    """
+    Return the id of the last reading that queries can see (the last one
+    rolled up if rolled_up is set) and the earliest datetime, in seconds
+    since the epoch, of the readings after since_id up to that id, or None
+    if there are none or since_id is None.
+    Used to find cached buckets that readings written late, e.g. by an
+    import or the aggregator, have since landed in
+    """
+    tab = LocalData.__table__
+    with engine.connect() as conn:
+        if rolled_up:
+            state = RollupState.__table__
+            last_id = conn.execute(
+                select([state.c.last_id]).where(state.c.name == "localdata")
+            ).scalar()
+        else:
+            last_id = conn.execute(select([func.max(tab.c.id)])).scalar()
+        last_id = last_id or 0
+        earliest = None
+        if since_id is not None and last_id > since_id:
+            earliest = conn.execute(
+                select([func.min(tab.c.datetime)])
+                .where(and_(tab.c.id > since_id, tab.c.id <= last_id))
+            ).scalar()
+    return last_id, None if earliest is None else to_epoch(earliest)
+
+
+def query_buckets(start, end, bucket_seconds, agg="mean", location=None,
+                  sensortype=None, table=LocalData, engine=ENGINE):
+    """
+    Aggregate readings with start <= datetime < end (both given as seconds
+    since the epoch) into buckets of bucket_seconds per location
+    Returns a list of dictionaries, one per non-empty bucket and location,
+    ordered by bucket then location
+    """
+    if agg not in AGGREGATES:
+        raise ValueError(f"aggregate must be one of {', '.join(AGGREGATES)}")
+    tab = table.__table__
+    epoch_seconds = cast(func.strftime('%s', tab.c.datetime), Integer)
+    bucket = (epoch_seconds / bucket_seconds * bucket_seconds).label("bucket")
+    if agg == "last":
+        # SQLite returns bare columns from the row holding MAX(datetime)
+        values = [func.max(tab.c.datetime).label("last_datetime")]
+        values += [tab.c[col] for col in VALUE_FIELDS]
+    else:
+        values = [AGGREGATES[agg](tab.c[col]).label(col)
+                  for col in VALUE_FIELDS]
+    # compare the column itself so that the datetime index can be used
+    conditions = [tab.c.datetime >= datetime.utcfromtimestamp(start),
+                  tab.c.datetime < datetime.utcfromtimestamp(end)]
+    if location is not None:
+        conditions.append(tab.c.location == location)
+    if sensortype is not None:
+        conditions.append(tab.c.sensortype == sensortype)
+    query = select([bucket, tab.c.location, func.count().label("n")]
+                   + values)\
+        .where(and_(*conditions))\
+        .group_by(tab.c.location, bucket)\
+        .order_by(bucket, tab.c.location)
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    result = []
+    for row in rows:
+        data = dict(datetime=datetime.utcfromtimestamp(row["bucket"]),
+                    location=row["location"], n=row["n"])
+        data.update({col: row[col] for col in VALUE_FIELDS})
+        result.append(data)
+    return result
+
+
+def choose_rollup(bucket_seconds):
+    """
+    Return the name of the coarsest rollup table whose buckets fit exactly
+    into buckets of bucket_seconds, or None if there is none
+    """
+    fitting = [(size, name) for name, (size, _) in ROLLUPS.items()
+               if bucket_seconds % size == 0]
+    return max(fitting)[1] if fitting else None
+
+
+def query_rollup(start, end, bucket_seconds, rollup, agg="mean",
+                 location=None, sensortype=None, engine=ENGINE):
+    """
+    As query_buckets, but combining the summaries in the named rollup table
+    instead of reading the raw readings. Rollup buckets starting before end
+    are included whole
+    """
+    if agg not in AGGREGATES:
+        raise ValueError(f"aggregate must be one of {', '.join(AGGREGATES)}")
+    tab = ROLLUP_TABLES[rollup]
+    epoch_seconds = cast(func.strftime('%s', tab.c.bucket), Integer)
+    bucket = (epoch_seconds / bucket_seconds * bucket_seconds).label("bucket")
+    if agg == "last":
+        # SQLite returns bare columns from the row holding MAX(last_datetime)
+        values = [func.max(tab.c.last_datetime).label("last_datetime")]
+        values += [tab.c[f"{col}_last"].label(col) for col in VALUE_FIELDS]
+    elif agg == "mean":
+        values = [(func.total(tab.c[f"{col}_sum"])
+                   / func.sum(tab.c[f"{col}_count"])).label(col)
+                  for col in VALUE_FIELDS]
+    elif agg == "count":
+        values = [func.sum(tab.c[f"{col}_count"]).label(col)
+                  for col in VALUE_FIELDS]
+    else:
+        values = [AGGREGATES[agg](tab.c[f"{col}_{agg}"]).label(col)
+                  for col in VALUE_FIELDS]
+    conditions = [tab.c.bucket >= datetime.utcfromtimestamp(start),
+                  tab.c.bucket < datetime.utcfromtimestamp(end)]
+    if location is not None:
+        conditions.append(tab.c.location == location)
+    if sensortype is not None:
+        conditions.append(tab.c.sensortype == sensortype)
+    query = select([bucket, tab.c.location, func.sum(tab.c.n).label("n")]
+                   + values)\
+        .where(and_(*conditions))\
+        .group_by(tab.c.location, bucket)\
+        .order_by(bucket, tab.c.location)
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    result = []
+    for row in rows:
+        data = dict(datetime=datetime.utcfromtimestamp(row["bucket"]),
+                    location=row["location"], n=row["n"])
+        data.update({col: row[col] for col in VALUE_FIELDS})
+        result.append(data)
+    return result
+
+
+class AggregateCache():
+    """
+    Cache of aggregated buckets. Only buckets that ended at least settle
+    seconds ago are cached, since later buckets may still receive readings.
+    For each combination of database, bucket size, aggregate and filters the
+    cache holds a contiguous run of complete buckets, so that a repeated
+    request only needs to query the database for buckets after that run.
+    Given a changes function (see get_changes), each run also records the
+    last reading id it reflects, and is cut back to before the earliest
+    bucket that readings written since then fall in.
+    At most max_entries combinations are kept, least recently used first out.
+    """
+    def __init__(self, max_entries=32, settle=300, clock=time.time):
+        self.max_entries = max_entries
+        self.settle = settle
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """
+        Remove everything from the cache
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key, start, end, fetch, changes=None):
+        """
+        Return the rows for buckets from start to end (seconds since the
+        epoch, aligned to buckets), calling fetch(start, end) to query any
+        range not held in the cache and, if given, changes(since_id) to
+        find readings written since the cached buckets were fetched
+        """
+        bucket_seconds = key[1]
+        complete_until = int(self.clock() - self.settle)
+        complete_until -= complete_until % bucket_seconds
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        version = None
+        if changes is not None:
+            version, earliest = changes(
+                None if entry is None else entry["version"]
+            )
+            if entry is not None and earliest is not None \
+                    and earliest < entry["end"]:
+                keep_end = max(earliest - earliest % bucket_seconds,
+                               entry["start"])
+                LOG.debug("late readings from %s, dropping cached buckets",
+                          datetime.utcfromtimestamp(earliest))
+                entry = dict(entry, end=keep_end, version=version,
+                             rows=[row for row in entry["rows"]
+                                   if to_epoch(row["datetime"]) < keep_end])
+                with self.lock:
+                    if keep_end > entry["start"]:
+                        self.entries[key] = entry
+                    else:
+                        self.entries.pop(key, None)
+        if entry is not None and entry["start"] <= start <= entry["end"]:
+            cached = [row for row in entry["rows"]
+                      if start <= to_epoch(row["datetime"]) < end]
+            fetch_from = max(start, entry["end"])
+        else:
+            entry = dict(start=start, end=start, rows=[])
+            cached = []
+            fetch_from = start
+        fetched = fetch(fetch_from, end) if fetch_from < end else []
+
+        new_end = min(end - end % bucket_seconds, complete_until)
+        if new_end > entry["end"]:
+            complete = [row for row in fetched
+                        if to_epoch(row["datetime"]) < new_end]
+            entry = dict(start=entry["start"], end=new_end,
+                         rows=entry["rows"] + complete)
+        if entry["end"] > entry["start"]:
+            entry = dict(entry, version=version)
+            with self.lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return cached + fetched
+
+
+AGGREGATE_CACHE = AggregateCache()
+
+
+@timed(DB_QUERY_SECONDS, query="get_aggregated_readings")
+def get_aggregated_readings(start_datetime_utc, end_datetime_utc=None,
+                            bucket="1h", agg="mean", location=None,
+                            sensortype=None, engine=ENGINE,
+                            cache=AGGREGATE_CACHE, use_rollups=True):
+    """
+    Get readings since start_datetime_utc (rounded down to a bucket boundary)
+    and before end_datetime_utc (default now) aggregated into buckets
+    bucket: size of the buckets, e.g. "15min", "1h", "1d" or seconds
+    agg: one of mean, min, max, last or count
+    use_rollups: build the buckets from the rollup tables where possible,
+                 which only include readings already rolled up by the writer
+    returns a list of dictionaries, each with the bucket start as datetime,
+    the location, the number of readings n and the aggregated values, or
+    None if there are no readings
+    """
+    bucket_seconds = parse_bucket(bucket)
+    if agg not in AGGREGATES:
+        raise ValueError(f"aggregate must be one of {', '.join(AGGREGATES)}")
+    if end_datetime_utc is None:
+        end_datetime_utc = datetime.utcnow()
+    start = to_epoch(start_datetime_utc)
+    start -= start % bucket_seconds
+    end = to_epoch(end_datetime_utc)
+    rollup = choose_rollup(bucket_seconds) if use_rollups else None
+
+    def fetch(fetch_start, fetch_end):
+        if rollup is None:
+            return query_buckets(fetch_start, fetch_end, bucket_seconds, agg,
+                                 location, sensortype, engine=engine)
+        return query_rollup(fetch_start, fetch_end, bucket_seconds, rollup,
+                            agg, location, sensortype, engine=engine)
+
+    LOG.debug("Aggregating readings since %s in %s s buckets (%s) from %s",
+              start_datetime_utc, bucket_seconds, agg, rollup or "localdata")
+    if cache is None:
+        result = fetch(start, end)
+    else:
+        key = (str(engine.url), bucket_seconds, agg, location, sensortype,
+               rollup)
+        result = cache.get(
+            key, start, end, fetch,
+            changes=lambda since_id: get_changes(since_id, rollup is not None,
+                                                 engine=engine)
+        )
+    return result or None
+
+
+@timed(DB_QUERY_SECONDS, query="get_filled_readings")
+def get_filled_readings(start_datetime_utc, end_datetime_utc=None,
+                        interval="5min", location=None, max_gap=None,
+                        engine=ENGINE, max_points=MAX_FILL_POINTS):
+    """
+    Reconstruct a regular series of readings, e.g. from a database written
+    through a local_db.DeadbandFilter, by forward-filling the stored readings
+    onto a grid of times every interval from start_datetime_utc (rounded
+    down to a multiple of interval) until end_datetime_utc (default now).
+    Each grid time of each location takes the values of the last reading
+    stored at or before it, if that reading is at most max_gap seconds old
+    (default unlimited); there is no row while a sensor has no such reading.
+    Raises ValueError if the grid would have more than max_points times.
+    returns a list of dictionaries ordered by datetime then location, each
+    with the grid time as datetime, the time of the stored reading as
+    reading_datetime and its values, or None if there are none
+    """
+    interval_seconds = parse_bucket(interval)
+    if end_datetime_utc is None:
+        end_datetime_utc = datetime.utcnow()
+    start = to_epoch(start_datetime_utc)
+    start -= start % interval_seconds
+    end = to_epoch(end_datetime_utc)
+    n_points = (end - start) // interval_seconds + 1
+    if n_points > max_points:
+        raise ValueError(f"fill would return {n_points} times per location, "
+                         f"more than the limit of {max_points}; use a "
+                         "longer interval or a later start")
+    grid = [datetime.utcfromtimestamp(t) for t in
+            range(start, end + 1, interval_seconds)]
+    if not grid:
+        return None
+    tab = LocalData.__table__
+    if location is None:
+        with engine.connect() as conn:
+            locations = [row[0] for row in conn.execute(
+                select([LatestReading.__table__.c.location])
+            )]
+    else:
+        locations = [location]
+
+    filled = []
+    with engine.connect() as conn:
+        for loc in locations:
+            # the last reading before the grid starts seeds the fill
+            seed = conn.execute(
+                select([tab]).where(and_(tab.c.location == loc,
+                                         tab.c.datetime <= grid[0]))
+                .order_by(tab.c.datetime.desc()).limit(1)
+            ).fetchall()
+            rows = conn.execute(
+                select([tab]).where(and_(tab.c.location == loc,
+                                         tab.c.datetime > grid[0],
+                                         tab.c.datetime <= grid[-1]))
+                .order_by(tab.c.datetime, tab.c.id)
+            ).fetchall()
+            readings = iter([dict(row) for row in seed + rows])
+            current, upcoming = None, next(readings, None)
+            for grid_time in grid:
+                while upcoming is not None and \
+                        upcoming["datetime"] <= grid_time:
+                    current, upcoming = upcoming, next(readings, None)
+                if current is None or (max_gap is not None and (
+                        grid_time - current["datetime"]
+                ).total_seconds() > max_gap):
+                    continue
+                data = dict(current, datetime=grid_time,
+                            reading_datetime=current["datetime"])
+                del data["id"]
+                filled.append(data)
+    filled.sort(key=lambda data: (data["datetime"], data["location"]))
+    return filled or None
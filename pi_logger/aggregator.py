@@ -0,0 +1,321 @@
+"""
+Collect readings from several pis running the pi_logger API into a single
+central database.
+
+Each pi (node) is pulled concurrently through its /readings_after endpoint,
+starting from a per-node high-water mark of the id of the last reading
+received, so that readings written to a pi with an older datetime than those
+already pulled (imports, backfills, readings taken before the clock was set)
+are collected too. Rows are deduplicated on (piid, location, datetime) when
+merged into the central store. A node that is slow or offline is retried
+with an exponential backoff, without holding up the other nodes.
+"""
+
+import os
+import time
+import json
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from sqlalchemy import (create_engine, Column, Integer, String, DateTime,
+                        Float, UniqueConstraint, select)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.declarative import declarative_base
+
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.aggregator")
+
+CENTRAL_BASE = declarative_base()
+CENTRAL_CONN_STRING = os.getenv(
+    "CENTRAL_DB",
+    default='sqlite:///{}'.format(os.path.join(LOG_PATH, "central.db"))
+)
+API_PORT = 5003
+
+
+class CentralData(CENTRAL_BASE):
+    """
+    Class for the table of readings collected from all pis
+    _______
+    columns:
+        as LocalData, with sourceid holding the id of the reading in the
+        pi's own database
+    """
+    __tablename__ = 'centraldata'
+    __table_args__ = (
+        UniqueConstraint('piid', 'location', 'datetime',
+                         name='uq_centraldata_reading'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    sourceid = Column(Integer)
+    datetime = Column(DateTime, index=True)
+    location = Column(String)
+    sensortype = Column(String)
+    piname = Column(String)
+    piid = Column(String)
+    temp = Column(Float)
+    humidity = Column(Float)
+    pressure = Column(Float)
+    gasvoc = Column(Float)
+    mcdvalue = Column(Integer)
+    mcdvoltage = Column(Float)
+    mcdstd = Column(Float)
+
+    def __repr__(self):
+        info = (self.piname, self.location, self.datetime)
+        return "<CentralData(pi={}, sensor={}, datetime={})>".format(*info)
+
+
+class NodeState(CENTRAL_BASE):
+    """
+    Class for the table of per-pi high-water marks
+    _______
+    columns:
+        name (String) # pi name
+        last_id (Integer) # id on the pi of the last reading received
+    """
+    __tablename__ = 'nodestate'
+
+    name = Column(String, primary_key=True)
+    last_id = Column(Integer)
+
+
+READING_FIELDS = ["datetime", "location", "sensortype", "piname", "piid",
+                  "temp", "humidity", "pressure", "gasvoc", "mcdvalue",
+                  "mcdvoltage", "mcdstd"]
+
+
+def set_up_central_database(engine):
+    """
+    Create the central tables if they do not exist
+    """
+    LOG.info("Attempting to create central db")
+    CENTRAL_BASE.metadata.create_all(engine)
+
+
+def parse_datetime(value):
+    """
+    Convert a datetime sent by the pi_logger API, as from
+    datetime.isoformat, back to a datetime
+    """
+    if "." in value:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def read_nodes(path=LOG_PATH, filename='logger_config.csv', port=API_PORT):
+    """
+    Return a dictionary of pi name: API url for every pi in the logger config
+    """
+    file_path = os.path.join(path, filename)
+    with open(file_path, "r") as file:
+        header = file.readline().strip().split(",")
+        name_col = header.index("name")
+        names = {line.strip().split(",")[name_col]
+                 for line in file if line.strip()}
+    return {name: f"http://{name}:{port}" for name in sorted(names)}
+
+
+class Node():
+    """
+    A pi serving the pi_logger API, with its high-water mark and backoff
+    state. Each node has its own requests session so that connections are
+    reused between pulls.
+    """
+    def __init__(self, name, url, last_id=0):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.last_id = last_id
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.session = requests.Session()
+
+    def __repr__(self):
+        return "<Node(name={}, url={}, failures={})>".format(
+            self.name, self.url, self.failures
+        )
+
+    def is_due(self, now):
+        """
+        Return True unless the node is backing off after a failure
+        """
+        return now >= self.next_attempt
+
+    def record_success(self):
+        """
+        Reset the backoff after a successful pull
+        """
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def record_failure(self, now, backoff, max_backoff):
+        """
+        Back off exponentially after a failed pull
+        Returns the delay in seconds before the next attempt
+        """
+        self.failures += 1
+        delay = min(backoff * 2 ** (self.failures - 1), max_backoff)
+        self.next_attempt = now + delay
+        return delay
+
+    def fetch_page(self, limit, timeout):
+        """
+        Fetch up to limit readings after the high-water mark, in id order
+        Returns a list of reading dictionaries
+        """
+        url = f"{self.url}/readings_after/{self.last_id}"
+        response = self.session.get(url, params=dict(limit=limit),
+                                    timeout=timeout)
+        response.raise_for_status()
+        readings = []
+        for line in response.iter_lines():
+            if line:
+                reading = json.loads(line)
+                reading["datetime"] = parse_datetime(reading["datetime"])
+                readings.append(reading)
+        return readings
+
+
+def insert_ignoring_duplicates(conn, table, rows):
+    """
+    Insert rows into table, skipping any that break a unique constraint
+    """
+    if conn.dialect.name == "postgresql":
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        statement = table.insert().prefix_with("OR IGNORE")
+    conn.execute(statement, rows)
+
+
+class Aggregator():
+    """
+    Pull new readings from a set of nodes into the central database
+    nodes: dictionary of pi name: API url, as returned by read_nodes
+    page_size: readings requested per HTTP request
+    timeout: seconds to wait for a node before counting it as failed
+    backoff, max_backoff: first and longest delays in seconds before
+        retrying a failed node
+    """
+    # pylint: disable=R0913
+    def __init__(self, nodes, engine, page_size=5000, timeout=10,
+                 backoff=30, max_backoff=3600, clock=time.time):
+        self.engine = engine
+        self.page_size = page_size
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        set_up_central_database(engine)
+        self.nodes = [Node(name, url) for name, url in nodes.items()]
+        self.load_state()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(nodes), 1),
+                                           thread_name_prefix="pull")
+
+    def load_state(self):
+        """
+        Restore the high-water marks of the nodes from the central database
+        """
+        tab = NodeState.__table__
+        with self.engine.connect() as conn:
+            state = {row["name"]: row for row in
+                     conn.execute(select([tab])).fetchall()}
+        for node in self.nodes:
+            if node.name in state:
+                node.last_id = state[node.name]["last_id"]
+
+    def save_page(self, node, readings):
+        """
+        Merge a page of readings from node into the central database and
+        advance its high-water mark in the same transaction
+        """
+        rows = [dict({k: r.get(k) for k in READING_FIELDS},
+                     sourceid=r.get("id")) for r in readings]
+        last = readings[-1]
+        with self.engine.begin() as conn:
+            insert_ignoring_duplicates(conn, CentralData.__table__, rows)
+            conn.execute(NodeState.__table__.delete()
+                         .where(NodeState.name == node.name))
+            conn.execute(NodeState.__table__.insert(),
+                         dict(name=node.name, last_id=last["id"]))
+        node.last_id = last["id"]
+
+    def pull_node(self, node):
+        """
+        Fetch pages of new readings from node until it has no more
+        Returns the number of readings received
+        """
+        n_received = 0
+        while True:
+            readings = node.fetch_page(self.page_size, self.timeout)
+            if readings:
+                self.save_page(node, readings)
+                n_received += len(readings)
+            if len(readings) < self.page_size:
+                return n_received
+
+    def sync_once(self):
+        """
+        Pull from every node that is not backing off, concurrently. A node
+        is backed off after a failed request or any other error pulling or
+        saving its readings, e.g. a malformed reading or a locked central
+        database, without stopping the pulls from the other nodes
+        Returns a dictionary of node name: readings received (or None if
+        the pull failed)
+        """
+        now = self.clock()
+        futures = {node: self.executor.submit(self.pull_node, node)
+                   for node in self.nodes if node.is_due(now)}
+        results = {}
+        for node, future in futures.items():
+            try:
+                results[node.name] = future.result()
+                node.record_success()
+            except requests.RequestException as err:
+                delay = node.record_failure(self.clock(), self.backoff,
+                                            self.max_backoff)
+                LOG.warning("pull from %s failed (%s); retrying in %s s",
+                            node.name, err, delay)
+                results[node.name] = None
+            except Exception:  # pylint: disable=W0703
+                delay = node.record_failure(self.clock(), self.backoff,
+                                            self.max_backoff)
+                LOG.exception("pull from %s failed; retrying in %s s",
+                              node.name, delay)
+                results[node.name] = None
+        return results
+
+    def run(self, interval=60):
+        """
+        Pull from the nodes every interval seconds, forever
+        """
+        while True:
+            LOG.info("received %s", self.sync_once())
+            time.sleep(interval)
+
+    def close(self):
+        """
+        Stop the worker threads and close the node sessions
+        """
+        self.executor.shutdown(wait=True)
+        for node in self.nodes:
+            node.session.close()
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Collect readings from all pis in the logger config."
+    )
+    PARSER.add_argument("--interval", type=int, default=60,
+                        help="seconds between pulls")
+    ARGS = PARSER.parse_args()
+    set_up_python_logging(log_filename="aggregator.log", log_path=LOG_PATH)
+    AGGREGATOR = Aggregator(read_nodes(), create_engine(CENTRAL_CONN_STRING))
+    try:
+        AGGREGATOR.run(ARGS.interval)
+    finally:
+        AGGREGATOR.close()
@@ -3,22 +3,44 @@ API for the pi_logger module
 
 adapted from:
 https://www.codementor.io/@sagaragarwal94/building-a-basic-restful-api-in-python-58k02xsiq
+
+pandas is imported by the handlers that need it rather than at import time,
+so that the server starts quickly
+
+The routes serving stored readings answer conditional requests: each
+response carries an ETag that changes whenever readings are added or pruned,
+and repeated requests are served from an in-memory cache until then.
+New readings are pushed to subscribers of /live as Server-Sent Events
 """
-# pylint: disable=C0103
+# pylint: disable=C0103,C0415
 
+import os
+import gzip
 import json
+import time
 import logging
 import urllib
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+from collections import OrderedDict, namedtuple
 
-import pandas as pd
-from flask import Flask, render_template, url_for
-from flask_restful import Resource, Api
-from pi_logger import PINAME, LOG_PATH
-from pi_logger.local_db import (ENGINE, get_recent_readings,
-                                get_last_reading)
-from pi_logger.local_loggers import getserial, initialise_sensors
-from pi_logger.local_loggers import (poll_all_dht22, poll_all_bme680,
-                                     poll_all_mcp3008)
+from flask import (Flask, Response, render_template, request, url_for,
+                   has_request_context, g)
+from flask_restful import Resource, Api, abort
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.local_db import (ENGINE, ReadingWriter, get_recent_readings,
+                                get_last_reading, get_last_readings,
+                                iter_readings, get_data_version,
+                                get_readings_after_id,
+                                count_readings_after_id)
+from pi_logger.live import BROADCASTER
+from pi_logger.aggregate import get_aggregated_readings, get_filled_readings
+from pi_logger.local_loggers import (getserial, initialise_sensors,
+                                     PollingEngine)
+from pi_logger.sensor_daemon import request_poll, send_command
+from pi_logger.metrics import (REGISTRY, CONTENT_TYPE, merge, render,
+                               file_size)
 
 app = Flask(__name__)
 api = Api(app)
@@ -26,18 +48,277 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 LOG = logging.getLogger(f"pi_logger_{PINAME}.api_server")
 
+REQUEST_SECONDS = REGISTRY.histogram(
+    "pi_logger_api_request_seconds", "Time taken to handle each API route",
+    ["endpoint"],
+)
+REQUESTS = REGISTRY.counter(
+    "pi_logger_api_requests_total", "API requests by route and status code",
+    ["endpoint", "status"],
+)
+DB_SIZE = REGISTRY.gauge(
+    "pi_logger_db_size_bytes", "Size of the local database file and its WAL",
+)
+DB_SIZE.set_function(lambda: file_size(ENGINE.url.database))
+LOGGER_UP = REGISTRY.gauge(
+    "pi_logger_logger_up",
+    "Whether the logger answered on its control socket for this scrape",
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "pi_logger_api_cache_requests_total",
+    "Conditional API requests by outcome: hit, miss or not_modified",
+    ["result"],
+)
+# seconds to wait for the logger's metrics before leaving them out
+LOGGER_METRICS_TIMEOUT = 2
+# smallest response body worth compressing, in bytes
+GZIP_MIN_BYTES = 1024
+# seconds between comments sent to idle live subscribers, so that proxies
+# keep the connection open and disconnected clients are noticed
+LIVE_KEEPALIVE_SECONDS = 15
+# readings buffered for each live subscriber before the oldest are dropped
+LIVE_MAX_QUEUE = int(os.getenv("LIVE_MAX_QUEUE", default="100"))
+# live streams served at once by each process; each holds a request thread
+# for as long as it is open, so this must be below the number of threads
+LIVE_MAX_CONNECTIONS = int(os.getenv("LIVE_MAX_CONNECTIONS", default="16"))
+CachedBody = namedtuple("CachedBody", ["body", "gzipped", "mimetype"])
+
+
+class ResponseCache():
+    """
+    Cache of response bodies built from one version of the stored readings.
+    Storing a body for a new version empties the cache, since every body
+    built from an earlier version is stale. At most max_entries bodies,
+    plus their compressed copies, totalling max_bytes are kept, least
+    recently used first out; a body larger than max_bytes is not cached.
+    Also notes when the latest version was first seen, to serve as its
+    Last-Modified time.
+    """
+    def __init__(self, max_entries=128, max_bytes=8 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.size = 0
+        self.entries = OrderedDict()
+        self.seen_version = None
+        self.seen_at = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(entry):
+        """
+        Return the bytes held by a CachedBody
+        """
+        return len(entry.body) + len(entry.gzipped or b"")
+
+    def clear(self):
+        """
+        Remove everything from the cache
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.seen_version = None
+            self.seen_at = None
+
+    def first_seen(self, version):
+        """
+        Return the UTC time, in whole seconds, at which version was first
+        seen, if it is the latest version seen, otherwise now
+        """
+        with self.lock:
+            if version != self.seen_version:
+                self.seen_version = version
+                self.seen_at = datetime.utcnow().replace(microsecond=0)
+            return self.seen_at
+
+    def get(self, key, version):
+        """
+        Return the CachedBody stored for key and version, or None
+        """
+        with self.lock:
+            if version != self.version:
+                return None
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, entry):
+        """
+        Store a CachedBody for key and version
+        """
+        size = self.entry_size(entry)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self.entry_size(previous)
+            self.entries[key] = entry
+            self.size += size
+            while len(self.entries) > self.max_entries \
+                    or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.entry_size(evicted)
+
+
+RESPONSE_CACHE = ResponseCache()
+REGISTRY.gauge(
+    "pi_logger_api_cache_bytes", "Bytes held by the API response cache",
+).set_function(lambda: RESPONSE_CACHE.size)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Note the time each request starts
+    """
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Record the time taken and status of each request
+    """
+    endpoint = request.endpoint or "unknown"
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+
+def cached_response(get, args, kwargs, version):
+    """
+    Return a response with the body of get(*args, **kwargs), reusing the
+    body cached for this request and version if there is one. Bodies of at
+    least GZIP_MIN_BYTES are sent compressed to clients that accept gzip
+    """
+    key = request.full_path
+    entry = RESPONSE_CACHE.get(key, version)
+    if entry is None:
+        CACHE_REQUESTS.inc(result="miss")
+        response = api.make_response(get(*args, **kwargs), 200)
+        body = response.get_data()
+        gzipped = None
+        if len(body) >= GZIP_MIN_BYTES:
+            gzipped = gzip.compress(body, compresslevel=6)
+        entry = CachedBody(body, gzipped, response.mimetype)
+        RESPONSE_CACHE.put(key, version, entry)
+    else:
+        CACHE_REQUESTS.inc(result="hit")
+    if entry.gzipped is not None and "gzip" in request.accept_encodings:
+        response = Response(entry.gzipped, mimetype=entry.mimetype)
+        response.content_encoding = "gzip"
+    else:
+        response = Response(entry.body, mimetype=entry.mimetype)
+    return response
+
+
+def conditional_get(uncached_args=()):
+    """
+    Decorator for the get method of a resource whose response depends only
+    on the request and the stored readings. Adds a weak ETag, from the
+    first and last reading ids and the id of the last reading rolled up,
+    and a Last-Modified header, from the time this version of the readings
+    was first seen, answers a matching If-None-Match (or, without one,
+    If-Modified-Since) with 304 Not Modified and otherwise serves the
+    response through cached_response.
+    The logger updates the rollup tables, which responses with a resolution
+    are read from, in a separate transaction after writing readings, so the
+    version changes again once they are up to date.
+    Unlike the latest reading's datetime, the time a version was first seen
+    changes when older readings are backfilled or deleted. As it is in
+    whole seconds, a later version could be seen within the same second,
+    so Last-Modified is only sent, and If-Modified-Since only honoured,
+    once that second is over.
+    Requests with any of uncached_args, whose responses also depend on the
+    time they are made, are passed straight to get
+    """
+    def decorator(get):
+        @wraps(get)
+        def wrapper(*args, **kwargs):
+            if any(arg in request.args for arg in uncached_args):
+                return get(*args, **kwargs)
+            first_id, last_id, _, rolled_up_id = get_data_version(
+                engine=kwargs.get("engine", ENGINE)
+            )
+            etag = f"{first_id or 0}-{last_id or 0}-{rolled_up_id or 0}"
+            modified = RESPONSE_CACHE.first_seen(etag)
+            settled = modified + timedelta(seconds=1) <= datetime.utcnow()
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = since is not None and settled \
+                    and modified <= since.replace(tzinfo=None)
+            if not_modified:
+                CACHE_REQUESTS.inc(result="not_modified")
+                response = Response(status=304)
+            else:
+                response = cached_response(get, args, kwargs, etag)
+            response.set_etag(etag, weak=True)
+            if settled:
+                response.last_modified = modified
+            response.cache_control.no_cache = True
+            response.vary.add("Accept-Encoding")
+            return response
+        return wrapper
+    return decorator
+
 
 class GetRecent(Resource):
     """
     API resource to provide all readings since a given start_datetime (UTC)
+    Optional query parameters:
+        resolution: return the mean of each location's readings in buckets
+                    of this size, e.g. 15min, 1h or 1d, read from the
+                    coarsest rollup table that provides it
+        fill: return a regular series at this interval, e.g. 5min, with
+              each location's last stored reading carried forward; responds
+              with 400 if the series would have more than
+              aggregate.MAX_FILL_POINTS times
+        max_gap: with fill, the longest time in seconds to carry a reading
+                 forward
+    Responses without fill are cached, see conditional_get
     """
+    method_decorators = [conditional_get(uncached_args=("fill",))]
+
     # pylint: disable=R0201
-    def get(self, start_datetime_utc, engine=ENGINE):
+    def get(self, start_datetime_utc, engine=ENGINE, resolution=None,
+            fill=None, max_gap=None):
         """
         GetRecent API resource get function
         """
+        import pandas as pd
         start_datetime_utc = pd.to_datetime(start_datetime_utc)
-        result = get_recent_readings(start_datetime_utc, engine=engine)
+        if has_request_context():
+            resolution = request.args.get('resolution', resolution)
+            fill = request.args.get('fill', fill)
+            max_gap = request.args.get('max_gap', max_gap, type=float)
+        if resolution is not None or fill is not None:
+            try:
+                if resolution is not None:
+                    result = get_aggregated_readings(start_datetime_utc,
+                                                     bucket=resolution,
+                                                     engine=engine)
+                else:
+                    result = get_filled_readings(start_datetime_utc,
+                                                 interval=fill,
+                                                 max_gap=max_gap,
+                                                 engine=engine)
+            except ValueError as err:
+                abort(400, message=str(err))
+            if result is not None:
+                return pd.DataFrame(result).to_json()
+        else:
+            result = get_recent_readings(start_datetime_utc, engine=engine)
         if result is None:
             msg = '{"message": "query returns no results"}'
             result = json.loads(msg)
@@ -49,15 +330,202 @@ class GetRecent(Resource):
         return result
 
 
+class StreamRecent(Resource):
+    """
+    API resource to stream readings since a given start_datetime_utc as
+    newline-delimited JSON, one reading per line in (datetime, id) order.
+    Optional query parameters:
+        limit: maximum number of readings to return
+        after_id: with start_datetime_utc set to the datetime of the last
+                  reading received, return the page following that reading
+    """
+    # pylint: disable=R0201
+    def get(self, start_datetime_utc, engine=ENGINE):
+        """
+        StreamRecent API resource get function
+        """
+        import pandas as pd
+        try:
+            start = pd.to_datetime(start_datetime_utc)
+        except ValueError:
+            abort(400, message=f"invalid datetime: {start_datetime_utc}")
+        if start.tzinfo is not None:
+            start = start.tz_convert("UTC").tz_localize(None)
+        start_datetime_utc = start.to_pydatetime()
+        limit = request.args.get('limit', type=int)
+        after_id = request.args.get('after_id', type=int)
+        readings = iter_readings(start_datetime_utc, after_id=after_id,
+                                 limit=limit, engine=engine)
+        lines = (json.dumps(reading, default=datetime.isoformat) + "\n"
+                 for reading in readings)
+        return Response(lines, mimetype='application/x-ndjson')
+
+
+class ReadingsAfter(Resource):
+    """
+    API resource to return the readings written after the one with id
+    last_id as newline-delimited JSON, one reading per line in id order,
+    whatever their datetimes. Used by the aggregator to pull every reading
+    exactly once, including those imported or backfilled with an older
+    datetime than readings already pulled.
+    Optional query parameters:
+        limit: maximum number of readings to return, default 1000
+    """
+    # pylint: disable=R0201
+    def get(self, last_id, engine=ENGINE):
+        """
+        ReadingsAfter API resource get function
+        """
+        limit = request.args.get('limit', 1000, type=int)
+        readings = get_readings_after_id(last_id, limit, engine=engine)
+        lines = (json.dumps(reading, default=datetime.isoformat) + "\n"
+                 for reading in readings)
+        return Response(lines, mimetype='application/x-ndjson')
+
+
+def format_event(event, data, event_id=None):
+    """
+    Return a Server-Sent Event with data encoded as JSON
+    """
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, default=datetime.isoformat))
+    return "\n".join(lines) + "\n\n"
+
+
+def live_events(subscription, backlog=(), skipped=0):
+    """
+    Yield the readings in backlog and then each reading passed to
+    subscription as Server-Sent Events, with the reading's id as the event
+    id. A "dropped" event reports the number of readings skipped after the
+    backlog, or dropped because the client fell behind, and a comment is
+    sent whenever no reading arrives within LIVE_KEEPALIVE_SECONDS
+    """
+    last_id = 0
+    dropped = 0
+    yield "retry: 5000\n\n"
+    for reading in backlog:
+        last_id = reading["id"]
+        yield format_event("reading", reading, last_id)
+    if skipped:
+        yield format_event("dropped", dict(count=skipped))
+    while True:
+        reading = subscription.get(timeout=LIVE_KEEPALIVE_SECONDS)
+        if subscription.dropped != dropped:
+            yield format_event("dropped",
+                               dict(count=subscription.dropped - dropped))
+            dropped = subscription.dropped
+        if reading is None:
+            yield ": keepalive\n\n"
+        elif reading["id"] > last_id:
+            last_id = reading["id"]
+            yield format_event("reading", reading, last_id)
+
+
+class LiveReadings(Resource):
+    """
+    API resource to push each new reading to the client as a Server-Sent
+    Event as soon as it is written. All subscribers share one watcher on
+    the database, see live.Broadcaster.
+    Optional query parameters:
+        location, sensortype: only send matching readings, may be repeated
+                              or comma separated
+    A client reconnecting with a Last-Event-ID header is first sent the
+    readings it missed, up to LIVE_MAX_QUEUE of them, followed by a
+    "dropped" event with the number of any more it missed.
+    Responds with 503 when LIVE_MAX_CONNECTIONS streams are already open
+    """
+    # pylint: disable=R0201
+    def get(self, broadcaster=BROADCASTER):
+        """
+        LiveReadings API resource get function
+        """
+        filters = {}
+        for name in ["location", "sensortype"]:
+            filters[name] = [value for values in request.args.getlist(name)
+                             for value in values.split(",") if value]
+        subscription = broadcaster.subscribe(
+            filters["location"], filters["sensortype"],
+            max_queue=LIVE_MAX_QUEUE, max_subscribers=LIVE_MAX_CONNECTIONS
+        )
+        if subscription is None:
+            abort(503, message=f"already serving {LIVE_MAX_CONNECTIONS} "
+                               "live streams, try again later")
+        backlog = []
+        skipped = 0
+        last_event_id = request.headers.get("Last-Event-ID", type=int)
+        if last_event_id is not None:
+            backlog = get_readings_after_id(
+                last_event_id, LIVE_MAX_QUEUE, filters["location"],
+                filters["sensortype"], engine=broadcaster.engine
+            )
+            if len(backlog) == LIVE_MAX_QUEUE:
+                skipped = count_readings_after_id(
+                    backlog[-1]["id"], subscription.start_id,
+                    filters["location"], filters["sensortype"],
+                    engine=broadcaster.engine
+                )
+        response = Response(live_events(subscription, backlog, skipped),
+                            mimetype='text/event-stream')
+        response.call_on_close(lambda: broadcaster.unsubscribe(subscription))
+        response.cache_control.no_cache = True
+        # stop nginx from buffering the stream
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+
+
+class GetAggregate(Resource):
+    """
+    API resource to provide readings since a given start_datetime (UTC),
+    aggregated into time buckets for each location.
+    Optional query parameters:
+        bucket: bucket size, e.g. 15min, 1h (default) or 1d
+        agg: mean (default), min, max, last or count
+        end: end datetime (UTC), defaults to now
+        location, sensortype: only include matching readings
+    """
+    # pylint: disable=R0201
+    def get(self, start_datetime_utc, engine=ENGINE):
+        """
+        GetAggregate API resource get function
+        """
+        import pandas as pd
+        try:
+            start_datetime_utc = pd.to_datetime(start_datetime_utc)
+            end_datetime_utc = request.args.get('end')
+            if end_datetime_utc is not None:
+                end_datetime_utc = pd.to_datetime(end_datetime_utc)
+            result = get_aggregated_readings(
+                start_datetime_utc, end_datetime_utc,
+                bucket=request.args.get('bucket', '1h'),
+                agg=request.args.get('agg', 'mean'),
+                location=request.args.get('location'),
+                sensortype=request.args.get('sensortype'),
+                engine=engine,
+            )
+        except ValueError as err:
+            abort(400, message=str(err))
+        if result is None:
+            msg = '{"message": "query returns no results"}'
+            result = json.loads(msg)
+        else:
+            result = pd.DataFrame(result)
+            result = result.to_json()
+        return result
+
+
 class GetLast(Resource):
     """
     API resource to provide the last recorded set of readings
     """
+    method_decorators = [conditional_get()]
+
     # pylint: disable=R0201
     def get(self, engine=ENGINE):
         """
         GetLast API resource get function
         """
+        import pandas as pd
         result = get_last_reading(engine=engine)
         if result is None:
             msg = '{"message": "query returns no results"}'
@@ -68,37 +536,70 @@ class GetLast(Resource):
         return result
 
 
-class PollSensors(Resource):
+class GetLatest(Resource):
     """
-    API resource to trigger a sensor polling event, returning the result
+    API resource to provide the most recent reading from every sensor
     """
+    method_decorators = [conditional_get()]
+
     # pylint: disable=R0201
-    def get(self):
+    def get(self, engine=ENGINE):
         """
-        PollSensors API resource get function
+        GetLatest API resource get function
         """
-        piid = getserial()
-        engine = ENGINE
-        dht_sensor, dht_conf, bme_sensor, bme_conf, mcp_chip, mcp_conf = \
-            initialise_sensors(pi_name=PINAME,
-                               config_path=LOG_PATH,
-                               config_fn='logger_config.csv')
-        # msg = 'Performing one-off logging of sensors connected to {pi_name}'
-        # LOG.info(msg)
-        poll_all_dht22(dht_conf, dht_sensor, piid, PINAME, engine)
-        poll_all_bme680(bme_conf, bme_sensor, piid, PINAME, engine)
-        poll_all_mcp3008(mcp_conf, mcp_chip, piid, PINAME, engine)
-
-        result = get_last_reading(engine=engine)
+        import pandas as pd
+        result = get_last_readings(engine=engine)
         if result is None:
             msg = '{"message": "query returns no results"}'
             result = json.loads(msg)
         else:
-            result = pd.DataFrame(result, index=[0])
+            result = pd.DataFrame(result)
             result = result.to_json()
         return result
 
 
+class PollSensors(Resource):
+    """
+    API resource to trigger a sensor polling event, returning the latest
+    reading from every sensor
+    """
+    # pylint: disable=R0201
+    def get(self):
+        """
+        PollSensors API resource get function
+        Asks the running logger to poll its sensors, only setting up the
+        sensors here if the logger's control socket is not available.
+        If the logger is running but fails to poll, times out or cannot be
+        reached, responds with 503 rather than competing for the sensors
+        """
+        engine = ENGINE
+        try:
+            request_poll()
+        except ConnectionError as err:
+            LOG.warning("polling sensors directly: %s", err)
+            poll_sensors_directly(engine)
+        except (OSError, RuntimeError) as err:
+            LOG.error("the logger failed to poll its sensors: %s", err)
+            abort(503, message=f"the logger failed to poll its sensors: "
+                               f"{err}")
+        return GetLatest().get(engine=engine)
+
+
+def poll_sensors_directly(engine=ENGINE):
+    """
+    Set up the sensors listed in the config file, poll them once and save
+    the readings to the database
+    """
+    piid = getserial()
+    sensors = initialise_sensors(pi_name=PINAME,
+                                 config_path=LOG_PATH,
+                                 config_fn='logger_config.csv')
+    LOG.info('Performing one-off logging of sensors connected to %s', PINAME)
+    with PollingEngine(*sensors, pi_id=piid, pi_name=PINAME) as poller, \
+            ReadingWriter(engine) as writer:
+        poller.poll(writer)
+
+
 def check_api_result(result):
     """
     Check that the result of an API request contains a datetime and temperature
@@ -114,11 +615,35 @@ def check_api_result(result):
     return True
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Return the metrics of the API server and of the logger, if it is
+    running, in the Prometheus text format. The API's metrics are labelled
+    with the pid of the worker process serving the scrape, as each worker
+    of pi_logger.serve counts separately
+    """
+    try:
+        logger_metrics = send_command(
+            "metrics", timeout=LOGGER_METRICS_TIMEOUT
+        )["metrics"]
+        LOGGER_UP.set(1)
+    except (OSError, RuntimeError) as err:
+        LOG.debug("leaving out the logger's metrics: %s", err)
+        logger_metrics = []
+        LOGGER_UP.set(0)
+    families = merge(REGISTRY.collect(process="api", worker=str(os.getpid())),
+                     logger_metrics)
+    return Response(render(families), mimetype=None,
+                    content_type=CONTENT_TYPE)
+
+
 @app.route('/')
 def main_page():
     """
     Render the main page with a table of available API routes
     """
+    import pandas as pd
     table = pd.DataFrame()
     for rule in app.url_map.iter_rules():
         options = {}
@@ -141,9 +666,15 @@ def main_page():
 
 
 api.add_resource(GetRecent, '/get_recent/<start_datetime_utc>')
+api.add_resource(StreamRecent, '/stream_recent/<start_datetime_utc>')
+api.add_resource(ReadingsAfter, '/readings_after/<int:last_id>')
+api.add_resource(GetAggregate, '/get_aggregate/<start_datetime_utc>')
+api.add_resource(LiveReadings, '/live')
 api.add_resource(GetLast, '/get_last')
+api.add_resource(GetLatest, '/get_latest')
 api.add_resource(PollSensors, '/poll_sensors')
 
 
 if __name__ == '__main__':
+    set_up_python_logging(log_filename="api_server.log", log_path=LOG_PATH)
     app.run(host='0.0.0.0', port='5003', debug=False)
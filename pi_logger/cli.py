@@ -23,6 +23,56 @@ def get_local_logger_arguments():
     parser.add_argument('--setup_db', action='store_const',
                         const=True, default=False,
                         help='initilise the local database')
+    parser.add_argument('--fixed_rate', action='store_const',
+                        const=True, default=False,
+                        help='align readings to multiples of the frequency '
+                        'on the clock, without drift')
+    parser.add_argument('--adaptive', action='store_const',
+                        const=True, default=False,
+                        help='poll each sensor at its own interval, '
+                        'adapted to how fast its readings change within '
+                        'the bounds in the logger config')
+    parser.add_argument('--control_socket', action='store_const',
+                        const=True, default=False,
+                        help='accept on-demand poll requests from the api '
+                        'server over a unix socket')
+    parser.add_argument('--batch_size', type=int, default=100,
+                        help='max number of readings to buffer before '
+                        'writing to the database')
+    parser.add_argument('--flush_age', type=float, default=60,
+                        help='max age in seconds of buffered readings '
+                        'before writing to the database')
+    parser.add_argument('--keep_days', type=float, default=None,
+                        help='delete raw readings older than this many days '
+                        'once summarised in the rollup tables')
+    parser.add_argument('--keep_minute_days', type=float, default=None,
+                        help='delete per-minute rollups older than this '
+                        'many days')
+    parser.add_argument('--deadband', nargs='*', metavar='FIELD=WIDTH',
+                        help='only store a reading if a field has changed '
+                        'by more than its deadband since the last stored '
+                        'reading; give no widths to use the defaults')
+    parser.add_argument('--heartbeat', type=float, default=900,
+                        help='with --deadband, store a reading at least '
+                        'this often in seconds')
+    parser.add_argument('--storage', choices=['sqlite', 'ring'],
+                        default='sqlite',
+                        help='store readings in the sqlite database or in '
+                        'memory-mapped ring buffer files per sensor, which '
+                        'the api server cannot serve; ring cannot be used '
+                        'with --control_socket')
+    parser.add_argument('--dht_retries', type=int, default=2,
+                        help='times to retry a failed DHT22 read')
+    parser.add_argument('--dht_deadline', type=float, default=8,
+                        help='seconds after which to stop retrying a '
+                        'DHT22 read')
+    parser.add_argument('--mcp_samples', type=int, default=1,
+                        help='number of times to read each MCP3008 channel '
+                        'per reading, in a burst')
+    parser.add_argument('--mcp_reduce', choices=['median', 'mean'],
+                        default='median',
+                        help='how to reduce a burst of MCP3008 samples to '
+                        'one reading')
     return parser.parse_args()
 
 
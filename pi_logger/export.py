@@ -0,0 +1,137 @@
+"""
+Export the localdata table to compressed Parquet files partitioned by pi
+name and date, for analysis off the pi.
+
+The id of the last exported row is stored as a high-water mark in the
+output directory, so each run only exports rows added since the previous
+one. Requires the optional pyarrow dependency (pip install pi_logger[export]).
+"""
+
+import os
+import json
+import logging
+import argparse
+
+from sqlalchemy import select
+
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.local_db import ENGINE, LocalData
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.export")
+
+EXPORT_PATH = os.getenv("EXPORT_PATH",
+                        default=os.path.join(LOG_PATH, "export"))
+# the leading underscore keeps parquet readers from treating it as data
+STATE_FILENAME = "_export_state.json"
+PARTITION_COLS = ["piname", "date"]
+
+
+def get_arrow_schema():
+    """
+    Return the Arrow schema of exported readings
+    """
+    return pa.schema([
+        ("id", pa.int64()),
+        ("datetime", pa.timestamp("us")),
+        ("location", pa.string()),
+        ("sensortype", pa.string()),
+        ("piname", pa.string()),
+        ("piid", pa.string()),
+        ("temp", pa.float64()),
+        ("humidity", pa.float64()),
+        ("pressure", pa.float64()),
+        ("gasvoc", pa.float64()),
+        ("mcdvalue", pa.int64()),
+        ("mcdvoltage", pa.float64()),
+        ("mcdstd", pa.float64()),
+        ("date", pa.string()),
+    ])
+
+
+def read_high_water_mark(out_dir):
+    """
+    Return the id of the last row exported to out_dir, or 0
+    """
+    state_path = os.path.join(out_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return 0
+    with open(state_path, "r") as file:
+        return json.load(file)["high_water_mark"]
+
+
+def write_high_water_mark(out_dir, high_water_mark):
+    """
+    Record the id of the last row exported to out_dir, replacing the state
+    file atomically so that an interrupted run cannot corrupt it
+    """
+    state_path = os.path.join(out_dir, STATE_FILENAME)
+    with open(state_path + ".tmp", "w") as file:
+        json.dump(dict(high_water_mark=high_water_mark), file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def rows_to_table(rows):
+    """
+    Convert rows of localdata to an Arrow table with a date partition column
+    """
+    records = []
+    for row in rows:
+        record = dict(row)
+        record["date"] = record["datetime"].strftime("%Y-%m-%d")
+        records.append(record)
+    return pa.Table.from_pylist(records, schema=get_arrow_schema())
+
+
+def export_parquet(out_dir=EXPORT_PATH, engine=ENGINE, chunk_size=100000,
+                   compression="zstd"):
+    """
+    Export rows of localdata added since the last export to Parquet files
+    under out_dir, partitioned as piname=<name>/date=<YYYY-MM-DD>/.
+    Rows are read and written chunk_size at a time, and the high-water mark
+    is advanced after each chunk, so an interrupted export resumes where it
+    stopped.
+    Returns the number of rows exported
+    """
+    if pa is None:
+        raise RuntimeError("exporting to parquet requires pyarrow")
+    os.makedirs(out_dir, exist_ok=True)
+    high_water_mark = read_high_water_mark(out_dir)
+    LOG.info("Exporting readings after id %s to %s", high_water_mark, out_dir)
+    tab = LocalData.__table__
+    n_exported = 0
+    while True:
+        query = select([tab]).where(tab.c.id > high_water_mark)\
+            .order_by(tab.c.id).limit(chunk_size)
+        with engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        if not rows:
+            break
+        first_id, last_id = rows[0]["id"], rows[-1]["id"]
+        pq.write_to_dataset(
+            rows_to_table(rows), out_dir, partition_cols=PARTITION_COLS,
+            basename_template=f"part-{first_id}-{last_id}-{{i}}.parquet",
+            compression=compression,
+        )
+        high_water_mark = last_id
+        write_high_water_mark(out_dir, high_water_mark)
+        n_exported += len(rows)
+    LOG.info("Exported %s readings, high-water mark now %s",
+             n_exported, high_water_mark)
+    return n_exported
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Export new readings to partitioned parquet files."
+    )
+    PARSER.add_argument("--out_dir", default=EXPORT_PATH,
+                        help="directory to write the parquet dataset to")
+    ARGS = PARSER.parse_args()
+    set_up_python_logging(log_filename="export.log", log_path=LOG_PATH)
+    print(export_parquet(ARGS.out_dir))
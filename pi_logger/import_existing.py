@@ -3,21 +3,73 @@ Load existing data stored in a csv file to the sqlite database
 """
 
 import os
+import time
 import socket
 import logging
 import pandas as pd
-from sqlalchemy import create_engine
-from local_db import LocalData
-from pi_logger import PINAME
+from sqlalchemy import text
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.local_db import (LocalData, create_db_engine,
+                                set_up_database, update_rollups)
 from pi_logger.local_loggers import getserial
 
 LOG = logging.getLogger(f"pi_logger_{PINAME}.import_existing")
 
+COLUMN_NAMES = {"relhum": "humidity", "airquality": "gasvoc",
+                "name": "location", "pi": "piname"}
+DATETIME_FORMAT = "%d/%m/%Y %H:%M:%S"
+# the format in which SQLAlchemy stores DateTime columns in SQLite
+DB_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def get_insert_statement(columns):
+    """
+    Return an INSERT statement for the given localdata columns that skips a
+    row if a reading with the same piname, location and datetime exists
+    """
+    names = ", ".join(columns)
+    params = ", ".join(f":{col}" for col in columns)
+    return text(f"""
+        INSERT INTO {LocalData.__tablename__} ({names})
+        SELECT {params}
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {LocalData.__tablename__}
+            WHERE location IS :location AND datetime = :datetime
+            AND piname IS :piname
+        )
+    """)
+
+
+def prepare_chunk(data, piid):
+    """
+    Rename the columns of a chunk of the legacy csv to match localdata and
+    convert its datetimes, returning a list of row dictionaries
+    """
+    data = data.rename(columns={k: k.lower() for k in data.columns})
+    data = data.rename(columns=COLUMN_NAMES)
+    data["datetime"] = pd.to_datetime(data["datetime"],
+                                      format=DATETIME_FORMAT)\
+        .dt.strftime(DB_DATETIME_FORMAT)
+    data['piid'] = piid
+    columns = [c.name for c in LocalData.__table__.columns
+               if c.name != "id"]
+    for col in columns:
+        if col not in data.columns:
+            data[col] = None
+    data = data[columns].astype(object).where(data[columns].notnull(), None)
+    return data.to_dict("records")
+
 
 def load_existing_data_to_db(existing_log=None,
-                             db_path=None):
+                             db_path=None,
+                             chunk_size=10000):
     """
-    Load existing data stored in a csv file to the sqlite database
+    Load existing data stored in a csv file to the sqlite database.
+    The csv is read chunk_size rows at a time and each chunk is inserted in
+    a single transaction. Rows already in the database (same piname,
+    location and datetime) are skipped, so the import can safely be re-run.
+    Returns a dictionary with the numbers of rows read and inserted and the
+    import rate in rows per second
     """
     pi_name = socket.gethostname()
     if existing_log is None:
@@ -30,21 +82,38 @@ def load_existing_data_to_db(existing_log=None,
             os.mkdir(log_path)
         db_path = os.path.join(log_path, "locallogs.db")
 
-    LOG.debug("reading existing log from %s", existing_log)
-    data = pd.read_csv(existing_log)
-    data = data.rename(columns={k: k.lower() for k in data.columns})
-    data = data.rename(columns={"relhum": "humidity", "airquality": "gasvoc",
-                                "name": "location", "pi": "piname"})
-    data["datetime"] = pd.to_datetime(data["datetime"],
-                                      format="%d/%m/%Y %H:%M:%S")
-    data['piid'] = getserial()
     conn_string = 'sqlite:///{}'.format(db_path)
     LOG.debug("connecting to %s", db_path)
-    engine = create_engine(conn_string, echo=True)
-    LOG.debug("saving records to %s", db_path)
-    data.to_sql(LocalData.__tablename__, engine, if_exists="append",
-                index=False)
+    engine = create_db_engine(conn_string)
+    set_up_database(os.path.dirname(db_path), engine)
+    piid = getserial()
+    statement = None
+    n_read = n_inserted = 0
+    start = time.monotonic()
+
+    LOG.debug("reading existing log from %s", existing_log)
+    for chunk in pd.read_csv(existing_log, chunksize=chunk_size):
+        rows = prepare_chunk(chunk, piid)
+        if statement is None:
+            statement = get_insert_statement(list(rows[0].keys()))
+        with engine.begin() as conn:
+            n_inserted += conn.execute(statement, rows).rowcount
+        n_read += len(rows)
+        LOG.debug("imported %s rows so far", n_read)
+    # summarise the imported readings, which the API's aggregates read
+    update_rollups(engine)
+
+    seconds = time.monotonic() - start
+    stats = dict(read=n_read, inserted=n_inserted,
+                 skipped=n_read - n_inserted,
+                 rows_per_second=n_read / seconds if seconds else 0.0)
+    LOG.info("imported %(inserted)s of %(read)s rows (%(skipped)s already "
+             "present) at %(rows_per_second).0f rows/s", stats)
+    engine.dispose()
+    return stats
 
 
 if __name__ == "__main__":
-    load_existing_data_to_db()
+    set_up_python_logging(log_filename="import_existing.log",
+                          log_path=LOG_PATH)
+    print(load_existing_data_to_db())
@@ -0,0 +1,170 @@
+"""
+Live updates of new readings for the API server.
+
+A single Broadcaster thread watches the local database for readings with a
+higher id than the last one it has seen, a primary key lookup run once per
+interval, and hands each new reading to every Subscription whose filters
+match. The database load is therefore the same for one subscriber as for
+hundreds. Each subscription buffers at most max_queue readings; when a slow
+consumer falls that far behind, its oldest readings are dropped and
+counted, so that it can fetch them again with /get_recent.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+from pi_logger import PINAME
+from pi_logger.local_db import ENGINE, get_data_version, get_readings_after_id
+from pi_logger.metrics import REGISTRY
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.live")
+
+SUBSCRIBERS = REGISTRY.gauge(
+    "pi_logger_live_subscribers", "Clients subscribed to live readings",
+)
+READINGS_DROPPED = REGISTRY.counter(
+    "pi_logger_live_readings_dropped_total",
+    "Live readings dropped because a subscriber fell behind",
+)
+
+
+class Subscription():
+    """
+    Bounded queue of new readings for one subscriber, optionally limited to
+    sets of locations and sensortypes. start_id is the id of the last
+    reading written before it was subscribed; later readings are queued
+    """
+    def __init__(self, locations=None, sensortypes=None, max_queue=100):
+        self.locations = set(locations) if locations else None
+        self.sensortypes = set(sensortypes) if sensortypes else None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.start_id = None
+
+    def matches(self, reading):
+        """
+        Return whether reading passes the subscription's filters
+        """
+        if self.locations is not None \
+                and reading["location"] not in self.locations:
+            return False
+        if self.sensortypes is not None \
+                and reading["sensortype"] not in self.sensortypes:
+            return False
+        return True
+
+    def put(self, reading):
+        """
+        Queue reading, dropping the oldest queued reading if the queue is
+        full, so that a slow consumer never holds up the others
+        """
+        while True:
+            try:
+                self.queue.put_nowait(reading)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                    READINGS_DROPPED.inc()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Return the next reading, or None if there is none within timeout
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broadcaster():
+    """
+    Watch the database for new readings on a background thread, which runs
+    only while there are subscribers, and fan them out to the subscriptions
+    """
+    def __init__(self, engine=ENGINE, interval=1.0, batch_size=1000):
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_id = 0
+        self.subscriptions = set()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, locations=None, sensortypes=None, max_queue=100,
+                  max_subscribers=None):
+        """
+        Return a new Subscription to readings written from now on, starting
+        the watcher thread if it is not running, or None if there are
+        already max_subscribers
+        """
+        subscription = Subscription(locations, sensortypes, max_queue)
+        with self.lock:
+            if max_subscribers is not None \
+                    and len(self.subscriptions) >= max_subscribers:
+                return None
+            self.subscriptions.add(subscription)
+            SUBSCRIBERS.set(len(self.subscriptions))
+            if self.thread is None:
+                self.last_id = get_data_version(engine=self.engine)[1] or 0
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name="live-readings")
+                self.thread.start()
+            subscription.start_id = self.last_id
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stop passing readings to subscription. The watcher thread stops
+        after its next check if there are no subscribers left
+        """
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            SUBSCRIBERS.set(len(self.subscriptions))
+
+    def check(self):
+        """
+        Pass any readings written since the last check to the matching
+        subscriptions
+        Returns the number of new readings
+        """
+        readings = get_readings_after_id(self.last_id, self.batch_size,
+                                         engine=self.engine)
+        if readings:
+            self.last_id = readings[-1]["id"]
+            with self.lock:
+                subscriptions = list(self.subscriptions)
+            for reading in readings:
+                for subscription in subscriptions:
+                    if subscription.matches(reading):
+                        subscription.put(reading)
+        return len(readings)
+
+    def run(self):
+        """
+        Check for new readings every interval seconds, or straight away
+        after a full batch, until there are no subscribers
+        """
+        LOG.info("watching for new readings")
+        new_readings = 0
+        while True:
+            with self.lock:
+                if not self.subscriptions:
+                    self.thread = None
+                    break
+            if new_readings < self.batch_size:
+                time.sleep(self.interval)
+            try:
+                new_readings = self.check()
+            except Exception:  # pylint: disable=W0703
+                LOG.exception("failed to check for new readings")
+                new_readings = 0
+        LOG.info("no subscribers left, stopped watching for new readings")
+
+
+BROADCASTER = Broadcaster()
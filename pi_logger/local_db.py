@@ -5,21 +5,98 @@ and handled using the SQLalchemy ORM.
 """
 
 import os
+import time
+import argparse
 import logging
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import (create_engine, Column, Integer, String, DateTime,
+                        Float, Index, Table, DDL, event, text, select, and_,
+                        or_, func)
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.inspection import inspect
 
-from pi_logger import PINAME, LOG_PATH
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.metrics import REGISTRY, timed
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.local_db")
 
 BASE = declarative_base()
 DB_PATH = os.path.join(LOG_PATH, "locallogs.db")
 CONN_STRING = 'sqlite:///{}'.format(DB_PATH)
-ENGINE = create_engine(CONN_STRING, echo=False)
 
-LOG = logging.getLogger(f"pi_logger_{PINAME}.local_db")
+# PRAGMA settings applied to every new SQLite connection
+STORAGE_PROFILES = {
+    # SQLite's own defaults: rollback journal, full fsync on every commit
+    "default": {},
+    # suitable for a logger and API sharing a database on an SD card: WAL
+    # lets readers run alongside a writer, NORMAL sync only fsyncs at
+    # checkpoints, and busy_timeout waits for locks instead of failing
+    "pi": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 10000,  # ms
+        "mmap_size": 64 * 1024 * 1024,  # bytes
+        "cache_size": -8000,  # negative values are KiB
+        "temp_store": "MEMORY",
+    },
+}
+STORAGE_PROFILE = os.getenv("STORAGE_PROFILE", default="pi")
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """
+    Apply a dictionary of PRAGMA name: value to a DBAPI SQLite connection
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def create_db_engine(conn_string=CONN_STRING, profile=STORAGE_PROFILE,
+                     pool_size=5, echo=False):
+    """
+    Create an engine for an SQLite database file, applying the PRAGMAs of
+    the named storage profile to each connection. Connections are kept in
+    a pool of pool_size, so that the PRAGMAs are only set once per
+    connection and concurrent readers (e.g. API request threads) each get
+    their own connection.
+    """
+    pragmas = STORAGE_PROFILES[profile]
+    busy_timeout = pragmas.get("busy_timeout", 5000)
+    engine = create_engine(
+        conn_string, echo=echo, poolclass=QueuePool,
+        pool_size=pool_size, max_overflow=2 * pool_size,
+        connect_args=dict(timeout=busy_timeout / 1000,
+                          check_same_thread=False),
+    )
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        # pylint: disable=W0612,W0613
+        apply_pragmas(dbapi_connection, pragmas)
+
+    LOG.debug("Created engine for %s with storage profile %s",
+              conn_string, profile)
+    return engine
+
+
+ENGINE = create_db_engine()
+
+DB_WRITE_SECONDS = REGISTRY.histogram(
+    "pi_logger_db_write_seconds",
+    "Time taken to write a batch of readings to the storage backend",
+)
+ROWS_WRITTEN = REGISTRY.counter(
+    "pi_logger_rows_written_total", "Readings written to the storage backend",
+)
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "pi_logger_db_query_seconds", "Time taken by each database query function",
+    ["query"],
+)
 
 
 class LocalData(BASE):
@@ -39,8 +116,14 @@ class LocalData(BASE):
         gasvoc (Float)
         mcdvalue (Integer)
         mcdvoltage (Float)
+        mcdstd (Float) # standard deviation of mcdvoltage in a burst
     """
     __tablename__ = 'localdata'
+    __table_args__ = (
+        Index('ix_localdata_datetime', 'datetime'),
+        Index('ix_localdata_location_datetime', 'location', 'datetime'),
+        Index('ix_localdata_piname_datetime', 'piname', 'datetime'),
+    )
 
     id = Column(Integer, primary_key=True)
     datetime = Column(DateTime)
@@ -54,6 +137,7 @@ class LocalData(BASE):
     gasvoc = Column(Float)
     mcdvalue = Column(Integer)
     mcdvoltage = Column(Float)
+    mcdstd = Column(Float)
 
     sqlite_autoincrement = True
 
@@ -78,10 +162,116 @@ class LocalData(BASE):
             gasvoc=self.gasvoc,
             mcdvalue=self.mcdvalue,
             mcdvoltage=self.mcdvoltage,
+            mcdstd=self.mcdstd,
         )
         return data
 
 
+class LatestReading(BASE):
+    """
+    Class for a table holding a copy of the most recent row of localdata for
+    each sensor location, so that the latest readings can be read without
+    searching the full history. Kept up to date by a trigger on localdata.
+    _______
+    columns:
+        as LocalData, with location as the primary key and id referring to
+        the id of the row in localdata
+    """
+    __tablename__ = 'latest_readings'
+
+    location = Column(String, primary_key=True)
+    id = Column(Integer)
+    datetime = Column(DateTime)
+    sensortype = Column(String)
+    piname = Column(String)
+    piid = Column(String)
+    temp = Column(Float)
+    humidity = Column(Float)
+    pressure = Column(Float)
+    gasvoc = Column(Float)
+    mcdvalue = Column(Integer)
+    mcdvoltage = Column(Float)
+    mcdstd = Column(Float)
+
+    def __repr__(self):
+        info = (self.piname, self.location, self.datetime)
+        return "<LatestReading(pi={}, sensor={}, datetime={})>".format(*info)
+
+    get_row = LocalData.get_row
+
+
+READING_COLUMNS = ("location, id, datetime, sensortype, piname, piid, temp, "
+                   "humidity, pressure, gasvoc, mcdvalue, mcdvoltage, mcdstd")
+
+LATEST_READING_TRIGGER = DDL(f"""
+CREATE TRIGGER IF NOT EXISTS localdata_latest_reading
+AFTER INSERT ON localdata
+WHEN NOT EXISTS (
+    SELECT 1 FROM latest_readings
+    WHERE location IS NEW.location AND datetime > NEW.datetime
+)
+BEGIN
+    INSERT OR REPLACE INTO latest_readings ({READING_COLUMNS})
+    VALUES ({", ".join("NEW." + c for c in READING_COLUMNS.split(", "))});
+END
+""")
+# created after all tables, since the trigger refers to both of them
+event.listen(BASE.metadata, "after_create", LATEST_READING_TRIGGER)
+
+# fields summarised in the rollup tables
+VALUE_FIELDS = ["temp", "humidity", "pressure", "gasvoc",
+                "mcdvalue", "mcdvoltage"]
+# rollup table name: (bucket size in seconds, strftime format of bucket)
+ROLLUPS = {
+    "rollup_minute": (60, "%Y-%m-%d %H:%M:00.000000"),
+    "rollup_hour": (3600, "%Y-%m-%d %H:00:00.000000"),
+    "rollup_day": (86400, "%Y-%m-%d 00:00:00.000000"),
+}
+
+
+def make_rollup_table(name):
+    """
+    Return a table holding readings summarised per location and time bucket.
+    For each field in VALUE_FIELDS there are _min, _max, _sum and _count
+    columns (so that rollups can be merged and means calculated) and a _last
+    column holding the value at last_datetime.
+    """
+    columns = [
+        Column("location", String, primary_key=True),
+        Column("bucket", DateTime, primary_key=True),
+        Column("sensortype", String),
+        Column("piname", String),
+        Column("piid", String),
+        Column("n", Integer),
+        Column("last_datetime", DateTime),
+    ]
+    for field in VALUE_FIELDS:
+        columns += [Column(f"{field}_min", Float),
+                    Column(f"{field}_max", Float),
+                    Column(f"{field}_sum", Float),
+                    Column(f"{field}_count", Integer),
+                    Column(f"{field}_last", Float)]
+    return Table(name, BASE.metadata, *columns,
+                 Index(f"ix_{name}_bucket", "bucket"))
+
+
+ROLLUP_TABLES = {name: make_rollup_table(name) for name in ROLLUPS}
+
+
+class RollupState(BASE):
+    """
+    Class for a table recording how far localdata has been rolled up
+    _______
+    columns:
+        name (String)
+        last_id (Integer) # id of the last localdata row rolled up
+    """
+    __tablename__ = 'rollup_state'
+
+    name = Column(String, primary_key=True)
+    last_id = Column(Integer)
+
+
 def set_up_database(path, engine):
     """
     Set up or connect to an SQLite database
@@ -92,41 +282,382 @@ def set_up_database(path, engine):
         os.mkdir(path)
     LOG.info("Attempting to create db")
     BASE.metadata.create_all(engine)
+    migrate_database(engine)
+
+
+def add_localdata_indexes(conn):
+    """
+    Migration 0 -> 1: add the datetime indexes on the localdata table to
+    databases created before they were part of the table definition
+    """
+    table = LocalData.__table__
+    existing = {ix['name'] for ix in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            LOG.info("Creating index %s", index.name)
+            index.create(bind=conn)
+    conn.execute(text("ANALYZE"))
+
+
+def add_latest_readings(conn):
+    """
+    Migration 1 -> 2: add the latest_readings table and the trigger that
+    maintains it, filling it from the existing rows of localdata
+    """
+    LatestReading.__table__.create(bind=conn, checkfirst=True)
+    conn.execute(LATEST_READING_TRIGGER)
+    # SQLite takes the bare columns from the row holding MAX(datetime)
+    conn.execute(text("""
+        INSERT OR REPLACE INTO latest_readings (location, id, datetime,
+            sensortype, piname, piid, temp, humidity, pressure, gasvoc,
+            mcdvalue, mcdvoltage)
+        SELECT location, id, MAX(datetime), sensortype, piname, piid, temp,
+               humidity, pressure, gasvoc, mcdvalue, mcdvoltage
+        FROM localdata GROUP BY location
+    """))
+
+
+def add_rollup_tables(conn):
+    """
+    Migration 2 -> 3: add the rollup tables. They are filled from the
+    existing rows of localdata by the next call to update_rollups
+    """
+    for table in list(ROLLUP_TABLES.values()) + [RollupState.__table__]:
+        table.create(bind=conn, checkfirst=True)
+
+
+def add_mcd_stddev(conn):
+    """
+    Migration 3 -> 4: add the mcdstd column for the spread of burst-sampled
+    MCP3008 readings, and recreate the latest_readings trigger to copy it
+    """
+    for table in (LocalData.__table__, LatestReading.__table__):
+        existing = {col['name'] for col in inspect(conn).get_columns(
+            table.name
+        )}
+        if "mcdstd" not in existing:
+            conn.execute(text(f"ALTER TABLE {table.name} "
+                              "ADD COLUMN mcdstd FLOAT"))
+    conn.execute(text("DROP TRIGGER IF EXISTS localdata_latest_reading"))
+    conn.execute(LATEST_READING_TRIGGER)
+
+
+# MIGRATIONS[n] upgrades a database from schema version n to n + 1
+MIGRATIONS = [
+    add_localdata_indexes,
+    add_latest_readings,
+    add_rollup_tables,
+    add_mcd_stddev,
+]
+# version number stored in the SQLite user_version pragma
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(engine):
+    """
+    Return the schema version recorded in the database
+    """
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def migrate_database(engine):
+    """
+    Bring an existing database up to SCHEMA_VERSION by running any
+    outstanding migrations, each in its own transaction
+    Returns the resulting schema version
+    """
+    if LocalData.__tablename__ not in inspect(engine).get_table_names():
+        LOG.info("No %s table to migrate", LocalData.__tablename__)
+        return get_schema_version(engine)
+    version = get_schema_version(engine)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version):
+        LOG.info("Migrating db from schema version %s to %s",
+                 number, number + 1)
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(text(f"PRAGMA user_version = {number + 1}"))
+    return max(version, SCHEMA_VERSION)
+
+
+class StorageBackend():
+    """
+    Interface for stores of sensor readings. Readings are dictionaries with
+    the columns of LocalData (except id)
+    """
+    def save_readings(self, readings):
+        """
+        Store a list of readings
+        """
+        raise NotImplementedError
+
+    def get_recent_readings(self, start_datetime_utc, end_datetime_utc=None):
+        """
+        Return a list of the readings after start_datetime_utc (and before
+        end_datetime_utc if given) in datetime order, or None
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release any resources held by the backend
+        """
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Store readings as rows of a table in the local SQL database
+    """
+    def __init__(self, engine=ENGINE, table=LocalData):
+        self.engine = engine
+        self.table = table
+
+    def save_readings(self, readings):
+        """
+        Insert readings with a single bulk INSERT in one transaction
+        """
+        with self.engine.begin() as conn:
+            conn.execute(self.table.__table__.insert(), readings)
+
+    def get_recent_readings(self, start_datetime_utc, end_datetime_utc=None):
+        """
+        Return a list of the readings after start_datetime_utc (and before
+        end_datetime_utc if given) in datetime order, or None
+        """
+        tab = self.table.__table__
+        query = select([tab]).where(tab.c.datetime > start_datetime_utc)
+        if end_datetime_utc is not None:
+            query = query.where(tab.c.datetime < end_datetime_utc)
+        query = query.order_by(tab.c.datetime, tab.c.id)
+        with self.engine.connect() as conn:
+            rows = [dict(row) for row in conn.execute(query)]
+        return rows or None
 
 
-def save_readings_to_db(data, engine):
+def save_readings_to_db(data, engine, backend=None):
     """
-    Save data from one of the sensors to the local database
+    Save data from one of the sensors to the local database, or to backend
+    if one is given
     """
-    if data is not None:
+    if data is not None and backend is not None:
+        with DB_WRITE_SECONDS.time():
+            backend.save_readings([data])
+        ROWS_WRITTEN.inc()
+    elif data is not None:
         LOG.debug("attempting to write data to db")
-        data = LocalData(**data)
-        session = sessionmaker(bind=engine)()
-        session.add(data)
-        session.flush()
-        session.commit()
+        with DB_WRITE_SECONDS.time():
+            data = LocalData(**data)
+            session = sessionmaker(bind=engine)()
+            session.add(data)
+            session.flush()
+            session.commit()
+        ROWS_WRITTEN.inc()
     else:
         LOG.debug("skipping writing of data. data is None")
 
 
+class ReadingWriter():
+    """
+    Buffer sensor readings in memory and write them to the local database
+    in batches, using a single bulk INSERT inside one transaction per flush.
+    The buffer is flushed when it holds max_rows readings, when the oldest
+    buffered reading is older than max_age seconds, and on close.
+    Can be used as a context manager to guarantee a flush on exit.
+    Safe to share between polling threads.
+    backend: StorageBackend to write to, instead of table in engine
+    """
+    # pylint: disable=R0913
+    def __init__(self, engine, max_rows=100, max_age=60, table=LocalData,
+                 backend=None):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.table = table
+        if backend is None:
+            backend = SQLiteBackend(engine, table)
+        self.backend = backend
+        self.buffer = []
+        self.oldest = None
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def add(self, data):
+        """
+        Add a dictionary of readings to the buffer, flushing if a size or age
+        threshold has been reached. None is ignored, as in save_readings_to_db
+        """
+        if data is None:
+            LOG.debug("skipping buffering of data. data is None")
+            return
+        with self.lock:
+            if not self.buffer:
+                self.oldest = time.monotonic()
+            self.buffer.append(data)
+            self.flush_if_due()
+
+    def is_due(self, lookahead=0):
+        """
+        Return True if the buffer should be flushed now, or would become due
+        within lookahead seconds
+        """
+        if not self.buffer:
+            return False
+        if len(self.buffer) >= self.max_rows:
+            return True
+        age = time.monotonic() - self.oldest
+        return age + lookahead >= self.max_age
+
+    def flush_if_due(self, lookahead=0):
+        """
+        Flush the buffer if a size or age threshold has been reached
+        Returns the number of rows written
+        """
+        with self.lock:
+            if self.is_due(lookahead):
+                return self.flush()
+        return 0
+
+    def flush(self):
+        """
+        Write all buffered readings to the database in a single transaction
+        Returns the number of rows written
+        """
+        with self.lock:
+            if not self.buffer:
+                return 0
+            columns = [c.name for c in self.table.__table__.columns]
+            rows = [{col: row.get(col) for col in columns if col != "id"}
+                    for row in self.buffer]
+            LOG.debug("writing %s buffered readings to db", len(rows))
+            with DB_WRITE_SECONDS.time():
+                self.backend.save_readings(rows)
+            ROWS_WRITTEN.inc(len(rows))
+            self.buffer = []
+            self.oldest = None
+        return len(rows)
+
+    def close(self):
+        """
+        Flush any remaining readings
+        """
+        return self.flush()
+
+
+# default widths of the deadband of each field, about the resolution of the
+# sensors: DHT22 and BME680 temperature and humidity, BME680 pressure (hPa)
+# and gas resistance (Ohms), and MCP3008 raw value and voltage
+DEFAULT_DEADBANDS = {
+    "temp": 0.1,
+    "humidity": 0.5,
+    "pressure": 0.1,
+    "gasvoc": 500,
+    "mcdvalue": 64,
+    "mcdvoltage": 0.005,
+}
+
+
+class DeadbandFilter():
+    """
+    Pass readings on to a ReadingWriter only if they differ from the last
+    reading passed on for the same location, so that a sensor whose readings
+    are steady stores few rows.
+    A reading is dropped when every field in VALUE_FIELDS is within the
+    field's deadband (default 0, i.e. unchanged) of the last stored reading,
+    unless that reading is at least heartbeat seconds older, so that a
+    steady sensor still records a row every heartbeat seconds.
+    Other attributes (flush, close...) are those of the writer.
+    """
+    def __init__(self, writer, deadbands=None, heartbeat=900):
+        self.writer = writer
+        self.deadbands = DEFAULT_DEADBANDS if deadbands is None \
+            else deadbands
+        self.heartbeat = heartbeat
+        self.last_stored = {}
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.writer.close()
+
+    def __len__(self):
+        return len(self.writer)
+
+    def is_within_deadband(self, data, last):
+        """
+        Return True if every field of data is within its deadband of last
+        """
+        for field in VALUE_FIELDS:
+            value, last_value = data.get(field), last.get(field)
+            if value is None or last_value is None:
+                if value is not last_value:
+                    return False
+            elif abs(value - last_value) > self.deadbands.get(field, 0):
+                return False
+        return True
+
+    def add(self, data):
+        """
+        Pass data on to the writer unless it is within the deadband of the
+        last stored reading for its location and the heartbeat is not due
+        Returns True if the reading was passed on
+        """
+        if data is None:
+            return False
+        with self.lock:
+            last = self.last_stored.get(data.get("location"))
+            if last is not None and self.is_within_deadband(data, last) \
+                    and (data["datetime"] - last["datetime"]).total_seconds() \
+                    < self.heartbeat:
+                self.dropped += 1
+                return False
+        return self.add_unfiltered(data)
+
+    def add_unfiltered(self, data):
+        """
+        Pass data on to the writer whatever the deadband, as for an
+        on-demand poll whose fresh readings must be stored, and compare
+        later readings for its location with it
+        Returns True if the reading was passed on
+        """
+        if data is None:
+            return False
+        with self.lock:
+            self.last_stored[data.get("location")] = dict(data)
+        self.writer.add(data)
+        return True
+
+
 def one_or_more_results(query):
     """
     Return True if query contains one or more results, otherwise False
     """
-    try:
-        query.one()
-    except NoResultFound:
-        return False
-    except MultipleResultsFound:
-        pass
-    return True
+    return query.first() is not None
 
 
-def get_recent_readings(start_datetime_utc, table=LocalData, engine=ENGINE):
+@timed(DB_QUERY_SECONDS, query="get_recent_readings")
+def get_recent_readings(start_datetime_utc, table=LocalData, engine=ENGINE,
+                        backend=None):
     """
-    Get all readings since startdate from the local DB
+    Get all readings since startdate from the local DB, or from backend if
+    one is given
     returns an iterator containing the results or None
     """
+    if backend is not None:
+        return backend.get_recent_readings(start_datetime_utc)
     session = sessionmaker(bind=engine)()
     LOG.debug("Querying db for data since %s", start_datetime_utc)
     query = session.query(table)\
@@ -140,21 +671,295 @@ def get_recent_readings(start_datetime_utc, table=LocalData, engine=ENGINE):
     return result
 
 
-def get_last_reading(table=LocalData, engine=ENGINE):
+def iter_readings(start_datetime_utc, after_id=None, limit=None,
+                  table=LocalData, engine=ENGINE, chunk_size=1000):
+    """
+    Iterate over readings after start_datetime_utc in (datetime, id) order,
+    fetching chunk_size rows at a time so that memory use does not depend on
+    the number of results.
+    For keyset pagination, pass the datetime and id of the last row of the
+    previous page as start_datetime_utc and after_id; rows at exactly that
+    datetime with a greater id are then included.
+    yields a dictionary of column values (including id) for each row
+    """
+    tab = table.__table__
+    if after_id is None:
+        condition = tab.c.datetime > start_datetime_utc
+    else:
+        condition = or_(tab.c.datetime > start_datetime_utc,
+                        and_(tab.c.datetime == start_datetime_utc,
+                             tab.c.id > after_id))
+    query = select([tab]).where(condition)\
+        .order_by(tab.c.datetime, tab.c.id).limit(limit)
+    LOG.debug("Streaming readings since %s (after id %s, limit %s)",
+              start_datetime_utc, after_id, limit)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            result.close()
+
+
+@timed(DB_QUERY_SECONDS, query="get_readings_after_id")
+def get_readings_after_id(last_id, limit=1000, locations=None,
+                          sensortypes=None, table=LocalData, engine=ENGINE):
+    """
+    Get up to limit readings with an id greater than last_id, in id order,
+    i.e. the readings written since the one with that id, optionally only
+    those at one of locations and of one of sensortypes. The primary key
+    index makes this cheap enough to run every second, even when there are
+    no new readings.
+    returns a list of dictionaries of column values (including id)
+    """
+    tab = table.__table__
+    query = select([tab])\
+        .where(readings_after_id(tab, last_id, None, locations, sensortypes))\
+        .order_by(tab.c.id).limit(limit)
+    with engine.connect() as conn:
+        return [dict(row) for row in conn.execute(query)]
+
+
+@timed(DB_QUERY_SECONDS, query="count_readings_after_id")
+def count_readings_after_id(last_id, until_id=None, locations=None,
+                            sensortypes=None, table=LocalData,
+                            engine=ENGINE):
+    """
+    Count the readings with last_id < id <= until_id (or all those after
+    last_id), optionally only those at one of locations and of one of
+    sensortypes
+    """
+    tab = table.__table__
+    query = select([func.count()]).where(
+        readings_after_id(tab, last_id, until_id, locations, sensortypes)
+    )
+    with engine.connect() as conn:
+        return conn.execute(query).scalar()
+
+
+def readings_after_id(tab, last_id, until_id=None, locations=None,
+                      sensortypes=None):
+    """
+    Return the condition selecting the rows of tab with last_id < id <=
+    until_id, at one of locations and of one of sensortypes, where given
+    """
+    conditions = [tab.c.id > last_id]
+    if until_id is not None:
+        conditions.append(tab.c.id <= until_id)
+    if locations:
+        conditions.append(tab.c.location.in_(locations))
+    if sensortypes:
+        conditions.append(tab.c.sensortype.in_(sensortypes))
+    return and_(*conditions)
+
+
+@timed(DB_QUERY_SECONDS, query="get_last_reading")
+def get_last_reading(table=LatestReading, engine=ENGINE):
     """
     Get most recent reading from the local DB
     returns a dictionary containing the results or None
     """
     session = sessionmaker(bind=engine)()
     LOG.debug("Querying for last reading")
-    query = session.query(table).order_by(table.datetime.desc())
-    if one_or_more_results(query):
-        result = query.first().get_row()
+    result = session.query(table).order_by(table.datetime.desc()).first()
+    if result is not None:
+        result = result.get_row()
     else:
         LOG.debug("No results from query (last)")
+    session.close()
+    return result
+
+
+@timed(DB_QUERY_SECONDS, query="get_data_version")
+def get_data_version(table=LocalData, engine=ENGINE):
+    """
+    Return the first id, last id and last datetime of the readings in table,
+    which change whenever readings are added or pruned, and the id of the
+    last reading rolled up, which changes whenever the rollup tables are
+    updated. Each is read from an index rather than by scanning a table.
+    returns a tuple, of Nones if the table is empty or nothing has been
+    rolled up
+    """
+    tab = table.__table__
+    state = RollupState.__table__
+    query = select([select([func.min(tab.c.id)]).as_scalar(),
+                    select([func.max(tab.c.id)]).as_scalar(),
+                    select([func.max(tab.c.datetime)]).as_scalar(),
+                    select([state.c.last_id])
+                    .where(state.c.name == "localdata").as_scalar()])
+    with engine.connect() as conn:
+        return tuple(conn.execute(query).first())
+
+
+@timed(DB_QUERY_SECONDS, query="get_last_readings")
+def get_last_readings(table=LatestReading, engine=ENGINE):
+    """
+    Get the most recent reading from every sensor location in the local DB
+    returns a list of dictionaries containing the results or None
+    """
+    session = sessionmaker(bind=engine)()
+    LOG.debug("Querying for last reading of each location")
+    result = [row.get_row() for row in
+              session.query(table).order_by(table.location)]
+    session.close()
+    if not result:
+        LOG.debug("No results from query (last per location)")
         result = None
     return result
 
 
+def get_rollup_upsert(name):
+    """
+    Return an SQL statement that summarises the localdata rows with
+    :first_id <= id <= :last_id into the named rollup table, merging with
+    any existing summaries of the same location and bucket
+    """
+    fmt = ROLLUPS[name][1]
+    selected, merged = [], []
+    for field in VALUE_FIELDS:
+        selected += [
+            f"MIN({field})", f"MAX({field})", f"TOTAL({field})",
+            f"COUNT({field})", f"MAX(CASE WHEN rn = 1 THEN {field} END)",
+        ]
+        merged += [
+            f"{field}_min = MIN(COALESCE({field}_min, excluded.{field}_min),"
+            f" COALESCE(excluded.{field}_min, {field}_min))",
+            f"{field}_max = MAX(COALESCE({field}_max, excluded.{field}_max),"
+            f" COALESCE(excluded.{field}_max, {field}_max))",
+            f"{field}_sum = {field}_sum + excluded.{field}_sum",
+            f"{field}_count = {field}_count + excluded.{field}_count",
+            f"{field}_last = CASE WHEN excluded.last_datetime >= "
+            f"last_datetime THEN excluded.{field}_last ELSE {field}_last END",
+        ]
+    columns = [c.name for c in ROLLUP_TABLES[name].columns]
+    newline = ",\n"
+    return text(f"""
+        WITH new AS (
+            SELECT *, strftime('{fmt}', datetime) AS bucket,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY location, strftime('{fmt}', datetime)
+                       ORDER BY datetime DESC, id DESC
+                   ) AS rn
+            FROM localdata WHERE id BETWEEN :first_id AND :last_id
+        )
+        INSERT INTO {name} ({", ".join(columns)})
+        SELECT location, bucket,
+               MAX(CASE WHEN rn = 1 THEN sensortype END),
+               MAX(CASE WHEN rn = 1 THEN piname END),
+               MAX(CASE WHEN rn = 1 THEN piid END),
+               COUNT(*), MAX(datetime),
+               {newline.join(selected)}
+        FROM new WHERE true GROUP BY location, bucket
+        ON CONFLICT (location, bucket) DO UPDATE SET
+            sensortype = excluded.sensortype,
+            piname = excluded.piname,
+            piid = excluded.piid,
+            n = n + excluded.n,
+            {newline.join(merged)},
+            last_datetime = MAX(last_datetime, excluded.last_datetime)
+    """)
+
+
+@timed(DB_QUERY_SECONDS, query="update_rollups")
+def update_rollups(engine=ENGINE, chunk_size=50000, max_chunks=None):
+    """
+    Add localdata rows written since the last call to the rollup tables,
+    chunk_size rows per transaction. Only new rows are read, and merged
+    into the existing summaries, so the cost depends on the number of new
+    rows rather than the size of the table. With max_chunks, stops after
+    that many transactions, leaving any further rows to the next call.
+    Returns the number of rows rolled up
+    """
+    state = RollupState.__table__
+    n_rolled_up = 0
+    n_chunks = 0
+    while max_chunks is None or n_chunks < max_chunks:
+        with engine.begin() as conn:
+            # a write first, so that concurrent callers are serialised
+            # before the high-water mark is read
+            conn.execute(state.insert().prefix_with("OR IGNORE"),
+                         dict(name="localdata", last_id=0))
+            first_id = conn.execute(
+                select([state.c.last_id]).where(state.c.name == "localdata")
+            ).scalar() + 1
+            last_id = conn.execute(text(
+                "SELECT MAX(id) FROM (SELECT id FROM localdata WHERE id >= "
+                ":first_id ORDER BY id LIMIT :chunk_size)"
+            ), dict(first_id=first_id, chunk_size=chunk_size)).scalar()
+            if last_id is None:
+                break
+            for name in ROLLUPS:
+                conn.execute(get_rollup_upsert(name),
+                             dict(first_id=first_id, last_id=last_id))
+            conn.execute(state.update().where(state.c.name == "localdata"),
+                         dict(last_id=last_id))
+        n_rolled_up += last_id - first_id + 1
+        n_chunks += 1
+    if n_rolled_up:
+        LOG.debug("Rolled up localdata rows to id %s", last_id)
+    return n_rolled_up
+
+
+def prune_old_readings(keep_days, keep_minute_days=None, engine=ENGINE,
+                       now=None):
+    """
+    Delete raw readings older than keep_days that have been rolled up, and
+    minute rollups older than keep_minute_days (if given). Hourly and daily
+    rollups are kept indefinitely. Space freed by the deletions is reused
+    by SQLite, so the database stops growing.
+    Returns the number of raw readings deleted
+    """
+    if now is None:
+        now = datetime.utcnow()
+    tab = LocalData.__table__
+    state = RollupState.__table__
+    with engine.begin() as conn:
+        rolled_up_to = conn.execute(
+            select([state.c.last_id]).where(state.c.name == "localdata")
+        ).scalar() or 0
+        deleted = conn.execute(tab.delete().where(and_(
+            tab.c.datetime < now - timedelta(days=keep_days),
+            tab.c.id <= rolled_up_to,
+        ))).rowcount
+        if keep_minute_days is not None:
+            minute = ROLLUP_TABLES["rollup_minute"]
+            conn.execute(minute.delete().where(
+                minute.c.bucket < now - timedelta(days=keep_minute_days)
+            ))
+    if deleted:
+        LOG.info("Deleted %s readings older than %s days", deleted, keep_days)
+    return deleted
+
+
+def apply_retention(keep_days=None, keep_minute_days=None, engine=ENGINE,
+                    max_chunks=None):
+    """
+    Bring the rollup tables up to date, or roll up at most max_chunks
+    chunks of new readings, and, if keep_days is given, delete raw readings
+    older than that
+    """
+    update_rollups(engine, max_chunks=max_chunks)
+    if keep_days is not None:
+        prune_old_readings(keep_days, keep_minute_days, engine)
+
+
 if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Set up the local database, or migrate an existing one, "
+                    "and bring its rollup tables up to date"
+    )
+    PARSER.add_argument('--keep_days', type=float, default=None,
+                        help='delete raw readings older than this many days '
+                        'once summarised in the rollup tables')
+    PARSER.add_argument('--keep_minute_days', type=float, default=None,
+                        help='delete per-minute rollups older than this '
+                        'many days')
+    ARGS = PARSER.parse_args()
+    set_up_python_logging(log_filename="local_db.log", log_path=LOG_PATH)
     set_up_database(LOG_PATH, ENGINE)
+    apply_retention(ARGS.keep_days, ARGS.keep_minute_days, ENGINE)
@@ -1,28 +1,77 @@
 """
 Log ambient atmospheric conditions at a specified frequency
+
+The hardware drivers and numpy are imported when first needed, so that only
+the drivers of the sensor types configured on a pi are loaded and the module
+imports quickly (e.g. for the API server). The config file is compiled once
+into a SensorPlan of plain tuples, so the logger does not need pandas.
 """
 
 import os
+import sys
+import csv
+import math
 import time
+import signal
 import logging
+import warnings
+import importlib
+import threading
 from datetime import datetime
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import SQLAlchemyError
 
-import pandas as pd
-import Adafruit_DHT
-import bme680
-import busio
-import digitalio
-import board
-import adafruit_mcp3xxx.mcp3008 as MCP
-from adafruit_mcp3xxx.analog_in import AnalogIn
-
-from pi_logger import PINAME, LOG_PATH
-from pi_logger.local_db import ENGINE, save_readings_to_db, set_up_database
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.local_db import (ENGINE, ReadingWriter, DeadbandFilter,
+                                DEFAULT_DEADBANDS, set_up_database,
+                                migrate_database, apply_retention)
 from pi_logger.cli import get_local_logger_arguments
+from pi_logger.metrics import REGISTRY
+from pi_logger.sensor_daemon import ControlServer, CollectingWriter
 
 
 LOG = logging.getLogger(f"pi_logger_{PINAME}.local_loggers")
 
+SENSOR_READ_SECONDS = REGISTRY.histogram(
+    "pi_logger_sensor_read_seconds",
+    "Time taken to read a sensor (location is burst for MCP3008 bursts)",
+    ["sensortype", "location"],
+)
+SENSOR_READS = REGISTRY.counter(
+    "pi_logger_sensor_reads_total", "Sensor reads by result (ok or failed)",
+    ["sensortype", "location", "result"],
+)
+POLL_TASK_SECONDS = REGISTRY.histogram(
+    "pi_logger_poll_task_seconds",
+    "Time taken by each polling task, one per DHT22 pin or sensor bus",
+    ["task"],
+)
+POLL_TASK_ERRORS = REGISTRY.counter(
+    "pi_logger_poll_task_errors_total", "Polling tasks that raised an error",
+    ["task"],
+)
+POLL_CYCLE_SECONDS = REGISTRY.histogram(
+    "pi_logger_poll_cycle_seconds", "Time taken to poll all sensors once",
+)
+CYCLE_OVERRUNS = REGISTRY.counter(
+    "pi_logger_cycle_overruns_total",
+    "Scheduled cycles that took longer than the polling period",
+)
+CYCLES_SKIPPED = REGISTRY.counter(
+    "pi_logger_cycles_skipped_total",
+    "Scheduled cycles skipped because an earlier cycle overran",
+)
+
+
+def import_driver(name):
+    """
+    Import and return a hardware driver module on first use
+    """
+    return importlib.import_module(name)
+
 
 def getserial():
     """
@@ -45,34 +94,61 @@ def getserial():
     return cpuserial
 
 
+# one configured sensor; the interval bounds and threshold are None where
+# they are not set in the config file
+SensorConfig = namedtuple("SensorConfig", ["location", "sensortype", "pin",
+                                           "min_interval", "max_interval",
+                                           "threshold"])
+# the sensors of a pi grouped by bus, as tuples of SensorConfig
+SensorPlan = namedtuple("SensorPlan", ["dht22", "bme680", "mcp3008"])
+
+
+def parse_setting(value, convert=float):
+    """
+    Convert a value from the config file, returning None if it is empty
+    """
+    if value is None or not value.strip():
+        return None
+    return convert(value)
+
+
+def compile_sensor_plan(rows, pi_name):
+    """
+    Compile the rows of the logger config (dictionaries of column: string
+    value) into the SensorPlan of the sensors attached to pi_name
+    """
+    groups = {sensortype: [] for sensortype in SensorPlan._fields}
+    for row in rows:
+        if row["name"] != pi_name or row["type"] not in groups:
+            continue
+        groups[row["type"]].append(SensorConfig(
+            location=row["location"],
+            sensortype=row["type"],
+            pin=parse_setting(row["pin"], int),
+            min_interval=parse_setting(row.get("min_interval")),
+            max_interval=parse_setting(row.get("max_interval")),
+            threshold=parse_setting(row.get("threshold")),
+        ))
+    return SensorPlan(**{sensortype: tuple(sensors)
+                         for sensortype, sensors in groups.items()})
+
+
 def read_config(pi_name, path=LOG_PATH, filename='logger_config.csv'):
     """
     Read local config file from path to determine which loggers should be set
     up
-    Return dictionary of logger_type: list_of_loggers
+    Return a SensorPlan of the sensors attached to pi_name
     """
     LOG.info("reading local logger config")
     file_path = os.path.join(path, filename)
-    config = pd.read_csv(file_path, index_col=1)
-    config = config[config['name'] == pi_name]
-    dht_sensors = config[config['type'] == 'dht22']
-    bme_sensors = config[config['type'] == 'bme680']
-    mcp_sensors = config[config['type'] == 'mcp3008']
-    sensors = {
-        "dht22": dht_sensors,
-        "bme680": bme_sensors,
-        "mcp3008": mcp_sensors
-    }
-
-    messages = [
-        'dht22_loggers: {}'.format(', '.join(dht_sensors.index.tolist())),
-        'bme680_loggers: {}'.format(', '.join(bme_sensors.index.tolist())),
-        'mcp3008_loggers: {}'.format(', '.join(mcp_sensors.index.tolist())),
-    ]
-    for msg in messages:
-        LOG.info(msg)
-
-    return sensors
+    with open(file_path, "r", newline="") as file:
+        plan = compile_sensor_plan(csv.DictReader(file), pi_name)
+
+    for sensortype, sensors in plan._asdict().items():
+        LOG.info('%s_loggers: %s', sensortype,
+                 ', '.join(sensor.location for sensor in sensors))
+
+    return plan
 
 
 def set_up_dht22_sensors():
@@ -80,7 +156,7 @@ def set_up_dht22_sensors():
     Return an instance of the DHT22 sensor class
     """
     LOG.info("setting up dht22 sensor")
-    return Adafruit_DHT.DHT22
+    return import_driver("Adafruit_DHT").DHT22
 
 
 def set_up_bme680_sensors():
@@ -88,6 +164,7 @@ def set_up_bme680_sensors():
     Return an instance of the BME680 sensor class
     """
     LOG.info("setting up bme680 sensor")
+    bme680 = import_driver("bme680")
     try:
         sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
     except IOError:
@@ -108,19 +185,158 @@ def set_up_mcp_convertor():
     Return an instance of the MCP analog-to-digital converter for reading
     the soil moisture probe
     """
-    spi_bus = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
-    chip_select = digitalio.DigitalInOut(board.D5)
-    return MCP.MCP3008(spi_bus, chip_select)
+    board = import_driver("board")
+    spi_bus = import_driver("busio").SPI(clock=board.SCK, MISO=board.MISO,
+                                         MOSI=board.MOSI)
+    chip_select = import_driver("digitalio").DigitalInOut(board.D5)
+    mcp = import_driver("adafruit_mcp3xxx.mcp3008")
+    return mcp.MCP3008(spi_bus, chip_select)
+
+
+class CircuitBreaker():
+    """
+    Track the failures of one sensor so that a persistently failing sensor
+    is skipped for a while instead of being retried every cycle.
+    After failure_threshold consecutive failures the circuit opens and
+    allow() returns False for reset_timeout seconds. One trial read is then
+    allowed: success closes the circuit, failure opens it again.
+    """
+    def __init__(self, failure_threshold=3, reset_timeout=300,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        """
+        "closed" (reading normally), "open" (skipping) or "half-open"
+        (allowing a trial read)
+        """
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """
+        Return True if the sensor should be read
+        """
+        return self.state != "open"
+
+    def record_success(self):
+        """
+        Close the circuit after a successful read
+        """
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        """
+        Count a failed read, opening the circuit at the threshold
+        Returns True if the circuit has just opened
+        """
+        self.failures += 1
+        if self.state == "half-open" or (
+                self.opened_at is None
+                and self.failures >= self.failure_threshold):
+            self.opened_at = self.clock()
+            return True
+        return False
+
+
+class DHTReader():
+    """
+    Read DHT22 sensors with a bounded number of attempts, instead of
+    Adafruit_DHT.read_retry, which may block for around 30 s on a failing
+    sensor.
+    Each read makes up to retries + 1 attempts, waiting delay seconds before
+    the first retry and multiplying the wait by backoff for each further
+    one, but never starts an attempt after deadline seconds. A CircuitBreaker
+    per pin skips pins that keep failing (see failure_threshold and
+    reset_timeout). read defaults to Adafruit_DHT.read, imported on the
+    first read.
+    """
+    # pylint: disable=R0913
+    def __init__(self, retries=2, delay=2.0, backoff=1.5, deadline=8.0,
+                 failure_threshold=3, reset_timeout=300,
+                 read=None, clock=time.monotonic, sleep=time.sleep):
+        self.retries = retries
+        self.delay = delay
+        self.backoff = backoff
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.read_once = read
+        self.clock = clock
+        self.sleep = sleep
+        self.breakers = {}
+
+    def breaker(self, pin):
+        """
+        Return the CircuitBreaker for pin
+        """
+        if pin not in self.breakers:
+            self.breakers[pin] = CircuitBreaker(self.failure_threshold,
+                                                self.reset_timeout,
+                                                self.clock)
+        return self.breakers[pin]
 
+    def read(self, sensor, pin):
+        """
+        Read a DHT22 sensor on pin
+        Returns (humidity, temperature), or (None, None) if every attempt
+        failed or the pin's circuit is open
+        """
+        breaker = self.breaker(pin)
+        if not breaker.allow():
+            LOG.debug('skipping DHT22 sensor at pin %s after %s failures',
+                      pin, breaker.failures)
+            return None, None
+        if self.read_once is None:
+            self.read_once = import_driver("Adafruit_DHT").read
+        give_up = self.clock() + self.deadline
+        wait = self.delay
+        for attempt in range(self.retries + 1):
+            humidity, temperature = self.read_once(sensor, pin)
+            if humidity is not None or temperature is not None:
+                breaker.record_success()
+                return humidity, temperature
+            if attempt == self.retries or self.clock() + wait > give_up:
+                break
+            self.sleep(wait)
+            wait *= self.backoff
+        if breaker.record_failure():
+            LOG.warning('DHT22 sensor at pin %s failed %s times in a row; '
+                        'skipping it for %s s', pin, breaker.failures,
+                        self.reset_timeout)
+        return None, None
 
-def poll_dht22(sensor, pin):
+    def status(self):
+        """
+        Return a dictionary of pin: state and consecutive failures for every
+        pin read so far
+        """
+        return {pin: dict(state=breaker.state, failures=breaker.failures)
+                for pin, breaker in self.breakers.items()}
+
+
+def poll_dht22(sensor, pin, time_now=None, reader=None):
     """
     Get a reading from a DHT22 sensor and return data as a dictionary
+    time_now defaults to the current UTC time
+    reader: the DHTReader to read the sensor with (default a new one)
     """
-    time_now = datetime.utcnow()
+    if time_now is None:
+        time_now = datetime.utcnow()
+    if reader is None:
+        reader = DHTReader()
     LOG.info('%s polling DHT22 sensor on pin %s',
              time_now.strftime("%Y-%m-%d %H:%M:%S"), pin)
-    humidity, temperature = Adafruit_DHT.read_retry(sensor, pin)
+    humidity, temperature = reader.read(sensor, pin)
     if humidity is None and temperature is None:
         LOG.info('%s failed to retrieve data from DHT22 sensor at pin %s',
                  time_now.strftime("%Y-%m-%d %H:%M:%S"), pin)
@@ -135,11 +351,13 @@ def poll_dht22(sensor, pin):
     return data
 
 
-def poll_bme680(sensor, pin):
+def poll_bme680(sensor, pin, time_now=None):
     """
     Get a reading from a BME680 sensor and return data as a dictionary
+    time_now defaults to the current UTC time
     """
-    time_now = datetime.utcnow()
+    if time_now is None:
+        time_now = datetime.utcnow()
     LOG.info('%s polling BME680 sensor on pin %s',
              time_now.strftime("%Y-%m-%d %H:%M:%S"), pin)
     if sensor.get_sensor_data():
@@ -159,15 +377,102 @@ def poll_bme680(sensor, pin):
     return data
 
 
-def poll_mcp3008(mcp_chip, pin):
+@lru_cache(maxsize=None)
+def get_mcp_channel(mcp_chip, pin):
+    """
+    Return the AnalogIn channel for pin of mcp_chip, created on first use and
+    reused afterwards
+    """
+    analog_in = import_driver("adafruit_mcp3xxx.analog_in")
+    mcp = import_driver("adafruit_mcp3xxx.mcp3008")
+    return analog_in.AnalogIn(mcp_chip, getattr(mcp, f"P{pin}"))
+
+
+def read_mcp_bursts(mcp_chip, pins, n_samples):
+    """
+    Read the raw values of the given pins of mcp_chip n_samples times, taking
+    one value from each pin in turn so that all pins are sampled over the
+    same period
+    Returns an array of shape (len(pins), n_samples), with NaN for failed
+    reads
+    """
+    import numpy as np  # pylint: disable=C0415
+    channels = [get_mcp_channel(mcp_chip, pin) for pin in pins]
+    samples = np.empty((len(channels), n_samples))
+    for i in range(n_samples):
+        for j, chan in enumerate(channels):
+            value = chan.value
+            samples[j, i] = np.nan if value is None else value
+    return samples
+
+
+def summarise_bursts(samples, reference_voltage, reduce="median"):
+    """
+    Reduce each row of an array of raw MCP3008 samples (as returned by
+    read_mcp_bursts) to a central value, using the mean or median, and the
+    standard deviation of the voltage
+    Returns a dictionary of arrays of the mcdvalue, mcdvoltage and mcdstd
+    of each row, which are NaN where every sample failed
+    """
+    import numpy as np  # pylint: disable=C0415
+    with warnings.catch_warnings():
+        # rows of NaN are expected when a sensor is disconnected
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if reduce == "mean":
+            values = np.nanmean(samples, axis=1)
+        else:
+            values = np.nanmedian(samples, axis=1)
+        spread = np.nanstd(samples, axis=1)
+    scale = reference_voltage / 65535
+    return dict(mcdvalue=values, mcdvoltage=values * scale,
+                mcdstd=spread * scale)
+
+
+def burst_readings(summary, time_now):
+    """
+    Convert the arrays returned by summarise_bursts to a list of reading
+    dictionaries, with None for rows where every sample failed
+    """
+    readings = []
+    for value, voltage, spread in zip(summary["mcdvalue"],
+                                      summary["mcdvoltage"],
+                                      summary["mcdstd"]):
+        if math.isnan(value):
+            readings.append(None)
+        else:
+            readings.append(dict(
+                datetime=time_now,
+                sensortype="MCP",
+                mcdvalue=int(round(value)),
+                mcdvoltage=float(voltage),
+                mcdstd=float(spread),
+            ))
+    return readings
+
+
+def poll_mcp3008(mcp_chip, pin, time_now=None, n_samples=1,
+                 reduce="median"):
     """
     Get a reading from a sensor connected to an MCP analog-to-digital converter
     and return data as a dictionary
+    time_now defaults to the current UTC time
+    With n_samples > 1, the pin is read n_samples times in a burst, reduced
+    to the mean or median (reduce) and standard deviation
     """
-    time_now = datetime.utcnow()
+    if time_now is None:
+        time_now = datetime.utcnow()
     LOG.info('%s polling MCP chip on pin %s',
              time_now.strftime("%Y-%m-%d %H:%M:%S"), pin)
-    chan = AnalogIn(mcp_chip, getattr(MCP, f"P{pin}"))
+    if n_samples > 1:
+        samples = read_mcp_bursts(mcp_chip, [pin], n_samples)
+        summary = summarise_bursts(samples, mcp_chip.reference_voltage,
+                                   reduce)
+        data = burst_readings(summary, time_now)[0]
+        if data is None:
+            LOG.info('%s failed to retrieve data from sensor at MCP pin %s',
+                     time_now.strftime("%Y-%m-%d %H:%M:%S"), pin)
+        return data
+    chan = get_mcp_channel(mcp_chip, pin)
     adc_val = chan.value
     adc_volt = chan.voltage
     if adc_val is None and adc_volt is None:
@@ -197,43 +502,81 @@ def add_local_pi_info(data, pi_id, pi_name, location):
     return data
 
 
-def poll_all_dht22(dht_config, dht_sensor, pi_id, pi_name, engine):
+def read_sensor(sensortype, location, poll, *args):
+    """
+    Read the sensor at location by calling poll(*args), recording the time
+    taken and whether a reading was returned
+    """
+    with SENSOR_READ_SECONDS.time(sensortype=sensortype, location=location):
+        data = poll(*args)
+    SENSOR_READS.inc(sensortype=sensortype, location=location,
+                     result="failed" if data is None else "ok")
+    return data
+
+
+def poll_all_dht22(dht_config, dht_sensor, pi_id, pi_name, writer,
+                   cycle_time=None, reader=None):
     """
     Poll all dht22 sensors listed in the config file for this pi
-    Save resulting records to the database specified engine
+    Pass resulting records to writer (a local_db.ReadingWriter)
+    All readings are stamped with cycle_time if it is given
+    reader: the DHTReader to read the sensors with
     """
     if dht_sensor is not None:
-        for location, details in dht_config.iterrows():
-            dht_pin = int(details.pin)
-            data = poll_dht22(dht_sensor, dht_pin)
-            data = add_local_pi_info(data, pi_id, pi_name, location)
-            save_readings_to_db(data, engine)
+        for sensor in dht_config:
+            data = read_sensor("dht22", sensor.location, poll_dht22,
+                               dht_sensor, sensor.pin, cycle_time, reader)
+            data = add_local_pi_info(data, pi_id, pi_name, sensor.location)
+            writer.add(data)
 
 
-def poll_all_bme680(bme_config, bme_sensor, pi_id, pi_name, engine):
+def poll_all_bme680(bme_config, bme_sensor, pi_id, pi_name, writer,
+                    cycle_time=None):
     """
     Poll all bme680 sensors listed in the config file for this pi
-    Save resulting records to the database specified engine
+    Pass resulting records to writer (a local_db.ReadingWriter)
+    All readings are stamped with cycle_time if it is given
     """
     if bme_sensor is not None:
-        for location, details in bme_config.iterrows():
-            bme_pin = int(details.pin)
-            data = poll_bme680(bme_sensor, bme_pin)
-            data = add_local_pi_info(data, pi_id, pi_name, location)
-            save_readings_to_db(data, engine)
+        for sensor in bme_config:
+            data = read_sensor("bme680", sensor.location, poll_bme680,
+                               bme_sensor, sensor.pin, cycle_time)
+            data = add_local_pi_info(data, pi_id, pi_name, sensor.location)
+            writer.add(data)
 
 
-def poll_all_mcp3008(mcp_config, mcp_chip, pi_id, pi_name, engine):
+def poll_all_mcp3008(mcp_config, mcp_chip, pi_id, pi_name, writer,
+                     cycle_time=None, n_samples=1, reduce="median"):
     """
     Poll all sensors connected to MCP3008 listed in the config file for this pi
-    Save resulting records to the database specified engine
+    Pass resulting records to writer (a local_db.ReadingWriter)
+    All readings are stamped with cycle_time if it is given
+    With n_samples > 1, all pins are sampled in one burst of n_samples reads
+    and each is reduced to the mean or median (reduce) and standard deviation
     """
-    if mcp_chip is not None:
-        for location, details in mcp_config.iterrows():
-            mcp_pin = int(details.pin)
-            data = poll_mcp3008(mcp_chip, mcp_pin)
-            data = add_local_pi_info(data, pi_id, pi_name, location)
-            save_readings_to_db(data, engine)
+    if mcp_chip is not None and n_samples > 1:
+        if cycle_time is None:
+            cycle_time = datetime.utcnow()
+        pins = [sensor.pin for sensor in mcp_config]
+        LOG.info('%s burst sampling MCP chip %s times on pins %s',
+                 cycle_time.strftime("%Y-%m-%d %H:%M:%S"), n_samples, pins)
+        with SENSOR_READ_SECONDS.time(sensortype="mcp3008",
+                                      location="burst"):
+            samples = read_mcp_bursts(mcp_chip, pins, n_samples)
+        summary = summarise_bursts(samples, mcp_chip.reference_voltage,
+                                   reduce)
+        for sensor, data in zip(mcp_config,
+                                burst_readings(summary, cycle_time)):
+            SENSOR_READS.inc(sensortype="mcp3008", location=sensor.location,
+                             result="failed" if data is None else "ok")
+            data = add_local_pi_info(data, pi_id, pi_name, sensor.location)
+            writer.add(data)
+    elif mcp_chip is not None:
+        for sensor in mcp_config:
+            data = read_sensor("mcp3008", sensor.location, poll_mcp3008,
+                               mcp_chip, sensor.pin, cycle_time)
+            data = add_local_pi_info(data, pi_id, pi_name, sensor.location)
+            writer.add(data)
 
 
 def initialise_sensors(pi_name=PINAME,
@@ -241,33 +584,383 @@ def initialise_sensors(pi_name=PINAME,
                        config_fn='logger_config.csv'):
     """
     Initialise the DHT22 and BME680 sensors
-    Return the sensor instances and dataframes containing the config parameters
+    Return the sensor instances and the tuples of SensorConfig of each bus
     """
-    sensors = read_config(
+    plan = read_config(
         pi_name=pi_name, path=config_path, filename=config_fn
     )
 
-    dht_config = sensors["dht22"]
-    if dht_config.size:
+    dht_config = plan.dht22
+    if dht_config:
         dht_sensor = set_up_dht22_sensors()
     else:
         dht_sensor = None
 
-    bme_config = sensors["bme680"]
-    if bme_config.size:
+    bme_config = plan.bme680
+    if bme_config:
         bme_sensor = set_up_bme680_sensors()
     else:
         bme_sensor = None
 
-    mcp_config = sensors["mcp3008"]
-    if mcp_config.size:
+    mcp_config = plan.mcp3008
+    if mcp_config:
         mcp_chip = set_up_mcp_convertor()
     else:
         mcp_chip = None
     return dht_sensor, dht_config, bme_sensor, bme_config, mcp_chip, mcp_config
 
 
+class PollingEngine():
+    """
+    Poll all configured sensors concurrently on a pool of worker threads.
+    Each DHT22 pin is polled as an independent task, while the BME680 (I2C)
+    and MCP3008 (SPI) sensors share a bus each and are polled serially within
+    a single task per bus. One cycle then takes about as long as the slowest
+    sensor rather than the sum of all of them. Whole cycles are serialised,
+    so the engine may be shared by the scheduler and the control socket.
+    Takes the sensors and configs in the order returned by initialise_sensors
+    mcp_samples, mcp_reduce: burst size and reduction for MCP3008 sensors,
+        see poll_all_mcp3008
+    dht_reader: DHTReader with the retry settings for DHT22 sensors
+    """
+    def __init__(self, dht_sensor, dht_config, bme_sensor, bme_config,
+                 mcp_chip, mcp_config, pi_id, pi_name=PINAME, mcp_samples=1,
+                 mcp_reduce="median", dht_reader=None):
+        # pylint: disable=R0913
+        self.dht_sensor = dht_sensor
+        self.dht_config = dht_config
+        self.bme_sensor = bme_sensor
+        self.bme_config = bme_config
+        self.mcp_chip = mcp_chip
+        self.mcp_config = mcp_config
+        self.mcp_samples = mcp_samples
+        self.mcp_reduce = mcp_reduce
+        self.dht_reader = DHTReader() if dht_reader is None else dht_reader
+        self.pi_id = pi_id
+        self.pi_name = pi_name
+        self.lock = threading.Lock()
+        n_workers = max(len(self.tasks(writer=None, cycle_time=None)), 1)
+        self.executor = ThreadPoolExecutor(max_workers=n_workers,
+                                           thread_name_prefix="poll")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def tasks(self, writer, cycle_time, locations=None):
+        """
+        Return a list of (name, function, args) tuples, one for each task
+        that may run concurrently with the others
+        locations: only poll the sensors at these locations (default all)
+        """
+        def select(config):
+            if locations is None:
+                return config
+            return tuple(sensor for sensor in config
+                         if sensor.location in locations)
+
+        tasks = []
+        dht_config = select(self.dht_config)
+        if self.dht_sensor is not None:
+            for sensor in dht_config:
+                args = ((sensor,), self.dht_sensor, self.pi_id,
+                        self.pi_name, writer, cycle_time, self.dht_reader)
+                tasks.append((f"dht22 {sensor.location}", poll_all_dht22,
+                              args))
+        bme_config = select(self.bme_config)
+        if self.bme_sensor is not None and len(bme_config):
+            args = (bme_config, self.bme_sensor,
+                    self.pi_id, self.pi_name, writer, cycle_time)
+            tasks.append(("bme680 bus", poll_all_bme680, args))
+        mcp_config = select(self.mcp_config)
+        if self.mcp_chip is not None and len(mcp_config):
+            args = (mcp_config, self.mcp_chip, self.pi_id,
+                    self.pi_name, writer, cycle_time, self.mcp_samples,
+                    self.mcp_reduce)
+            tasks.append(("mcp3008 bus", poll_all_mcp3008, args))
+        return tasks
+
+    def poll(self, writer, cycle_time=None, locations=None):
+        """
+        Poll every sensor once, passing readings to writer. All readings are
+        stamped with a common cycle_time (defaults to the current UTC time).
+        A failure in one task is logged without affecting the others.
+        locations: only poll the sensors at these locations (default all)
+        Returns the cycle time
+        """
+        with self.lock, POLL_CYCLE_SECONDS.time():
+            if cycle_time is None:
+                cycle_time = datetime.utcnow()
+            tasks = self.tasks(writer, cycle_time, locations)
+            futures = [(name, self.executor.submit(self.run_task, name,
+                                                   func, args))
+                       for name, func, args in tasks]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception:  # pylint: disable=W0703
+                    POLL_TASK_ERRORS.inc(task=name)
+                    LOG.exception("polling task '%s' failed", name)
+        return cycle_time
+
+    @staticmethod
+    def run_task(name, func, args):
+        """
+        Run one polling task, recording the time it takes
+        """
+        with POLL_TASK_SECONDS.time(task=name):
+            return func(*args)
+
+    def status(self):
+        """
+        Return a dictionary of the state of the DHT22 pins' circuit breakers
+        """
+        return dict(dht22=self.dht_reader.status())
+
+    def shutdown(self):
+        """
+        Stop the worker threads
+        """
+        self.executor.shutdown(wait=True)
+
+
+class CycleStats():
+    """
+    Running statistics on the timing of scheduled polling cycles.
+    jitter is the delay between the scheduled start of a cycle and the time
+    it actually started; duration is the time taken to run the cycle.
+    """
+    def __init__(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_jitter = None
+        self.max_jitter = 0.0
+        self.max_duration = 0.0
+        self._mean_jitter = 0.0
+        self._m2_jitter = 0.0
+
+    def update(self, jitter, duration):
+        """
+        Add the timings of one cycle, using Welford's algorithm for the
+        running mean and variance of the jitter
+        """
+        self.cycles += 1
+        self.last_jitter = jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self.max_duration = max(self.max_duration, duration)
+        delta = jitter - self._mean_jitter
+        self._mean_jitter += delta / self.cycles
+        self._m2_jitter += delta * (jitter - self._mean_jitter)
+
+    def summary(self):
+        """
+        Return a dictionary summarising the cycle timings so far
+        """
+        if self.cycles > 1:
+            std_jitter = math.sqrt(self._m2_jitter / (self.cycles - 1))
+        else:
+            std_jitter = 0.0
+        return dict(
+            cycles=self.cycles,
+            overruns=self.overruns,
+            skipped=self.skipped,
+            last_jitter=self.last_jitter,
+            mean_jitter=self._mean_jitter,
+            std_jitter=std_jitter,
+            max_jitter=self.max_jitter,
+            max_duration=self.max_duration,
+        )
+
+
+class FixedRateScheduler():
+    """
+    Call a function at a fixed rate, with cycles aligned to wall-clock
+    multiples of period (e.g. on the minute for period=60). Cycle start times
+    are computed from the grid rather than from the end of the previous
+    cycle, so time spent polling does not cause drift.
+    If a cycle overruns one or more later start times, those cycles are
+    skipped (and counted) rather than being run back-to-back to catch up.
+    clock and sleep may be replaced for testing.
+    """
+    def __init__(self, period, clock=time.time, sleep=time.sleep):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = CycleStats()
+
+    def next_boundary(self, now):
+        """
+        Return the first grid time strictly after now
+        """
+        return (math.floor(now / self.period) + 1) * self.period
+
+    def run(self, func, n_cycles=None):
+        """
+        Call func(cycle_time) at each grid time, where cycle_time is the
+        scheduled start as a naive UTC datetime. Runs forever unless n_cycles
+        is given. Returns the cycle statistics
+        """
+        scheduled = self.next_boundary(self.clock())
+        while n_cycles is None or self.stats.cycles < n_cycles:
+            self.sleep(max(scheduled - self.clock(), 0))
+            start = self.clock()
+            func(datetime.utcfromtimestamp(scheduled))
+            end = self.clock()
+            self.stats.update(jitter=start - scheduled, duration=end - start)
+            LOG.debug("cycle at %s started %.3f s late and took %.3f s",
+                      scheduled, start - scheduled, end - start)
+
+            scheduled += self.period
+            if end > scheduled:
+                missed = math.floor((end - scheduled) / self.period) + 1
+                self.stats.overruns += 1
+                self.stats.skipped += missed
+                CYCLE_OVERRUNS.inc()
+                CYCLES_SKIPPED.inc(missed)
+                LOG.warning("polling cycle took %.3f s, longer than the "
+                            "period of %s s; skipping %s cycle(s)",
+                            end - start, self.period, missed)
+                scheduled += missed * self.period
+        return self.stats
+
+
+class SensorSchedule():
+    """
+    Polling interval of one sensor location, adapted to how fast its
+    readings change. The interval is halved (down to min_interval) when the
+    watched field changes by more than threshold between readings, and
+    lengthened by half (up to max_interval) when it changes by less than
+    half of threshold. Without a threshold the interval stays fixed.
+    """
+    # pylint: disable=R0913
+    def __init__(self, location, field, min_interval, max_interval,
+                 threshold=None):
+        self.location = location
+        self.field = field
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.threshold = threshold
+        self.interval = min_interval
+        self.next_due = 0.0
+        self.last_value = None
+
+    def __repr__(self):
+        return "<SensorSchedule(location={}, interval={})>".format(
+            self.location, self.interval
+        )
+
+    def update(self, reading, now):
+        """
+        Adapt the interval to a new reading (None if the poll failed) taken
+        at now (seconds since the epoch) and schedule the next poll
+        Returns the new interval
+        """
+        value = None if reading is None else reading.get(self.field)
+        if value is not None and self.last_value is not None \
+                and self.threshold is not None:
+            change = abs(value - self.last_value)
+            if change > self.threshold:
+                self.interval = max(self.interval / 2, self.min_interval)
+            elif change < self.threshold / 2:
+                self.interval = min(self.interval * 1.5, self.max_interval)
+        if value is not None:
+            self.last_value = value
+        self.next_due = now + self.interval
+        return self.interval
+
+
+# the field of each sensor type that adaptive polling watches for changes
+WATCHED_FIELDS = {"dht22": "temp", "bme680": "temp", "mcp3008": "mcdvoltage"}
+
+
+def make_schedules(configs, default_interval):
+    """
+    Return a SensorSchedule for every sensor in configs, a dictionary of
+    sensor type: tuple of SensorConfig. Bounds are read from the optional
+    config columns min_interval, max_interval and threshold (in seconds and
+    units of the watched field); where they are missing the sensor is polled
+    every default_interval seconds
+    """
+    schedules = []
+    for sensortype, config in configs.items():
+        for sensor in config:
+            min_interval = sensor.min_interval
+            if min_interval is None:
+                min_interval = default_interval
+            max_interval = sensor.max_interval
+            if max_interval is None:
+                max_interval = min_interval
+            schedules.append(SensorSchedule(
+                sensor.location, WATCHED_FIELDS[sensortype], min_interval,
+                max_interval, sensor.threshold,
+            ))
+    return schedules
+
+
+class AdaptiveScheduler():
+    """
+    Poll each sensor location of a PollingEngine at its own adaptive
+    interval (see SensorSchedule). Sensors that fall due together are
+    polled in a single cycle of the engine.
+    """
+    def __init__(self, poller, default_interval, clock=time.time):
+        self.poller = poller
+        self.clock = clock
+        configs = {}
+        if poller.dht_sensor is not None:
+            configs["dht22"] = poller.dht_config
+        if poller.bme_sensor is not None:
+            configs["bme680"] = poller.bme_config
+        if poller.mcp_chip is not None:
+            configs["mcp3008"] = poller.mcp_config
+        self.schedules = make_schedules(configs, default_interval)
+
+    def run_once(self, writer):
+        """
+        Poll the sensors that are due, passing readings to writer, and adapt
+        their intervals
+        Returns the number of seconds until the next sensor is due
+        """
+        now = self.clock()
+        due = [s for s in self.schedules if s.next_due <= now]
+        if due:
+            collector = CollectingWriter(writer)
+            self.poller.poll(collector, datetime.utcfromtimestamp(now),
+                             locations=[s.location for s in due])
+            readings = {r["location"]: r for r in collector.readings}
+            for schedule in due:
+                schedule.update(readings.get(schedule.location), now)
+            LOG.debug("polled %s", due)
+        if not self.schedules:
+            return None
+        return max(min(s.next_due for s in self.schedules) - self.clock(), 0)
+
+
+def maintain_rollups(keep_days=None, keep_minute_days=None, engine=ENGINE,
+                     max_chunks=None):
+    """
+    Roll up new readings and delete old ones as local_db.apply_retention
+    does, logging any database error rather than raising it so that the
+    logger keeps running and its buffered readings are not lost. SQLite
+    older than 3.25, for example, lacks the window functions and upserts
+    the rollups are built with
+    Returns True if the rollups were updated
+    """
+    try:
+        apply_retention(keep_days, keep_minute_days, engine, max_chunks)
+    except SQLAlchemyError:
+        LOG.exception("failed to update the rollup tables")
+        return False
+    return True
+
+
 if __name__ == "__main__":
+    set_up_python_logging(log_filename="local_loggers.log", log_path=LOG_PATH)
     PIID = getserial()
     ARGS = get_local_logger_arguments()
     FREQ = ARGS.frequency
@@ -275,23 +968,99 @@ if __name__ == "__main__":
 
     if ARGS.setup_db:
         set_up_database(LOG_PATH, ENGINE)
+    else:
+        migrate_database(ENGINE)
 
-    DHT_SENSOR, DHT_CONF, BME_SENSOR, BME_CONF, MCP_CHIP, MCP_CONF = \
-        initialise_sensors(pi_name=PINAME,
-                           config_path=LOG_PATH,
-                           config_fn='logger_config.csv')
-
-    if FREQ is None:
-        LOG.info('Performing one-off logging of sensors connected to %s',
-                 PINAME)
-        poll_all_dht22(DHT_CONF, DHT_SENSOR, PIID, PINAME, ENGINE)
-        poll_all_bme680(BME_CONF, BME_SENSOR, PIID, PINAME, ENGINE)
-        poll_all_mcp3008(MCP_CONF, MCP_CHIP, PIID, PINAME, ENGINE)
+    # let systemd stop the service cleanly so buffered readings are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    POLLER = PollingEngine(*initialise_sensors(pi_name=PINAME,
+                                               config_path=LOG_PATH,
+                                               config_fn='logger_config.csv'),
+                           pi_id=PIID, pi_name=PINAME,
+                           mcp_samples=ARGS.mcp_samples,
+                           mcp_reduce=ARGS.mcp_reduce,
+                           dht_reader=DHTReader(retries=ARGS.dht_retries,
+                                                deadline=ARGS.dht_deadline))
+
+    if ARGS.storage == "ring":
+        if ARGS.control_socket:
+            # the api server and on-demand polls read the sqlite database
+            sys.exit("--storage ring cannot be used with --control_socket")
+        from pi_logger.ring_store import RingBufferBackend
+        BACKEND = RingBufferBackend()
+    else:
+        BACKEND = None
+    WRITER = ReadingWriter(ENGINE, max_rows=ARGS.batch_size,
+                           max_age=ARGS.flush_age, backend=BACKEND)
+    if ARGS.deadband is not None:
+        DEADBANDS = dict(DEFAULT_DEADBANDS)
+        DEADBANDS.update({field: float(width) for field, width in
+                          (arg.split("=") for arg in ARGS.deadband)})
+        WRITER = DeadbandFilter(WRITER, DEADBANDS, ARGS.heartbeat)
+    if ARGS.control_socket and FREQ is not None:
+        CONTROL = ControlServer(POLLER, WRITER).start()
     else:
-        LOG.info('Will log sensors connected to %s at frequency of %s s',
-                 PINAME, FREQ)
-        while True:
-            poll_all_dht22(DHT_CONF, DHT_SENSOR, PIID, PINAME, ENGINE)
-            poll_all_bme680(BME_CONF, BME_SENSOR, PIID, PINAME, ENGINE)
-            poll_all_mcp3008(MCP_CONF, MCP_CHIP, PIID, PINAME, ENGINE)
-            time.sleep(FREQ)
+        CONTROL = None
+    # with ring storage the logger writes no rows for the rollups to use
+    MAINTAIN_ROLLUPS = BACKEND is None
+    if MAINTAIN_ROLLUPS and FREQ is not None:
+        # roll up the existing readings, e.g. the whole history of a newly
+        # migrated database, before polling starts, so that the loop only
+        # ever has the readings of its last flush to add
+        LOG.info("Bringing the rollup tables up to date")
+        maintain_rollups(ARGS.keep_days, ARGS.keep_minute_days, ENGINE)
+    try:
+        if FREQ is None:
+            LOG.info('Performing one-off logging of sensors connected to %s',
+                     PINAME)
+            POLLER.poll(WRITER)
+            WRITER.flush()
+            if MAINTAIN_ROLLUPS:
+                maintain_rollups(ARGS.keep_days, ARGS.keep_minute_days,
+                                 ENGINE)
+        elif ARGS.fixed_rate:
+            LOG.info('Will log sensors connected to %s every %s s, aligned '
+                     'to the clock', PINAME, FREQ)
+
+            def run_cycle(cycle_time):
+                """Poll all sensors and write out and roll up stale readings"""
+                POLLER.poll(WRITER, cycle_time)
+                if WRITER.flush_if_due(lookahead=FREQ) and MAINTAIN_ROLLUPS:
+                    maintain_rollups(ARGS.keep_days, ARGS.keep_minute_days,
+                                     ENGINE, max_chunks=1)
+
+            SCHEDULER = FixedRateScheduler(FREQ)
+            try:
+                SCHEDULER.run(run_cycle)
+            finally:
+                LOG.info("cycle timing statistics: %s",
+                         SCHEDULER.stats.summary())
+        elif ARGS.adaptive:
+            LOG.info('Will log sensors connected to %s at adaptive '
+                     'intervals, %s s by default', PINAME, FREQ)
+            SCHEDULER = AdaptiveScheduler(POLLER, FREQ)
+            while True:
+                WAIT = SCHEDULER.run_once(WRITER)
+                if WAIT is None:
+                    break
+                if WRITER.flush_if_due(lookahead=WAIT) and MAINTAIN_ROLLUPS:
+                    maintain_rollups(ARGS.keep_days, ARGS.keep_minute_days,
+                                     ENGINE, max_chunks=1)
+                time.sleep(WAIT)
+        else:
+            LOG.info('Will log sensors connected to %s at frequency of %s s',
+                     PINAME, FREQ)
+            while True:
+                POLLER.poll(WRITER)
+                # write now if the buffer would go stale during the sleep
+                if WRITER.flush_if_due(lookahead=FREQ) and MAINTAIN_ROLLUPS:
+                    maintain_rollups(ARGS.keep_days, ARGS.keep_minute_days,
+                                     ENGINE, max_chunks=1)
+                time.sleep(FREQ)
+    finally:
+        if CONTROL is not None:
+            CONTROL.stop()
+        POLLER.shutdown()
+        WRITER.close()
+        WRITER.backend.close()
@@ -0,0 +1,322 @@
+"""
+Compact storage of readings in fixed-size binary ring buffers, as an
+alternative to rows in SQLite for sensors sampled many times a second.
+
+Each sensor (location) has its own memory-mapped file holding a small header
+and a fixed number of fixed-size records, read and written as numpy
+structured arrays. Records are appended in datetime order, overwriting the
+oldest once the file is full, so the datetime column doubles as a time index
+that is searched with a binary search. A range read returns a view of the
+mapped file, without copying, unless the range crosses the point where the
+buffer wraps around.
+
+Only one process should write to a sensor's file; any number may read it.
+
+Readings stored here are not in the SQLite database, so the API server, the
+rollups, retention and the control socket do not see them. The logger
+refuses --storage ring together with --control_socket, and pi_logger.serve
+refuses to start while RING_PATH holds ring buffers; read them with
+RingBufferBackend(readonly=True) instead.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from pi_logger import PINAME, LOG_PATH
+from pi_logger.local_db import StorageBackend
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.ring_store")
+
+RING_PATH = os.getenv("RING_PATH", default=os.path.join(LOG_PATH, "rings"))
+DEFAULT_CAPACITY = 1 << 19  # records per sensor, 32 MiB at 64 bytes each
+MAGIC = b"PIRING01"
+VALUE_FIELDS = ["temp", "humidity", "pressure", "gasvoc", "mcdvalue",
+                "mcdvoltage", "mcdstd"]
+METADATA_FIELDS = ["location", "sensortype", "piname", "piid"]
+# missing values are stored as NaN
+RECORD_DTYPE = np.dtype([("datetime", "M8[us]")]
+                        + [(field, "f8") for field in VALUE_FIELDS])
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("capacity", "i8"),
+                         ("count", "i8"), ("record_size", "i8")])
+HEADER_SIZE = 64  # bytes reserved for the header before the records
+
+
+class RingBuffer():
+    """
+    A memory-mapped file of up to capacity records of RECORD_DTYPE
+    The file is created if it does not exist; capacity is then read from
+    its header. count is the total number of records ever appended.
+    """
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, readonly=False):
+        self.path = path
+        if not os.path.exists(path):
+            if readonly:
+                raise FileNotFoundError(path)
+            self.create(path, capacity)
+        mode = "r" if readonly else "r+"
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode=mode,
+                                shape=(1,))
+        if self.header["magic"][0] != MAGIC or \
+                self.header["record_size"][0] != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{path} is not a ring buffer of readings")
+        self.capacity = int(self.header["capacity"][0])
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode=mode,
+                                 offset=HEADER_SIZE, shape=(self.capacity,))
+
+    @staticmethod
+    def create(path, capacity):
+        """
+        Write the header of an empty ring buffer and size the file to hold
+        capacity records. The records take no disk space until written.
+        """
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header["magic"] = MAGIC
+        header["capacity"] = capacity
+        header["record_size"] = RECORD_DTYPE.itemsize
+        with open(path, "wb") as file:
+            file.write(header.tobytes().ljust(HEADER_SIZE, b"\0"))
+            file.truncate(HEADER_SIZE + capacity * RECORD_DTYPE.itemsize)
+
+    @property
+    def count(self):
+        """
+        Total number of records appended since the file was created
+        """
+        return int(self.header["count"][0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def segments(self):
+        """
+        Return views of the stored records as (older, newer) arrays, each in
+        datetime order. newer is empty until the buffer has wrapped around
+        """
+        count = self.count
+        if count <= self.capacity:
+            return self.records[:count], self.records[:0]
+        position = count % self.capacity
+        return self.records[position:], self.records[:position]
+
+    def last_datetime(self):
+        """
+        Return the datetime of the newest record as numpy datetime64, or None
+        """
+        count = self.count
+        if count == 0:
+            return None
+        return self.records["datetime"][(count - 1) % self.capacity]
+
+    def append(self, records):
+        """
+        Append a structured array of RECORD_DTYPE, sorted into datetime
+        order. Records no newer than the newest stored record, e.g. after
+        the clock has been stepped back or when a failed batch is saved
+        again, are dropped with a warning, so that the datetimes stay in
+        order and appending the same records twice stores them once
+        Returns the number of records appended
+        """
+        records = np.asarray(records, dtype=RECORD_DTYPE)
+        if len(records) > 1:
+            records = np.sort(records, order="datetime", kind="stable")
+        last = self.last_datetime()
+        if last is not None and len(records) \
+                and records["datetime"][0] <= last:
+            stale = np.searchsorted(records["datetime"], last, "right")
+            LOG.warning("dropping %s records for %s no newer than the last "
+                        "stored record at %s", stale, self.path, last)
+            records = records[stale:]
+        if len(records) == 0:
+            return 0
+        if len(records) > self.capacity:
+            records = records[-self.capacity:]
+        count = self.count
+        position = count % self.capacity
+        first_part = min(len(records), self.capacity - position)
+        self.records[position:position + first_part] = records[:first_part]
+        self.records[:len(records) - first_part] = records[first_part:]
+        # publish the records to readers only once they have been written
+        self.header["count"] = count + len(records)
+        return len(records)
+
+    def read_range(self, start=None, end=None):
+        """
+        Return the records with start < datetime < end (either may be None)
+        as a structured array. This is a view of the file, not a copy, unless
+        the range spans the point where the buffer wraps around.
+        """
+        selected = []
+        for segment in self.segments():
+            times = segment["datetime"]
+            first = 0 if start is None else \
+                np.searchsorted(times, np.datetime64(start, "us"), "right")
+            last = len(segment) if end is None else \
+                np.searchsorted(times, np.datetime64(end, "us"), "left")
+            if last > first:
+                selected.append(segment[first:last])
+        if not selected:
+            return self.records[:0]
+        if len(selected) == 1:
+            return selected[0]
+        return np.concatenate(selected)
+
+    def flush(self):
+        """
+        Write changes to the file back to disk
+        """
+        self.records.flush()
+        self.header.flush()
+
+
+def records_to_readings(records, metadata):
+    """
+    Convert a structured array of records to a list of reading dictionaries
+    with the sensor's metadata
+    """
+    columns = {"datetime": records["datetime"].astype("M8[us]").tolist()}
+    for field in VALUE_FIELDS:
+        values = records[field]
+        columns[field] = np.where(np.isnan(values), None, values).tolist()
+    columns["mcdvalue"] = [None if value is None else int(value)
+                           for value in columns["mcdvalue"]]
+    return [dict(metadata, **{col: columns[col][i] for col in columns})
+            for i in range(len(records))]
+
+
+def readings_to_records(readings):
+    """
+    Convert a list of reading dictionaries to a structured array of records
+    """
+    records = np.empty(len(readings), dtype=RECORD_DTYPE)
+    records["datetime"] = [reading["datetime"] for reading in readings]
+    for field in VALUE_FIELDS:
+        records[field] = [np.nan if reading.get(field) is None
+                          else reading[field] for reading in readings]
+    return records
+
+
+class RingBufferBackend(StorageBackend):
+    """
+    Store readings in one RingBuffer file per location under path
+    Each file has a .json file alongside with the sensor's metadata
+    """
+    def __init__(self, path=RING_PATH, capacity=DEFAULT_CAPACITY,
+                 readonly=False):
+        self.path = path
+        self.capacity = capacity
+        self.readonly = readonly
+        self.rings = {}
+        self.metadata = {}
+        self.lock = threading.Lock()
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+
+    def filename(self, location):
+        """
+        Return the path of the ring buffer file for location. The name is
+        made safe for the filesystem, with a hash of the location added so
+        that e.g. "soil a" and "soil_a" get different files
+        """
+        name = re.sub(r"[^\w.-]", "_", location)
+        digest = hashlib.sha1(location.encode()).hexdigest()[:8]
+        return os.path.join(self.path, f"{name}-{digest}.ring")
+
+    def locations(self):
+        """
+        Return the locations stored under path
+        """
+        if not os.path.isdir(self.path):
+            return []
+        locations = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.path, name), "r") as file:
+                    locations.append(json.load(file)["location"])
+        return locations
+
+    def get_ring(self, location, metadata=None):
+        """
+        Return the RingBuffer for location, opening or creating it
+        """
+        with self.lock:
+            if location not in self.rings:
+                filename = self.filename(location)
+                meta_path = filename[:-len(".ring")] + ".json"
+                if not os.path.exists(meta_path):
+                    if self.readonly or metadata is None:
+                        raise KeyError(location)
+                    with open(meta_path, "w") as file:
+                        json.dump(metadata, file)
+                with open(meta_path, "r") as file:
+                    self.metadata[location] = json.load(file)
+                self.rings[location] = RingBuffer(filename, self.capacity,
+                                                  self.readonly)
+        return self.rings[location]
+
+    def save_records(self, metadata, records):
+        """
+        Append a structured array of records for the sensor described by
+        metadata (a dictionary of location, sensortype, piname and piid)
+        """
+        ring = self.get_ring(metadata["location"], metadata)
+        written = ring.append(records)
+        ring.flush()
+        return written
+
+    def save_readings(self, readings):
+        """
+        Append readings to the ring buffer of each location
+        """
+        by_location = {}
+        for reading in readings:
+            by_location.setdefault(reading["location"], []).append(reading)
+        for location_readings in by_location.values():
+            metadata = {field: location_readings[0].get(field)
+                        for field in METADATA_FIELDS}
+            self.save_records(metadata,
+                              readings_to_records(location_readings))
+
+    def read_range(self, location, start=None, end=None):
+        """
+        Return the records of location with start < datetime < end as a
+        structured array, see RingBuffer.read_range
+        """
+        return self.get_ring(location).read_range(start, end)
+
+    def get_recent_readings(self, start_datetime_utc, end_datetime_utc=None):
+        """
+        Return a list of the readings of all locations after
+        start_datetime_utc (and before end_datetime_utc if given) in
+        datetime order, or None
+        """
+        readings = []
+        for location in self.locations():
+            records = self.read_range(location, start_datetime_utc,
+                                      end_datetime_utc)
+            readings += records_to_readings(records, self.metadata[location])
+        readings.sort(key=lambda reading: reading["datetime"])
+        return readings or None
+
+    def close(self):
+        """
+        Write outstanding changes and unmap the files
+        """
+        with self.lock:
+            if not self.readonly:
+                for ring in self.rings.values():
+                    ring.flush()
+            self.rings.clear()
+
+
+def has_rings(path=RING_PATH):
+    """
+    Return whether path holds any ring buffer files
+    """
+    return os.path.isdir(path) and any(name.endswith(".ring")
+                                       for name in os.listdir(path))
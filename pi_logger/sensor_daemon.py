@@ -0,0 +1,180 @@
+"""
+Control socket for the long-running sensor logger.
+
+The logger process keeps its sensors initialised between polling cycles.
+It can serve on-demand polls to other local processes (such as the API
+server) over a Unix domain socket, so that they never need to set up the
+sensor hardware themselves. Messages are single lines of JSON.
+"""
+
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+from datetime import datetime
+
+from pi_logger import PINAME, LOG_PATH
+from pi_logger.metrics import REGISTRY
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.sensor_daemon")
+
+SOCKET_PATH = os.getenv("CONTROL_SOCKET",
+                        default=os.path.join(LOG_PATH, "pi_logger.sock"))
+
+
+class CollectingWriter():
+    """
+    Pass readings on to a local_db.ReadingWriter while keeping a copy of
+    each one, so that the readings from a single poll can be returned.
+    With unfiltered, readings bypass any local_db.DeadbandFilter, so that
+    all of them are stored
+    """
+    def __init__(self, writer, unfiltered=False):
+        self.writer = writer
+        self.readings = []
+        self.write = getattr(writer, "add_unfiltered", writer.add) \
+            if unfiltered else writer.add
+
+    def add(self, data):
+        """
+        Keep a copy of data and pass it on to the writer
+        """
+        if data is not None:
+            self.readings.append(dict(data))
+        self.write(data)
+
+
+def serialise_reading(data):
+    """
+    Return a copy of a reading dictionary that can be converted to JSON
+    """
+    return {k: v.isoformat() if isinstance(v, datetime) else v
+            for k, v in data.items()}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one request on the control socket.
+    Supported commands:
+        {"command": "ping"}
+        {"command": "poll"}  # poll all sensors, write and return readings
+        {"command": "status"}  # report sensors being skipped after failures
+        {"command": "metrics"}  # return the logger's metrics
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode())
+            command = request["command"]
+            if command == "ping":
+                response = dict(status="ok")
+            elif command == "poll":
+                readings = self.server.poll()
+                response = dict(status="ok", readings=readings)
+            elif command == "status":
+                response = dict(status="ok",
+                                sensors=self.server.poller.status())
+            elif command == "metrics":
+                response = dict(status="ok",
+                                metrics=REGISTRY.collect(process="logger"))
+            else:
+                response = dict(status="error",
+                                message=f"unknown command: {command}")
+        except (ValueError, KeyError, TypeError) as err:
+            response = dict(status="error", message=f"bad request: {err}")
+        except Exception as err:  # pylint: disable=W0703
+            LOG.exception("control request failed")
+            response = dict(status="error", message=str(err))
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn,
+                    socketserver.UnixStreamServer):
+    """
+    Unix socket server giving other processes access to the warm sensors
+    held by a local_loggers.PollingEngine
+    """
+    daemon_threads = True
+
+    def __init__(self, poller, writer, socket_path=SOCKET_PATH):
+        self.poller = poller
+        self.writer = writer
+        self.socket_path = socket_path
+        self.thread = None
+        if os.path.exists(socket_path):
+            LOG.info("removing stale control socket %s", socket_path)
+            os.remove(socket_path)
+        super().__init__(socket_path, ControlHandler)
+
+    def poll(self):
+        """
+        Poll all sensors once, write the readings to the database straight
+        away, even those a deadband would drop, so that they are the latest
+        stored, and return them as a list of dictionaries
+        """
+        collector = CollectingWriter(self.writer, unfiltered=True)
+        self.poller.poll(collector)
+        self.writer.flush()
+        return [serialise_reading(data) for data in collector.readings]
+
+    def start(self):
+        """
+        Serve requests on a background thread
+        """
+        LOG.info("listening for control requests on %s", self.socket_path)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="control", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and remove the socket file
+        """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def send_command(command, socket_path=SOCKET_PATH, timeout=30):
+    """
+    Send a command to the logger's control socket and return the response
+    Raises ConnectionError if the logger is not running and RuntimeError if
+    it could not carry out the command or its reply could not be read, e.g.
+    because it exited while handling the command
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError) as err:
+            raise ConnectionError(
+                f"no logger listening on {socket_path}"
+            ) from err
+        sock.sendall(json.dumps(dict(command=command)).encode() + b"\n")
+        with sock.makefile("rb") as stream:
+            reply = stream.readline()
+    if not reply:
+        raise RuntimeError("the logger closed the connection without replying")
+    try:
+        response = json.loads(reply.decode())
+    except ValueError as err:
+        raise RuntimeError(f"unreadable reply from the logger: {err}") from err
+    if not isinstance(response, dict):
+        raise RuntimeError(f"unexpected reply from the logger: {response}")
+    if response.get("status") != "ok":
+        raise RuntimeError(response.get("message", "request failed"))
+    return response
+
+
+def request_poll(socket_path=SOCKET_PATH, timeout=30):
+    """
+    Ask the running logger to poll its sensors
+    Returns a list of dictionaries containing the new readings
+    """
+    return send_command("poll", socket_path, timeout)["readings"]
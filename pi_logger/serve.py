@@ -0,0 +1,147 @@
+"""
+Production server for the pi_logger API.
+
+Runs api_server.app under gunicorn in preforked worker processes, each
+handling requests on a pool of threads (gunicorn's gthread worker). Every
+request, with any blocking database query or poll of the logger it makes,
+runs on its own thread, so a slow query never holds up other clients. An
+open /live stream holds its thread for as long as it is open, so each
+worker accepts at most LIVE_MAX_CONNECTIONS streams, half its threads by
+default, and answers further ones with 503. The app, with pandas, is
+loaded once before forking; each worker then opens its own SQLite
+connections in local_db.ENGINE's pool, which its threads share, since
+connections cannot be shared between processes. Metrics, the response
+cache and the live readings watcher are also per worker; the API's
+metrics are labelled with the worker's pid.
+
+Uses gunicorn (pip install pi_logger[serve]) if it is installed. With
+--dev, or without gunicorn, runs Flask's threaded development server.
+
+Run with:
+    python -m pi_logger.serve --workers 2 --threads 32
+"""
+
+import os
+import logging
+import argparse
+import importlib.util
+
+from pi_logger import PINAME, LOG_PATH, set_up_python_logging
+from pi_logger.local_db import ENGINE
+
+LOG = logging.getLogger(f"pi_logger_{PINAME}.serve")
+
+HOST = os.getenv("API_HOST", default="0.0.0.0")
+PORT = int(os.getenv("API_PORT", default="5003"))
+# a Pi has four cores; the logger and SQLite need some of them
+WORKERS = 2
+# each open /live stream takes up a thread for as long as it is open, see
+# LIVE_MAX_CONNECTIONS
+THREADS = 32
+
+
+def post_fork(server, worker):
+    """
+    Drop any database connections inherited from the parent process, so
+    that each worker opens its own
+    """
+    # pylint: disable=W0613
+    ENGINE.dispose()
+    LOG.debug("worker %s started", worker.pid)
+
+
+def gunicorn_options(host=HOST, port=PORT, workers=WORKERS, threads=THREADS):
+    """
+    Return the gunicorn settings for serving the API
+    """
+    return dict(
+        bind=f"{host}:{port}",
+        workers=workers,
+        worker_class="gthread",
+        threads=threads,
+        preload_app=True,
+        post_fork=post_fork,
+        # seconds without a heartbeat before a worker is restarted; open
+        # streams do not count, since the worker's main thread still beats
+        timeout=30,
+        graceful_timeout=10,
+        keepalive=5,
+    )
+
+
+def run_gunicorn(app, options):
+    """
+    Serve app with gunicorn, using the given settings
+    """
+    # pylint: disable=C0415,W0223
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError as err:
+        raise RuntimeError("the production server requires gunicorn "
+                           "(pip install pi_logger[serve]), or use "
+                           "--dev") from err
+
+    class Application(BaseApplication):
+        """
+        gunicorn application serving an already imported app
+        """
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def main():
+    """
+    Serve the API with the settings given on the command line
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=THREADS,
+                        help="number of request threads per worker")
+    parser.add_argument("--dev", action="store_true",
+                        help="run the single process development server")
+    args = parser.parse_args()
+    # pylint: disable=C0415
+    from pi_logger.ring_store import RING_PATH, has_rings
+    if has_rings(RING_PATH):
+        parser.error(f"{RING_PATH} holds readings logged with --storage "
+                     "ring, which the API cannot serve; log to sqlite and "
+                     "move the ring buffers elsewhere")
+    # leave threads for other requests however many streams are open
+    live_connections = int(os.environ.setdefault(
+        "LIVE_MAX_CONNECTIONS", str(max(args.threads // 2, 1))
+    ))
+    if not args.dev and live_connections >= args.threads:
+        parser.error(f"LIVE_MAX_CONNECTIONS ({live_connections}) must be "
+                     f"less than --threads ({args.threads})")
+    set_up_python_logging(log_filename="api_server.log", log_path=LOG_PATH)
+    from pi_logger.api_server import app  # pylint: disable=C0415
+    if not args.dev and importlib.util.find_spec("gunicorn") is None:
+        LOG.warning("gunicorn is not installed (pip install "
+                    "pi_logger[serve]), falling back to the development "
+                    "server")
+        args.dev = True
+    if args.dev:
+        LOG.warning("running the development server")
+        app.run(host=args.host, port=args.port, threaded=True, debug=False)
+    else:
+        # the handlers import pandas on first use; importing it before
+        # forking spares each worker's first requests the wait, and the
+        # workers share its memory
+        import pandas  # noqa: F401 pylint: disable=C0415,W0611
+        LOG.info("serving on %s:%s with %s workers of %s threads",
+                 args.host, args.port, args.workers, args.threads)
+        run_gunicorn(app, gunicorn_options(args.host, args.port,
+                                           args.workers, args.threads))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,7 @@ After=multi-user.target
 [Service]
 WorkingDirectory=$PWD
 User=$USER
-ExecStart=$PWD/env/bin/python3 pi_logger/api_server.py
+ExecStart=$PWD/env/bin/python3 -m pi_logger.serve
 Restart=on-failure
 RestartSec=5s
 
@@ -42,6 +42,10 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'export': ['pyarrow'],
+        'serve': ['gunicorn'],
+    },
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -4,5 +4,5 @@ if [ ! -e env ]
 then
   python3 -m venv env
   source env/bin/activate
-  pip3 install -e .
+  pip3 install -e .[serve]
 fi
@@ -1,3 +1,3 @@
 #!/bin/bash
 source env/bin/activate
-flask run --host=0.0.0.0
+python -m pi_logger.serve
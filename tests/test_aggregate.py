@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.aggregate` module.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine
+
+from pi_logger.local_db import (set_up_database, ReadingWriter,
+                                update_rollups)
+from pi_logger.aggregate import (get_aggregated_readings, parse_bucket,
+                                 AggregateCache, to_epoch, choose_rollup,
+                                 AGGREGATES, get_filled_readings,
+                                 get_changes)
+
+START = datetime(2020, 1, 1)
+
+
+@pytest.fixture(name="engine", scope="module")
+def fixture_engine(tmp_path_factory):
+    """
+    Fill the test database, in a temporary directory, with two hours of
+    one-minute readings for two locations, with temp equal to the minute
+    number, and roll them up
+    """
+    path = tmp_path_factory.mktemp("db")
+    engine = create_engine(f'sqlite:///{path / "test_aggregate.db"}')
+    set_up_database(str(path), engine)
+    with ReadingWriter(engine, max_rows=1000) as writer:
+        for minute in range(120):
+            for location in ("attic", "cellar"):
+                writer.add(dict(datetime=START + timedelta(minutes=minute),
+                                location=location, sensortype="dht22",
+                                piname="testy", piid="7357",
+                                temp=float(minute), humidity=50.0))
+    update_rollups(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_parse_bucket():
+    """
+    Check that bucket sizes are converted to seconds
+    """
+    assert parse_bucket("15min") == 900
+    assert parse_bucket("1h") == 3600
+    assert parse_bucket("2d") == 172800
+    assert parse_bucket(60) == 60
+    pytest.raises(ValueError, parse_bucket, "1 fortnight")
+
+
+def test_hourly_mean(engine):
+    """
+    Check that hourly means are calculated per location
+    """
+    result = get_aggregated_readings(START, START + timedelta(hours=2),
+                                     bucket="1h", agg="mean", engine=engine,
+                                     cache=None)
+    assert [(r['datetime'], r['location'], r['n'], r['temp'])
+            for r in result] == [
+                (START, "attic", 60, 29.5),
+                (START, "cellar", 60, 29.5),
+                (START + timedelta(hours=1), "attic", 60, 89.5),
+                (START + timedelta(hours=1), "cellar", 60, 89.5),
+            ]
+
+
+def test_last_with_filter(engine):
+    """
+    Check the last aggregate and the location filter
+    """
+    result = get_aggregated_readings(START, START + timedelta(hours=2),
+                                     bucket="1h", agg="last",
+                                     location="cellar", engine=engine,
+                                     cache=None)
+    assert [(r['location'], r['temp']) for r in result] == [("cellar", 59.0),
+                                                            ("cellar", 119.0)]
+    pytest.raises(ValueError, get_aggregated_readings, START, agg="median",
+                  engine=engine)
+
+
+def test_cache_only_fetches_new_buckets(engine):
+    """
+    Check that complete buckets are served from the cache and only newer
+    buckets are queried again
+    """
+    end = to_epoch(START + timedelta(hours=2))
+    cache = AggregateCache(settle=0, clock=lambda: end)
+    calls = []
+
+    def fetch(start, stop):
+        calls.append((start, stop))
+        return [dict(datetime=datetime.utcfromtimestamp(start))]
+
+    key = ("db", 3600, "mean", None, None)
+    start = to_epoch(START)
+    assert len(cache.get(key, start, end, fetch)) == 1
+    assert len(cache.get(key, start, end, fetch)) == 1
+    assert len(cache.get(key, start, end + 1800, fetch)) == 2
+    assert calls == [(start, end), (end, end + 1800)]
+    result = get_aggregated_readings(START, START + timedelta(hours=2),
+                                     engine=engine)
+    assert result == get_aggregated_readings(START,
+                                             START + timedelta(hours=2),
+                                             engine=engine)
+
+
+def test_choose_rollup():
+    """
+    Check that the coarsest rollup dividing the bucket size is chosen
+    """
+    assert choose_rollup(86400 * 7) == "rollup_day"
+    assert choose_rollup(7200) == "rollup_hour"
+    assert choose_rollup(900) == "rollup_minute"
+    assert choose_rollup(90) is None
+
+
+def test_rollups_match_raw_readings(engine):
+    """
+    Check that buckets built from the rollup tables equal those built from
+    the raw readings once rolled up, including after readings are added to
+    a bucket that has already been rolled up, and that aggregating does not
+    roll up readings itself
+    """
+    end = START + timedelta(hours=3)
+
+    def compare():
+        for bucket in ("15min", "1h", "1d"):
+            for agg in AGGREGATES:
+                kwargs = dict(bucket=bucket, agg=agg, engine=engine,
+                              cache=None)
+                assert get_aggregated_readings(START, end, **kwargs) == \
+                    get_aggregated_readings(START, end, use_rollups=False,
+                                            **kwargs)
+
+    update_rollups(engine)
+    compare()
+    with ReadingWriter(engine) as writer:
+        writer.add(dict(datetime=START + timedelta(minutes=30, seconds=30),
+                        location="attic", sensortype="dht22",
+                        piname="testy", piid="7357", temp=-5.0))
+        writer.add(dict(datetime=START + timedelta(hours=2), location="attic",
+                        sensortype="dht22", piname="testy", piid="7357",
+                        temp=200.0, humidity=40.0))
+    # aggregating only reads; the writer rolls up new readings
+    rolled_up_to = get_changes(None, rolled_up=True, engine=engine)[0]
+    get_aggregated_readings(START, end, bucket="1h", engine=engine,
+                            cache=None)
+    assert get_changes(None, rolled_up=True, engine=engine)[0] == \
+        rolled_up_to
+    update_rollups(engine)
+    compare()
+
+
+def test_filled_readings(engine):
+    """
+    Check that sparse readings are forward-filled onto a regular grid, up to
+    the maximum gap
+    """
+    base = datetime(2021, 1, 1)
+    with ReadingWriter(engine) as writer:
+        for minute, temp in ((1, 1.0), (7, 2.0)):
+            writer.add(dict(datetime=base + timedelta(minutes=minute),
+                            location="sparse", sensortype="dht22",
+                            piname="testy", piid="7357", temp=temp))
+    result = get_filled_readings(base, base + timedelta(minutes=20),
+                                 interval="5min", location="sparse",
+                                 max_gap=600, engine=engine)
+    assert [(r['datetime'] - base, r['reading_datetime'] - base, r['temp'])
+            for r in result] == [
+                (timedelta(minutes=5), timedelta(minutes=1), 1.0),
+                (timedelta(minutes=10), timedelta(minutes=7), 2.0),
+                (timedelta(minutes=15), timedelta(minutes=7), 2.0),
+            ]
+    result = get_filled_readings(base + timedelta(minutes=3),
+                                 base + timedelta(minutes=5),
+                                 interval="5min", max_gap=600,
+                                 engine=engine)
+    assert [(r['location'], r['temp']) for r in result] == [
+        ("sparse", 1.0),
+    ]
+
+
+def test_filled_readings_limit(engine):
+    """
+    Check that a grid with more times than the limit is refused before it
+    is built
+    """
+    end = START + timedelta(minutes=10)
+    assert get_filled_readings(START, end, interval="5min", max_points=3,
+                               engine=engine) is not None
+    with pytest.raises(ValueError):
+        get_filled_readings(START, end, interval="5min", max_points=2,
+                            engine=engine)
+    with pytest.raises(ValueError):
+        get_filled_readings(datetime(2019, 1, 1), interval="1s",
+                            engine=engine)
+
+
+def test_timezone_aware_start(engine):
+    """
+    Check that a timezone-aware start is converted to UTC rather than
+    compared with naive datetimes
+    """
+    assert to_epoch(datetime(2020, 1, 1, 1, tzinfo=timezone(
+        timedelta(hours=1)))) == to_epoch(START)
+    aware = START.replace(tzinfo=timezone.utc)
+    kwargs = dict(bucket="1h", engine=engine, cache=None)
+    assert get_aggregated_readings(aware, START + timedelta(hours=2),
+                                   **kwargs) == \
+        get_aggregated_readings(START, START + timedelta(hours=2), **kwargs)
+    assert get_filled_readings(aware, aware + timedelta(minutes=10),
+                               interval="5min", engine=engine) == \
+        get_filled_readings(START, START + timedelta(minutes=10),
+                            interval="5min", engine=engine)
+
+
+def test_cache_drops_buckets_with_late_readings(engine):
+    """
+    Check that cached buckets are fetched again once a reading written
+    later falls in them, and only from the earliest such bucket
+    """
+    day = datetime(2022, 1, 1)
+    cache = AggregateCache(settle=0)
+    key = ("late", 3600, "mean", None, None, None)
+    calls = []
+
+    def fetch(start, stop):
+        calls.append((start, stop))
+        return get_aggregated_readings(
+            datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(stop),
+            bucket="1h", engine=engine, cache=None, use_rollups=False
+        ) or []
+
+    def changes(since_id):
+        return get_changes(since_id, engine=engine)
+
+    def add(hour, temp):
+        with ReadingWriter(engine) as writer:
+            writer.add(dict(datetime=day + timedelta(hours=hour),
+                            location="late", sensortype="dht22",
+                            piname="testy", piid="7357", temp=temp))
+
+    add(0, 1.0)
+    add(2, 3.0)
+    start, end = to_epoch(day), to_epoch(day + timedelta(hours=3))
+    first = cache.get(key, start, end, fetch, changes)
+    assert [row["temp"] for row in first] == [1.0, 3.0]
+    add(1, 2.0)
+    second = cache.get(key, start, end, fetch, changes)
+    assert [row["temp"] for row in second] == [1.0, 2.0, 3.0]
+    assert calls == [(start, end), (start + 3600, end)]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.aggregator` module.
+Local Flask servers stand in for the pis
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask, Response, request
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.exc import OperationalError
+from werkzeug.serving import make_server
+
+from pi_logger import aggregator as aggregator_module
+from pi_logger.aggregator import Aggregator, CentralData
+
+START = datetime(2020, 1, 1)
+
+
+def make_pi_app(piname, n_readings):
+    """
+    Return a Flask app serving n_readings one-minute readings from
+    /readings_after in the same way as pi_logger.api_server
+    """
+    readings = [dict(id=i + 1, datetime=START + timedelta(minutes=i // 2),
+                     location=f"room{i % 2}", sensortype="dht22",
+                     piname=piname, piid=f"{piname}_id", temp=float(i),
+                     mcdstd=i / 10)
+                for i in range(n_readings)]
+    app = Flask(piname)
+
+    @app.route('/readings_after/<int:last_id>')
+    def readings_after(last_id):
+        limit = request.args.get('limit', 1000, type=int)
+        page = [r for r in readings if r['id'] > last_id][:limit]
+        lines = (json.dumps(r, default=datetime.isoformat) + "\n"
+                 for r in page)
+        return Response(lines, mimetype='application/x-ndjson')
+
+    return app, readings
+
+
+@pytest.fixture(name="engine")
+def fixture_engine(tmp_path):
+    """
+    Return an engine for a central database in a temporary directory
+    """
+    engine = create_engine(f'sqlite:///{tmp_path / "central.db"}')
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="pis")
+def fixture_pis():
+    """
+    Serve two stand-in pis on local ports
+    """
+    servers = {}
+    for piname, n_readings in [("catflap", 25), ("beret", 8)]:
+        app, readings = make_pi_app(piname, n_readings)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers[piname] = (server, readings)
+    yield servers
+    for server, _ in servers.values():
+        server.shutdown()
+
+
+def count_rows(engine):
+    """
+    Return the number of rows in the central table
+    """
+    with engine.connect() as conn:
+        return conn.execute(
+            select([func.count()]).select_from(CentralData.__table__)
+        ).scalar()
+
+
+def test_aggregator_pulls_incrementally(pis, engine):
+    """
+    Check that all readings from every pi are collected in pages, that the
+    high-water marks survive a restart and that nothing is duplicated
+    """
+    nodes = {name: f"http://127.0.0.1:{server.server_port}"
+             for name, (server, _) in pis.items()}
+    aggregator = Aggregator(nodes, engine, page_size=10)
+    assert aggregator.sync_once() == {"catflap": 25, "beret": 8}
+    assert aggregator.sync_once() == {"catflap": 0, "beret": 0}
+    aggregator.close()
+
+    pis["beret"][1].append(dict(pis["beret"][1][-1], id=9,
+                                datetime=START + timedelta(hours=1)))
+    aggregator = Aggregator(nodes, engine, page_size=10)
+    assert aggregator.sync_once() == {"catflap": 0, "beret": 1}
+    aggregator.close()
+    assert count_rows(engine) == 34
+
+
+def test_aggregator_backs_off_offline_node(pis, engine):
+    """
+    Check that an offline pi is skipped with a growing backoff while the
+    others are still pulled
+    """
+    now = [1000.0]
+    server = pis["catflap"][0]
+    nodes = {"catflap": f"http://127.0.0.1:{server.server_port}",
+             "offline": "http://127.0.0.1:9"}
+    aggregator = Aggregator(nodes, engine, timeout=1, backoff=30,
+                            clock=lambda: now[0])
+    assert aggregator.sync_once() == {"catflap": 25, "offline": None}
+    assert aggregator.sync_once() == {"catflap": 0}
+    now[0] += 30
+    assert aggregator.sync_once() == {"catflap": 0, "offline": None}
+    offline = [node for node in aggregator.nodes if node.name == "offline"]
+    assert offline[0].next_attempt == now[0] + 60
+    aggregator.close()
+
+
+def test_aggregator_pulls_backfilled_readings(pis, engine):
+    """
+    Check that readings written to a pi after those already pulled are
+    collected even when their datetime is older
+    """
+    server, readings = pis["catflap"]
+    nodes = {"catflap": f"http://127.0.0.1:{server.server_port}"}
+    aggregator = Aggregator(nodes, engine, page_size=10)
+    assert aggregator.sync_once() == {"catflap": 25}
+    readings.append(dict(readings[0], id=26, location="imported",
+                         datetime=START - timedelta(days=365)))
+    assert aggregator.sync_once() == {"catflap": 1}
+    aggregator.close()
+    assert count_rows(engine) == 26
+
+
+@pytest.mark.parametrize("error", [
+    OperationalError("INSERT", {}, Exception("database is locked")),
+    KeyError("id"),
+])
+def test_aggregator_backs_off_save_error(pis, monkeypatch, error, engine):
+    """
+    Check that a failure to save a node's readings backs the node off
+    rather than stopping the aggregator
+    """
+    def insert_locked(conn, table, rows):
+        raise error
+
+    server = pis["beret"][0]
+    nodes = {"beret": f"http://127.0.0.1:{server.server_port}"}
+    aggregator = Aggregator(nodes, engine, backoff=30, clock=lambda: 1000.0)
+    monkeypatch.setattr(aggregator_module, "insert_ignoring_duplicates",
+                        insert_locked)
+    assert aggregator.sync_once() == {"beret": None}
+    assert aggregator.nodes[0].next_attempt == 1030.0
+    monkeypatch.undo()
+    aggregator.nodes[0].next_attempt = 0.0
+    assert aggregator.sync_once() == {"beret": 8}
+    aggregator.close()
+
+
+def test_aggregator_stores_mcdstd(pis, engine):
+    """
+    Check that the spread of each burst-sampled reading is stored
+    """
+    server = pis["beret"][0]
+    nodes = {"beret": f"http://127.0.0.1:{server.server_port}"}
+    aggregator = Aggregator(nodes, engine)
+    assert aggregator.sync_once() == {"beret": 8}
+    aggregator.close()
+    tab = CentralData.__table__
+    with engine.connect() as conn:
+        spreads = [row[0] for row in conn.execute(
+            select([tab.c.mcdstd]).order_by(tab.c.sourceid)
+        )]
+    assert spreads == [i / 10 for i in range(8)]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Tests for the fake drivers, synthetic database and regression check of the
+`benchmarks` package.
+"""
+
+import sys
+import sqlite3
+
+from benchmarks import fake_drivers
+from benchmarks.synthetic_db import generate_database, END
+from benchmarks.suite import find_regressions
+from benchmarks.bench_load import percentile, run_against_synthetic
+
+
+def test_synthetic_database(tmp_path):
+    """
+    Check that the generated rows span the requested years, that
+    latest_readings holds the last reading of each location and that the
+    trigger maintaining it is restored
+    """
+    path = str(tmp_path / "test_synthetic.db")
+    engine = generate_database(path, 1000, years=1,
+                               chunk_size=300)
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    count, first, last = conn.execute(
+        "SELECT COUNT(*), MIN(datetime), MAX(datetime) FROM localdata"
+    ).fetchone()
+    latest = conn.execute(
+        "SELECT location, datetime FROM latest_readings"
+    ).fetchall()
+    triggers = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    ).fetchall()
+    conn.close()
+    assert count == 1000
+    assert first.startswith("2019-01-01") and last == str(END) + ".000000"
+    assert len(latest) == 4 and max(latest)[1] <= last
+    assert triggers == [("localdata_latest_reading",)]
+
+
+def test_fake_drivers():
+    """
+    Check that the logger sets up and polls sensors through the fake
+    drivers, and that uninstalling them restores sys.modules
+    """
+    from pi_logger import local_loggers  # pylint: disable=C0415
+    previous = fake_drivers.install()
+    try:
+        chip = local_loggers.set_up_mcp_convertor()
+        reading = local_loggers.poll_mcp3008(chip, 3, END)
+        bme = local_loggers.set_up_bme680_sensors()
+        assert 15 <= local_loggers.poll_bme680(bme, 0, END)["temp"] <= 25
+    finally:
+        fake_drivers.uninstall(previous)
+    assert 20000 <= reading["mcdvalue"] <= 40000
+    assert all(sys.modules.get(name) is module
+               for name, module in previous.items())
+
+
+def test_find_regressions():
+    """
+    Check that only results worse than their baselines by more than the
+    tolerance are reported, in the right direction for each metric
+    """
+    baselines = dict(poll_cycle_ms=1.0, insert_rows_per_s=1000.0,
+                     get_recent_ms=10.0)
+    results = dict(poll_cycle_ms=2.5, insert_rows_per_s=600.0,
+                   get_recent_ms=1.0)
+    regressions = find_regressions(results, baselines, tolerance=2.0)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("poll_cycle_ms")
+    results["insert_rows_per_s"] = 400.0
+    assert len(find_regressions(results, baselines, tolerance=2.0)) == 2
+
+
+def test_percentile():
+    """
+    Check the nearest rank percentiles used by the load test
+    """
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+
+
+def test_load_test():
+    """
+    Check that the load test starts a server on a small synthetic database
+    and reports successful requests
+    """
+    results = run_against_synthetic(1000, clients=2, duration=1, dev=True)
+    assert results["requests"] > 0 and results["errors"] == 0
+    assert results["p50_ms"] <= results["p99_ms"] <= results["max_ms"]
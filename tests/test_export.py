@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.export` module.
+Skipped if the optional pyarrow dependency is not installed
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+
+from pi_logger.local_db import set_up_database, ReadingWriter
+from pi_logger.export import export_parquet, read_high_water_mark
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+START = datetime(2020, 1, 1, 23, 0)
+
+
+@pytest.fixture(name="engine")
+def fixture_engine(tmp_path_factory):
+    """
+    Set up a test database in a temporary directory
+    """
+    path = tmp_path_factory.mktemp("db")
+    engine = create_engine(f'sqlite:///{path / "test_export.db"}')
+    set_up_database(str(path), engine)
+    yield engine
+    engine.dispose()
+
+
+def add_readings(engine, n_readings, start):
+    """
+    Write n_readings one-minute readings from start to the test database
+    """
+    with ReadingWriter(engine, max_rows=1000) as writer:
+        for minute in range(n_readings):
+            writer.add(dict(datetime=start + timedelta(minutes=minute),
+                            location="attic", sensortype="dht22",
+                            piname="testy", piid="7357",
+                            temp=float(minute), humidity=50.0))
+
+
+def test_incremental_export(tmp_path, engine):
+    """
+    Check that rows are exported to date partitions and that a second run
+    only exports rows added since the first
+    """
+    add_readings(engine, 120, START)
+    assert export_parquet(str(tmp_path), engine=engine, chunk_size=50) == 120
+    assert read_high_water_mark(str(tmp_path)) == 120
+    assert sorted(os.listdir(tmp_path / "piname=testy")) == [
+        "date=2020-01-01", "date=2020-01-02"
+    ]
+
+    assert export_parquet(str(tmp_path), engine=engine) == 0
+    add_readings(engine, 10, START + timedelta(hours=2))
+    assert export_parquet(str(tmp_path), engine=engine) == 10
+
+    table = pq.read_table(str(tmp_path)).to_pandas()
+    assert len(table) == 130
+    assert table["id"].is_unique
+    assert table["temp"].sum() == sum(range(120)) + sum(range(10))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.import_existing` module.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from pi_logger.local_db import create_db_engine, get_last_readings
+from pi_logger.import_existing import load_existing_data_to_db
+
+LEGACY_CSV = """Datetime,Name,Pi,Temp,RelHum
+01/01/2020 12:00:00,livingroom,catflap,20.5,40.0
+01/01/2020 12:00:00,piano,catflap,19.0,
+01/01/2020 12:05:00,livingroom,catflap,21.0,41.0
+01/01/2020 12:05:00,piano,catflap,19.5,45.0
+01/01/2020 12:10:00,livingroom,catflap,21.5,42.0
+"""
+
+
+def test_import_is_chunked_and_idempotent(tmp_path):
+    """
+    Check that a legacy csv is imported in chunks and that importing it a
+    second time adds nothing
+    """
+    csv_path = tmp_path / "log_catflap.csv"
+    csv_path.write_text(LEGACY_CSV)
+    db_path = str(tmp_path / "locallogs.db")
+
+    stats = load_existing_data_to_db(str(csv_path), db_path, chunk_size=2)
+    assert (stats["read"], stats["inserted"], stats["skipped"]) == (5, 5, 0)
+    stats = load_existing_data_to_db(str(csv_path), db_path, chunk_size=2)
+    assert (stats["read"], stats["inserted"], stats["skipped"]) == (5, 0, 5)
+
+    engine = create_db_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        assert conn.execute(
+            text("SELECT COUNT(*) FROM localdata")
+        ).scalar() == 5
+    latest = {r["location"]: r for r in get_last_readings(engine=engine)}
+    assert latest["livingroom"]["datetime"] == datetime(2020, 1, 1, 12, 10)
+    assert latest["piano"]["humidity"] == 45.0
+    engine.dispose()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Tests that importing the pi_logger package and its API server is fast and
+has no side effects, and that the logger does not load pandas
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+from benchmarks.bench_import_time import import_times
+
+# generous, so that the test only fails if heavy imports creep back in
+MAX_IMPORT_SECONDS = float(os.getenv("MAX_IMPORT_SECONDS", default="2.0"))
+HEAVY_MODULES = ["pandas", "Adafruit_DHT", "bme680", "board", "busio",
+                 "adafruit_mcp3xxx"]
+
+
+def run_python(code, **env):
+    """
+    Run code in a fresh interpreter with extra environment variables and
+    return its standard output
+    """
+    return subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, check=True,
+        universal_newlines=True, env=dict(os.environ, **env),
+    ).stdout
+
+
+def test_api_server_imports_lazily():
+    """
+    Check that the API server imports neither pandas nor the sensor
+    drivers, and imports within MAX_IMPORT_SECONDS
+    """
+    loaded = json.loads(run_python(
+        "import sys, json, pi_logger.api_server; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES} "
+        "if m in sys.modules]))"
+    ))
+    assert loaded == []
+    times = import_times("pi_logger.api_server")
+    assert times["pi_logger.api_server"] < MAX_IMPORT_SECONDS
+
+
+def test_import_has_no_side_effects(tmp_path):
+    """
+    Check that importing the package neither creates LOG_PATH nor adds
+    logging handlers
+    """
+    log_path = tmp_path / "logs"
+    handlers = run_python(
+        "import logging, pi_logger.local_loggers; "
+        "print(len(logging.getLogger(f'pi_logger_{pi_logger.PINAME}')"
+        ".handlers))",
+        LOG_PATH=str(log_path),
+    )
+    assert handlers.strip() == "0"
+    assert not log_path.exists()
+
+
+def test_logger_runs_without_pandas():
+    """
+    Check that reading the config and scheduling the sensors does not
+    import pandas into the logger process
+    """
+    loaded = run_python(
+        "import sys, pi_logger.local_loggers as ll; "
+        "plan = ll.read_config('catflap', '', 'logger_config.csv'); "
+        "ll.make_schedules(plan._asdict(), 60); "
+        "print('pandas' in sys.modules)"
+    )
+    assert loaded.strip() == "False"
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.live` module and the /live API resource.
+"""
+
+import json
+from datetime import datetime
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+
+from sqlalchemy import create_engine
+
+from pi_logger import live, api_server
+from pi_logger.local_db import (set_up_database, save_readings_to_db,
+                                get_data_version)
+from pi_logger.live import Broadcaster, Subscription
+from pi_logger.api_server import app, LiveReadings
+
+
+def save_reading(engine, location, sensortype="dht22"):
+    """
+    Save a reading for location to the test database
+    """
+    save_readings_to_db(dict(datetime=datetime.utcnow(), location=location,
+                             sensortype=sensortype, piname="testy",
+                             piid="7357", temp=20.0, humidity=50.0), engine)
+
+
+@pytest.fixture(name="engine", scope="module")
+def fixture_engine(tmp_path_factory):
+    """
+    Create the test database, in a temporary directory, with one reading
+    in it
+    """
+    path = tmp_path_factory.mktemp("db")
+    engine = create_engine(f'sqlite:///{path / "test_live.db"}')
+    set_up_database(str(path), engine)
+    save_reading(engine, "attic")
+    yield engine
+    engine.dispose()
+
+
+def test_subscription_drops_oldest():
+    """
+    Check that a full subscription drops its oldest readings and counts
+    them, and that filters are applied
+    """
+    subscription = Subscription(locations=["attic"], max_queue=2)
+    for number in range(3):
+        subscription.put(dict(id=number))
+    assert subscription.dropped == 1
+    assert subscription.get(0) == dict(id=1)
+    assert subscription.get(0) == dict(id=2)
+    assert subscription.get(timeout=0.01) is None
+    assert subscription.matches(dict(location="attic", sensortype="dht22"))
+    assert not subscription.matches(dict(location="cellar",
+                                         sensortype="dht22"))
+
+
+def test_broadcaster_thread(engine):
+    """
+    Check that the watcher thread passes new readings to the matching
+    subscribers and stops once they have all unsubscribed
+    """
+    broadcaster = Broadcaster(engine, interval=0.05)
+    attic = broadcaster.subscribe(locations=["attic"])
+    cellar = broadcaster.subscribe(locations=["cellar"])
+    save_reading(engine, "cellar")
+    assert cellar.get(timeout=5)["location"] == "cellar"
+    assert attic.get(timeout=0.2) is None
+    thread = broadcaster.thread
+    broadcaster.unsubscribe(attic)
+    broadcaster.unsubscribe(cellar)
+    thread.join(timeout=5)
+    assert not thread.is_alive() and broadcaster.thread is None
+
+
+def test_broadcaster_fans_out(monkeypatch, engine):
+    """
+    Check that a single query passes a new reading to every subscriber,
+    however many there are
+    """
+    queries = []
+
+    def counting_get_readings_after_id(*args, **kwargs):
+        queries.append(args)
+        return get_readings_after_id(*args, **kwargs)
+
+    get_readings_after_id = live.get_readings_after_id
+    monkeypatch.setattr(live, "get_readings_after_id",
+                        counting_get_readings_after_id)
+    # the watcher thread sleeps throughout, leaving the checks to the test
+    broadcaster = Broadcaster(engine, interval=60)
+    subscriptions = [broadcaster.subscribe() for _ in range(200)]
+    save_reading(engine, "attic")
+    assert broadcaster.check() == 1
+    assert len(queries) == 1
+    assert all(subscription.get(timeout=0)["location"] == "attic"
+               for subscription in subscriptions)
+    for subscription in subscriptions:
+        broadcaster.unsubscribe(subscription)
+
+
+def test_live_route(engine):
+    """
+    Check that /live sends readings missed since Last-Event-ID, then new
+    readings matching its filters as Server-Sent Events, and unsubscribes
+    when the response is closed
+    """
+    broadcaster = Broadcaster(engine, interval=60)
+    last_id = get_data_version(engine=engine)[1]
+    save_reading(engine, "attic")
+    headers = {"Last-Event-ID": str(last_id)}
+    with app.test_request_context('/live?location=attic,loft',
+                                  headers=headers):
+        response = LiveReadings().get(broadcaster=broadcaster)
+    assert response.mimetype == "text/event-stream"
+    events = iter(response.response)
+    assert next(events).startswith("retry:")
+    backlog = next(events)
+    assert backlog.startswith(f"id: {last_id + 1}\nevent: reading\ndata: {{")
+    save_reading(engine, "cellar")
+    save_reading(engine, "loft")
+    broadcaster.check()
+    lines = next(events).splitlines()
+    assert lines[1] == "event: reading"
+    assert json.loads(lines[2][len("data: "):])["location"] == "loft"
+    response.close()
+    assert not broadcaster.subscriptions
+
+
+def test_live_route_backlog_limit(monkeypatch, engine):
+    """
+    Check that a client that missed more than LIVE_MAX_QUEUE matching
+    readings is sent that many, then a "dropped" event with the number of
+    the rest
+    """
+    monkeypatch.setattr(api_server, "LIVE_MAX_QUEUE", 2)
+    broadcaster = Broadcaster(engine, interval=60)
+    last_id = get_data_version(engine=engine)[1]
+    for location in ["attic", "cellar", "attic", "attic", "cellar", "attic"]:
+        save_reading(engine, location)
+    headers = {"Last-Event-ID": str(last_id)}
+    with app.test_request_context('/live?location=attic', headers=headers):
+        response = LiveReadings().get(broadcaster=broadcaster)
+    events = iter(response.response)
+    assert next(events).startswith("retry:")
+    assert next(events).startswith(f"id: {last_id + 1}\n")
+    assert next(events).startswith(f"id: {last_id + 3}\n")
+    assert next(events) == 'event: dropped\ndata: {"count": 2}\n\n'
+    response.close()
+
+
+def test_live_route_connection_limit(monkeypatch, engine):
+    """
+    Check that /live refuses a stream once LIVE_MAX_CONNECTIONS are open,
+    and accepts one again when a stream is closed
+    """
+    monkeypatch.setattr(api_server, "LIVE_MAX_CONNECTIONS", 1)
+    broadcaster = Broadcaster(engine, interval=60)
+    with app.test_request_context('/live'):
+        response = LiveReadings().get(broadcaster=broadcaster)
+        with pytest.raises(ServiceUnavailable):
+            LiveReadings().get(broadcaster=broadcaster)
+        response.close()
+        LiveReadings().get(broadcaster=broadcaster).close()
+    assert not broadcaster.subscriptions
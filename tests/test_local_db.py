@@ -8,14 +8,21 @@ uninstallable on Travis CI
 
 # import pytest
 import os
+import threading
 from datetime import datetime
 
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 
 from pi_logger.local_db import (set_up_database, save_readings_to_db,
-                                get_last_reading, get_recent_readings)
+                                get_last_reading, get_recent_readings,
+                                ReadingWriter, migrate_database,
+                                get_schema_version, SCHEMA_VERSION,
+                                get_last_readings, iter_readings,
+                                create_db_engine, update_rollups,
+                                prune_old_readings, ROLLUP_TABLES,
+                                DeadbandFilter)
 
 BASE = declarative_base()
 TEST_DB_PATH = os.getcwd()
@@ -39,6 +46,7 @@ TEST_DATA = dict(
     gasvoc=-999.999,
     mcdvalue=-999.999,
     mcdvoltage=-999.999,
+    mcdstd=-999.999,
 )
 
 
@@ -69,3 +77,260 @@ def test_recent_readings():
     recent_readings['datetime'] = pd.to_datetime(recent_readings['datetime'],
                                                  format="%Y-%m-%d %H:%M:%S")
     assert TEST_DATA['datetime'] in recent_readings['datetime'].to_list()
+
+
+def test_reading_writer_batches():
+    """
+    Check that the ReadingWriter holds readings until a threshold is reached
+    and writes them all in one flush
+    """
+    writer = ReadingWriter(ENGINE, max_rows=3, max_age=3600)
+    readings = [dict(TEST_DATA, location=f"batch{i}") for i in range(3)]
+    writer.add(readings[0])
+    writer.add(None)
+    writer.add(readings[1])
+    assert len(writer) == 2
+    recent_readings = pd.DataFrame(
+        get_recent_readings(start_datetime_utc=TEST_TIME, engine=ENGINE)
+    )
+    assert "batch0" not in recent_readings['location'].to_list()
+    writer.add(readings[2])
+    assert len(writer) == 0
+    recent_readings = pd.DataFrame(
+        get_recent_readings(start_datetime_utc=TEST_TIME, engine=ENGINE)
+    )
+    assert {"batch0", "batch1", "batch2"} <= set(recent_readings['location'])
+
+
+def test_reading_writer_flushes_on_close():
+    """
+    Check that buffered readings are written when the writer is closed and
+    that the age threshold honours the lookahead
+    """
+    with ReadingWriter(ENGINE, max_rows=100, max_age=60) as writer:
+        writer.add(dict(TEST_DATA, location="closing"))
+        assert not writer.is_due()
+        assert writer.is_due(lookahead=60)
+    assert len(writer) == 0
+    recent_readings = pd.DataFrame(
+        get_recent_readings(start_datetime_utc=TEST_TIME, engine=ENGINE)
+    )
+    assert "closing" in recent_readings['location'].to_list()
+
+
+def test_migrate_legacy_db():
+    """
+    Check that a database created before the localdata indexes existed is
+    migrated to the current schema version and gains the indexes
+    """
+    legacy_filepath = os.path.join(TEST_DB_PATH, f"legacy_{TEST_DB_FILENAME}")
+    legacy_engine = create_engine(f'sqlite:///{legacy_filepath}')
+    with legacy_engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE localdata (id INTEGER PRIMARY KEY, "
+            "datetime DATETIME, location VARCHAR, sensortype VARCHAR, "
+            "piname VARCHAR, piid VARCHAR, temp FLOAT, humidity FLOAT, "
+            "pressure FLOAT, gasvoc FLOAT, mcdvalue INTEGER, "
+            "mcdvoltage FLOAT)"
+        ))
+        conn.execute(text(
+            "INSERT INTO localdata (datetime, location, temp) VALUES "
+            "('2020-01-01 12:00:00.000000', 'attic', 1.0), "
+            "('2020-01-01 12:05:00.000000', 'attic', 2.0), "
+            "('2020-01-01 12:01:00.000000', 'cellar', 3.0)"
+        ))
+    assert get_schema_version(legacy_engine) == 0
+    assert migrate_database(legacy_engine) == SCHEMA_VERSION
+    assert get_schema_version(legacy_engine) == SCHEMA_VERSION
+    # running again is a no-op
+    assert migrate_database(legacy_engine) == SCHEMA_VERSION
+    with legacy_engine.connect() as conn:
+        plan = conn.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM localdata "
+            "WHERE datetime > '2020-01-01' ORDER BY datetime"
+        )).fetchall()
+    assert "ix_localdata_datetime" in str(plan)
+    latest = get_last_readings(engine=legacy_engine)
+    assert [(r['location'], r['temp']) for r in latest] == [("attic", 2.0),
+                                                            ("cellar", 3.0)]
+    save_readings_to_db(dict(TEST_DATA, location="attic",
+                             datetime=datetime(2020, 1, 2)), legacy_engine)
+    assert get_last_reading(engine=legacy_engine)['mcdstd'] == -999.999
+    legacy_engine.dispose()
+    os.remove(legacy_filepath)
+
+
+def test_last_readings_per_location():
+    """
+    Check that the latest reading of each location is kept up to date and
+    not replaced by an older reading inserted later
+    """
+    newer = dict(TEST_DATA, location="latest_a", temp=2.0,
+                 datetime=datetime(2030, 1, 1, 12, 5))
+    older = dict(TEST_DATA, location="latest_a", temp=1.0,
+                 datetime=datetime(2030, 1, 1, 12, 0))
+    other = dict(TEST_DATA, location="latest_b", temp=3.0,
+                 datetime=datetime(2030, 1, 1, 12, 1))
+    with ReadingWriter(ENGINE) as writer:
+        writer.add(newer)
+        writer.add(other)
+    save_readings_to_db(older, ENGINE)
+    latest = {r['location']: r for r in get_last_readings(engine=ENGINE)}
+    assert latest["latest_a"] == newer
+    assert latest["latest_b"] == other
+    assert get_last_reading(engine=ENGINE) == newer
+
+
+def test_iter_readings_pages():
+    """
+    Check that paging through readings with a (datetime, id) cursor returns
+    every reading exactly once, including readings sharing a datetime
+    """
+    page_time = datetime(2040, 1, 1)
+    with ReadingWriter(ENGINE) as writer:
+        for i in range(5):
+            writer.add(dict(TEST_DATA, location=f"page{i}",
+                            datetime=page_time))
+    pages = []
+    start, after_id = datetime(2039, 12, 31), None
+    while True:
+        page = list(iter_readings(start, after_id=after_id, limit=2,
+                                  engine=ENGINE, chunk_size=1))
+        if not page:
+            break
+        pages.append([r['location'] for r in page])
+        start, after_id = page[-1]['datetime'], page[-1]['id']
+    assert pages == [["page0", "page1"], ["page2", "page3"], ["page4"]]
+
+
+def test_prune_keeps_rollups():
+    """
+    Check that old readings are only deleted once rolled up, and that their
+    summaries are kept
+    """
+    old_time = datetime(2000, 1, 1)
+    save_readings_to_db(dict(TEST_DATA, location="retained", temp=1.0,
+                             datetime=old_time), ENGINE)
+    update_rollups(ENGINE)
+    save_readings_to_db(dict(TEST_DATA, location="retained", temp=3.0,
+                             datetime=old_time), ENGINE)
+    now = datetime(2000, 1, 3)
+    assert prune_old_readings(1, keep_minute_days=1, engine=ENGINE,
+                              now=now) == 1
+    update_rollups(ENGINE)
+    assert prune_old_readings(1, keep_minute_days=1, engine=ENGINE,
+                              now=now) == 1
+    hour = ROLLUP_TABLES["rollup_hour"]
+    with ENGINE.connect() as conn:
+        raw = conn.execute(text(
+            "SELECT COUNT(*) FROM localdata WHERE location = 'retained'"
+        )).scalar()
+        rollup = conn.execute(hour.select()
+                              .where(hour.c.location == "retained")).first()
+        minutes = conn.execute(text(
+            "SELECT COUNT(*) FROM rollup_minute WHERE location = 'retained'"
+        )).scalar()
+    assert raw == 0
+    assert (rollup["n"], rollup["temp_min"], rollup["temp_max"],
+            rollup["temp_sum"], rollup["temp_last"]) == (2, 1.0, 3.0, 4.0,
+                                                         3.0)
+    assert minutes == 0
+
+
+def test_update_rollups_in_chunks(tmp_path):
+    """
+    Check that update_rollups stops after max_chunks chunks and that later
+    calls carry on from there
+    """
+    engine = create_engine(f'sqlite:///{tmp_path / "chunks.db"}')
+    set_up_database(str(tmp_path), engine)
+    for minute in range(5):
+        save_readings_to_db(dict(TEST_DATA, location="chunked",
+                                 datetime=datetime(2001, 1, 1, 0, minute)),
+                            engine)
+    assert update_rollups(engine, chunk_size=2, max_chunks=1) == 2
+    assert update_rollups(engine, chunk_size=2, max_chunks=1) == 2
+    assert update_rollups(engine, chunk_size=2) == 1
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            "SELECT n FROM rollup_hour WHERE location = 'chunked'"
+        )).scalar() == 5
+    engine.dispose()
+
+
+def test_deadband_filter():
+    """
+    Check that readings within the deadband of the last stored reading are
+    dropped, except for a heartbeat
+    """
+    start = datetime(2020, 6, 1)
+    temps = [20.0, 20.05, 20.12, 20.2, 20.3, 20.3, 20.3]
+    writer = []
+    with DeadbandFilter(ReadingWriter(ENGINE), heartbeat=600) as deadband:
+        deadband.writer.add = writer.append
+        for minute, temp in enumerate(temps):
+            deadband.add(dict(TEST_DATA, location="steady", temp=temp,
+                              datetime=start + pd.Timedelta(minutes=minute)))
+        deadband.add(dict(TEST_DATA, location="steady", temp=20.3,
+                          datetime=start + pd.Timedelta(minutes=14)))
+        deadband.add(dict(TEST_DATA, location="steady", temp=20.3,
+                          humidity=None,
+                          datetime=start + pd.Timedelta(minutes=15)))
+    assert [r['temp'] for r in writer] == [20.0, 20.12, 20.3, 20.3, 20.3]
+    assert writer[-1]['humidity'] is None
+    assert deadband.dropped == 4
+
+
+def test_concurrent_writers_and_readers(tmp_path):
+    """
+    Stress test: with the pi storage profile, two writers and four readers
+    using separate engines (as the logger and API processes do) should
+    never fail with "database is locked"
+    """
+    conn_string = f'sqlite:///{tmp_path / "stress.db"}'
+    set_up_database(str(tmp_path), create_db_engine(conn_string, "pi"))
+    errors = []
+    writing = threading.Event()
+    writing.set()
+
+    def write(name):
+        engine = create_db_engine(conn_string, "pi")
+        try:
+            for i in range(20):
+                with ReadingWriter(engine) as writer:
+                    for j in range(50):
+                        writer.add(dict(TEST_DATA, location=f"{name}_{j}",
+                                        temp=float(i)))
+        except Exception as err:  # pylint: disable=W0703
+            errors.append(err)
+        engine.dispose()
+
+    def read():
+        engine = create_db_engine(conn_string, "pi")
+        try:
+            while writing.is_set():
+                get_last_readings(engine=engine)
+                get_recent_readings(TEST_TIME, engine=engine)
+        except Exception as err:  # pylint: disable=W0703
+            errors.append(err)
+        engine.dispose()
+
+    writers = [threading.Thread(target=write, args=(f"w{i}",))
+               for i in range(2)]
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    writing.clear()
+    for thread in readers:
+        thread.join()
+
+    assert errors == []
+    engine = create_db_engine(conn_string, "pi")
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(
+            text("SELECT COUNT(*) FROM localdata")
+        ).scalar() == 2 * 20 * 50
+    engine.dispose()
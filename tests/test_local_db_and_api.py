@@ -8,16 +8,24 @@ on Travis CI
 
 # import pytest
 import os
-from datetime import datetime
+import gzip
+import json
+from datetime import datetime, timedelta
 
 import pytest
 import pandas as pd
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.exceptions import HTTPException
 
 from pi_logger.local_db import (set_up_database, save_readings_to_db,
-                                get_last_reading, get_recent_readings)
-from pi_logger.api_server import GetRecent, GetLast, check_api_result
+                                get_last_reading, get_recent_readings,
+                                update_rollups)
+from pi_logger import api_server
+from pi_logger.api_server import (app, GetRecent, GetLast, GetLatest,
+                                  StreamRecent, ReadingsAfter, GetAggregate,
+                                  ResponseCache, CachedBody, RESPONSE_CACHE,
+                                  check_api_result)
 
 BASE = declarative_base()
 TEST_DB_PATH = os.getcwd()
@@ -40,6 +48,7 @@ TEST_DATA = dict(
     gasvoc=-999.999,
     mcdvalue=-999.999,
     mcdvoltage=-999.999,
+    mcdstd=-999.999,
 )
 
 
@@ -97,3 +106,290 @@ def test_get_last():
     route = GetLast()
     route_result = route.get(engine=ENGINE)
     assert check_api_result(route_result)
+
+
+def test_get_latest():
+    """
+    Check get_latest returns a json with necessary fields
+    """
+    route = GetLatest()
+    route_result = route.get(engine=ENGINE)
+    assert check_api_result(route_result)
+
+
+def test_stream_recent():
+    """
+    Check stream_recent returns one json reading per line, up to the limit
+    """
+    save_readings_to_db(TEST_DATA, ENGINE)
+    save_readings_to_db(TEST_DATA, ENGINE)
+    with app.test_request_context('/stream_recent/1970-01-01?limit=2'):
+        response = StreamRecent().get("1970-01-01", engine=ENGINE)
+        lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 2
+    for line in lines:
+        assert check_api_result(line)
+        assert "id" in json.loads(line)
+
+
+def test_stream_recent_pages():
+    """
+    Check stream_recent accepts a start with a Z suffix and, given the
+    datetime and id of the last reading of a page, returns the next page
+    """
+    now = datetime.utcnow()
+    for _ in range(3):
+        save_readings_to_db(dict(TEST_DATA, datetime=now), ENGINE)
+    start = (now - timedelta(microseconds=1)).isoformat() + "Z"
+    url = f'/stream_recent/{start}?limit=2'
+    with app.test_request_context(url):
+        response = StreamRecent().get(start, engine=ENGINE)
+        first = [json.loads(line) for line
+                 in response.get_data(as_text=True).splitlines()]
+    assert len(first) == 2
+    last = first[-1]
+    url = f'/stream_recent/{last["datetime"]}?after_id={last["id"]}'
+    with app.test_request_context(url):
+        response = StreamRecent().get(last["datetime"], engine=ENGINE)
+        second = [json.loads(line) for line
+                  in response.get_data(as_text=True).splitlines()]
+    assert [r["id"] for r in second][:1] == [last["id"] + 1]
+    with app.test_request_context('/stream_recent/yesterday'):
+        with pytest.raises(HTTPException) as error:
+            StreamRecent().get("yesterday", engine=ENGINE)
+    assert error.value.code == 400
+
+
+def test_readings_after():
+    """
+    Check readings_after returns the readings after an id in id order,
+    including one written later with an older datetime
+    """
+    save_readings_to_db(TEST_DATA, ENGINE)
+    with app.test_request_context('/readings_after/0?limit=1'):
+        response = ReadingsAfter().get(0, engine=ENGINE)
+        first = json.loads(response.get_data(as_text=True))
+    save_readings_to_db(dict(TEST_DATA, datetime=datetime(2000, 1, 1)),
+                        ENGINE)
+    with app.test_request_context(f'/readings_after/{first["id"]}'):
+        response = ReadingsAfter().get(first["id"], engine=ENGINE)
+        lines = [json.loads(line) for line
+                 in response.get_data(as_text=True).splitlines()]
+    ids = [reading["id"] for reading in lines]
+    assert ids == sorted(ids) and ids[0] > first["id"]
+    assert lines[-1]["datetime"] == "2000-01-01T00:00:00"
+
+
+def test_get_aggregate():
+    """
+    Check get_aggregate returns a json with necessary fields
+    """
+    update_rollups(ENGINE)
+    with app.test_request_context('/get_aggregate/1970-01-01?bucket=1d'):
+        route_result = GetAggregate().get("1970-01-01", engine=ENGINE)
+    assert check_api_result(route_result)
+
+
+def test_get_recent_resolution():
+    """
+    Check get_recent returns means at a requested resolution
+    """
+    update_rollups(ENGINE)
+    with app.test_request_context('/get_recent/1970-01-01?resolution=1h'):
+        route_result = GetRecent().get("1970-01-01", engine=ENGINE)
+    assert check_api_result(route_result)
+    assert "n" in json.loads(route_result)
+
+
+def test_get_recent_fill():
+    """
+    Check get_recent returns a forward-filled series at a requested interval
+    """
+    now = datetime.utcnow()
+    save_readings_to_db(dict(TEST_DATA, location="filled",
+                             datetime=now - pd.Timedelta(minutes=10)), ENGINE)
+    url = '/get_recent/1970-01-01?fill=1min&max_gap=3600'
+    with app.test_request_context(url):
+        route_result = GetRecent().get(
+            (now - pd.Timedelta(minutes=20)).isoformat(), engine=ENGINE
+        )
+    assert check_api_result(route_result)
+    assert "reading_datetime" in json.loads(route_result)
+
+
+def test_get_recent_fill_limit():
+    """
+    Check that get_recent refuses a fill with too many times with 400
+    """
+    response = app.test_client().get('/get_recent/2019-01-01?fill=1s')
+    assert response.status_code == 400
+    assert "limit" in response.get_json()["message"]
+
+
+def test_metrics_route():
+    """
+    Check that /metrics reports the API server's metrics in the Prometheus
+    text format, without the logger's when it is not running
+    """
+    save_readings_to_db(TEST_DATA, ENGINE)
+    client = app.test_client()
+    client.get('/no_such_route')
+    response = client.get('/metrics')
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    assert "# TYPE pi_logger_db_write_seconds histogram" in text
+    worker = f'worker="{os.getpid()}"'
+    assert f'pi_logger_logger_up{{process="api",{worker}}} 0' in text
+    assert 'pi_logger_api_requests_total{endpoint="unknown",status="404",' \
+        f'process="api",{worker}}} 1' in text
+    written = [line for line in text.splitlines()
+               if line.startswith("pi_logger_rows_written_total")]
+    assert len(written) == 1 and float(written[0].split()[-1]) >= 1
+
+
+def test_conditional_get():
+    """
+    Check that get_last sends an ETag, answers a matching If-None-Match with
+    304 and sends a new ETag and reading once another reading is saved
+    """
+    RESPONSE_CACHE.clear()
+    with app.test_request_context('/get_last'):
+        response = GetLast().dispatch_request(engine=ENGINE)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200 and etag.startswith('W/"')
+    assert check_api_result(json.loads(response.get_data()))
+    headers = {"If-None-Match": etag}
+    with app.test_request_context('/get_last', headers=headers):
+        assert GetLast().dispatch_request(engine=ENGINE).status_code == 304
+    save_readings_to_db(dict(TEST_DATA, location="conditional",
+                             datetime=datetime.now()), ENGINE)
+    with app.test_request_context('/get_last', headers=headers):
+        response = GetLast().dispatch_request(engine=ENGINE)
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert "conditional" in json.loads(response.get_data())
+
+
+def test_conditional_get_backfill():
+    """
+    Check that Last-Modified changes when an older reading is backfilled,
+    so that If-Modified-Since is not answered with 304 afterwards
+    """
+    RESPONSE_CACHE.clear()
+    with app.test_request_context('/get_recent/1970-01-01'):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    # as if the version had been seen a while ago
+    RESPONSE_CACHE.seen_at -= timedelta(seconds=10)
+    with app.test_request_context('/get_recent/1970-01-01'):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    headers = {"If-Modified-Since": response.headers["Last-Modified"]}
+    with app.test_request_context('/get_recent/1970-01-01', headers=headers):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert response.status_code == 304
+    save_readings_to_db(dict(TEST_DATA, location="backfilled",
+                             datetime=datetime(2000, 1, 1)), ENGINE)
+    with app.test_request_context('/get_recent/1970-01-01', headers=headers):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert response.status_code == 200
+    assert "Last-Modified" not in response.headers
+    assert "backfilled" in response.get_data(as_text=True)
+
+
+def test_conditional_get_rollups():
+    """
+    Check that a response with a resolution, cached after readings are
+    written but before they are rolled up, is not served once the rollup
+    tables are brought up to date
+    """
+    RESPONSE_CACHE.clear()
+    location = f"rolled_up_{TEST_TIME:%Y%m%d%H%M%S%f}"
+    update_rollups(ENGINE)
+    save_readings_to_db(dict(TEST_DATA, location=location,
+                             datetime=datetime.utcnow()), ENGINE)
+    url = '/get_recent/1970-01-01?resolution=1d'
+    with app.test_request_context(url):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert location not in response.get_data(as_text=True)
+    update_rollups(ENGINE)
+    headers = {"If-None-Match": response.headers["ETag"]}
+    with app.test_request_context(url, headers=headers):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert response.status_code == 200
+    assert location in response.get_data(as_text=True)
+
+
+def test_conditional_get_gzip(monkeypatch):
+    """
+    Check that get_recent compresses bodies for clients accepting gzip and
+    serves repeated requests from the cache
+    """
+    RESPONSE_CACHE.clear()
+    monkeypatch.setattr(api_server, "GZIP_MIN_BYTES", 0)
+    url = '/get_recent/1970-01-01'
+    with app.test_request_context(url, headers={"Accept-Encoding": "gzip"}):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = gzip.decompress(response.get_data())
+    assert len(RESPONSE_CACHE.entries) == 1
+    with app.test_request_context(url):
+        response = GetRecent().dispatch_request("1970-01-01", engine=ENGINE)
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == body
+
+
+def test_response_cache():
+    """
+    Check that the response cache keeps within its bounds, least recently
+    used first out, and empties when the version changes
+    """
+    cache = ResponseCache(max_entries=3, max_bytes=100)
+    for key in "abc":
+        cache.put(key, 1, CachedBody(b"x" * 20, None, "application/json"))
+    cache.get("a", 1)
+    cache.put("d", 1, CachedBody(b"x" * 30, b"x" * 10, "application/json"))
+    assert list(cache.entries) == ["c", "a", "d"] and cache.size == 80
+    cache.put("e", 1, CachedBody(b"x" * 30, None, "application/json"))
+    assert list(cache.entries) == ["a", "d", "e"] and cache.size == 90
+    cache.put("f", 1, CachedBody(b"x" * 101, None, "application/json"))
+    assert cache.get("f", 1) is None and cache.get("e", 2) is None
+    cache.put("g", 2, CachedBody(b"x", None, "application/json"))
+    assert list(cache.entries) == ["g"] and cache.size == 1
+
+
+@pytest.mark.parametrize("error", [RuntimeError("sensor failure"),
+                                   TimeoutError("timed out"),
+                                   PermissionError("permission denied")])
+def test_poll_sensors_logger_error(monkeypatch, error):
+    """
+    Check that poll_sensors reports a running logger's failure to poll as
+    503, without setting up the sensors itself
+    """
+    def failing_request_poll():
+        raise error
+
+    def poll_sensors_directly(engine):
+        raise AssertionError("polled the sensors directly")
+
+    monkeypatch.setattr(api_server, "request_poll", failing_request_poll)
+    monkeypatch.setattr(api_server, "poll_sensors_directly",
+                        poll_sensors_directly)
+    response = app.test_client().get('/poll_sensors')
+    assert response.status_code == 503
+    assert str(error) in response.get_json()["message"]
+
+
+@pytest.mark.parametrize("url", ['/get_aggregate/{}?bucket=1h',
+                                 '/get_recent/{}?resolution=1h',
+                                 '/get_recent/{}?fill=5min'])
+def test_timezone_aware_start(url):
+    """
+    Check that routes taking a resolution or fill accept a UTC start with a
+    Z suffix
+    """
+    update_rollups(ENGINE)
+    start = (datetime.utcnow() - pd.Timedelta(hours=1)).isoformat() + "Z"
+    resource = GetAggregate if url.startswith('/get_aggregate') else GetRecent
+    with app.test_request_context(url.format(start)):
+        route_result = resource().get(start, engine=ENGINE)
+    assert check_api_result(route_result)
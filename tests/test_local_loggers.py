@@ -6,8 +6,41 @@ Separated from db tests because sensor dependencies are uninstallable
 on Travis CI"""
 
 # import pytest
-import pandas as pd
-from pi_logger.local_loggers import (getserial, read_config)
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.fake_drivers import (FakeBME680, FakeMCP3008,
+                                     make_mcp_modules)
+from pi_logger import local_loggers
+from pi_logger.local_loggers import (getserial, read_config, PollingEngine,
+                                     FixedRateScheduler, poll_mcp3008,
+                                     AdaptiveScheduler, DHTReader,
+                                     poll_dht22, SensorConfig, SensorPlan,
+                                     compile_sensor_plan)
+
+
+class ListWriter(list):
+    """
+    Stand-in for local_db.ReadingWriter that keeps readings in a list
+    """
+    def add(self, data):
+        """Store data if it is not None"""
+        if data is not None:
+            self.append(data)
+
+
+@pytest.fixture
+def fake_analog_in(monkeypatch):
+    """
+    Replace the adafruit_mcp3xxx modules that local_loggers imports on first
+    use with the stand-ins from benchmarks.fake_drivers
+    """
+    _, mcp3008, analog_in = make_mcp_modules(latency=0.0)
+    monkeypatch.setitem(sys.modules, "adafruit_mcp3xxx.analog_in", analog_in)
+    monkeypatch.setitem(sys.modules, "adafruit_mcp3xxx.mcp3008", mcp3008)
 
 
 def test_serial():
@@ -19,13 +52,281 @@ def test_serial():
 
 def test_read_config():
     """
-    Check that read_config returns dataframes for both sensor types
+    Check that read_config returns a plan of the pi's sensors of each type
     """
     piname = "catflap"
     config_path = ""
     config_file = "logger_config.csv"
-    sensor_dict = read_config(piname, config_path, config_file)
-    assert (
-        isinstance(sensor_dict["bme680"], pd.DataFrame)
-        and isinstance(sensor_dict["dht22"], pd.DataFrame)
+    plan = read_config(piname, config_path, config_file)
+    assert isinstance(plan, SensorPlan)
+    assert plan.bme680 == ()
+    assert plan.dht22 == (
+        SensorConfig("livingroom", "dht22", 4, 60.0, 900.0, 0.2),
+        SensorConfig("piano", "dht22", 24, 60.0, 900.0, 0.2),
+    )
+    assert [sensor.pin for sensor in plan.mcp3008] == [0, 1]
+
+
+def test_compile_sensor_plan():
+    """
+    Check that settings missing from the config are None and that other
+    pis' sensors and unknown sensor types are left out
+    """
+    rows = [
+        dict(location="bedroom", name="testy", type="bme680", pin="0",
+             min_interval="", max_interval="", threshold=""),
+        dict(location="hall", name="other", type="dht22", pin="4"),
+        dict(location="shed", name="testy", type="unknown", pin="1"),
+    ]
+    plan = compile_sensor_plan(rows, "testy")
+    assert plan == SensorPlan(
+        dht22=(), mcp3008=(),
+        bme680=(SensorConfig("bedroom", "bme680", 0, None, None, None),),
+    )
+
+
+def make_config(sensortype, locations, **settings):
+    """
+    Return a tuple of SensorConfig for the given locations, on pins
+    0, 1, 2... and with lists of values for the optional settings
+    """
+    return tuple(
+        SensorConfig(location, sensortype, pin,
+                     *(settings.get(name, [None] * len(locations))[pin]
+                       for name in ("min_interval", "max_interval",
+                                    "threshold")))
+        for pin, location in enumerate(locations)
     )
+
+
+def test_polling_engine_cycle_time():
+    """
+    Check that all readings from one polling cycle share the cycle timestamp
+    """
+    bme_config = make_config("bme680", ["bedroom", "kitchen"])
+    empty_config = ()
+    writer = ListWriter()
+    cycle_time = datetime(2020, 1, 1, 12, 0)
+    with PollingEngine(None, empty_config, FakeBME680(), bme_config,
+                       None, empty_config, pi_id="7357",
+                       pi_name="testy") as poller:
+        assert poller.poll(writer, cycle_time) == cycle_time
+        assert sorted(r['location'] for r in writer) == ["bedroom",
+                                                         "kitchen"]
+        assert all(r['datetime'] == cycle_time for r in writer)
+        writer.clear()
+        poller.poll(writer, cycle_time, locations=["kitchen"])
+    assert [r['location'] for r in writer] == ["kitchen"]
+
+
+class FakeClock():
+    """
+    Clock for the scheduler tests that only advances when told to
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the clock instead of sleeping"""
+        self.now += seconds
+
+
+def test_fixed_rate_scheduler_aligns_and_skips():
+    """
+    Check that cycles start on multiples of the period, that a slow cycle
+    causes the missed cycles to be skipped and that no drift accumulates
+    """
+    clock = FakeClock(1000.5)
+    durations = iter([1.0, 25.0, 2.0, 1.0])
+    cycle_times = []
+
+    def cycle(cycle_time):
+        cycle_times.append(cycle_time)
+        clock.sleep(next(durations))
+
+    scheduler = FixedRateScheduler(10, clock=clock, sleep=clock.sleep)
+    stats = scheduler.run(cycle, n_cycles=4).summary()
+    starts = [(t - datetime(1970, 1, 1)).total_seconds() for t in cycle_times]
+    assert starts == [1010, 1020, 1050, 1060]
+    assert stats['cycles'] == 4
+    assert stats['overruns'] == 1
+    assert stats['skipped'] == 2
+    assert stats['max_duration'] == 25.0
+
+
+def test_mcp3008_burst_sampling(fake_analog_in):
+    """
+    Check that a burst of MCP3008 samples is reduced to one reading per pin
+    with the median and spread, reusing one channel object per pin
+    """
+    # pylint: disable=W0613,W0621
+    chip = FakeMCP3008(pin_values={0: [1000, 1000, 60000, 1000, 1000],
+                                   1: [None] * 5,
+                                   2: [30000, 40000, 30000, 40000, None]})
+    config = make_config("mcp3008", ["probe_a", "unplugged", "probe_b"])
+    writer = ListWriter()
+    cycle_time = datetime(2020, 1, 1, 12, 0)
+    for _ in range(2):
+        local_loggers.poll_all_mcp3008(config, chip, "7357", "testy", writer,
+                                       cycle_time, n_samples=5)
+    assert chip.reads == 30
+    assert chip.channels_created == 3
+    assert [r['location'] for r in writer] == ["probe_a", "probe_b"] * 2
+    probe_a, probe_b = writer[:2]
+    assert probe_a['mcdvalue'] == 1000
+    assert probe_a['mcdvoltage'] == pytest.approx(1000 * 3.3 / 65535)
+    assert probe_a['mcdstd'] > 1
+    assert probe_b['mcdvalue'] == 35000
+    assert probe_b['mcdstd'] == pytest.approx(5000 * 3.3 / 65535)
+    assert all(r['datetime'] == cycle_time for r in writer)
+
+    mean = poll_mcp3008(chip, 0, cycle_time, n_samples=5, reduce="mean")
+    assert mean['mcdvalue'] == 12800
+    single = poll_mcp3008(chip, 0, cycle_time)
+    assert single['mcdvalue'] == 1000 and 'mcdstd' not in single
+    assert chip.channels_created == 3
+
+
+class FakePoller():
+    """
+    Stand-in for PollingEngine with MCP3008 sensors whose voltage is given
+    by a function of location and time
+    """
+    dht_sensor = bme_sensor = None
+    mcp_chip = object()
+
+    def __init__(self, mcp_config, voltage):
+        self.mcp_config = mcp_config
+        self.voltage = voltage
+        self.polls = {sensor.location: 0 for sensor in mcp_config}
+
+    def poll(self, writer, cycle_time, locations):
+        """Pretend to poll the sensors at locations"""
+        for location in locations:
+            self.polls[location] += 1
+            writer.add(dict(location=location, datetime=cycle_time,
+                            mcdvoltage=self.voltage(location, cycle_time)))
+
+
+def test_adaptive_scheduler():
+    """
+    Check that a sensor with fast-changing readings stays at its shortest
+    interval, a flat one backs off to its longest, and one without bounds
+    is polled at the default interval
+    """
+    config = make_config("mcp3008", ["fast", "flat", "fixed"],
+                         min_interval=[10, 10, None],
+                         max_interval=[60, 60, None],
+                         threshold=[0.05, 0.05, None])
+
+    def voltage(location, cycle_time):
+        return cycle_time.timestamp() / 10 if location == "fast" else 1.0
+
+    poller = FakePoller(config, voltage)
+    clock = FakeClock(0.0)
+    scheduler = AdaptiveScheduler(poller, 30, clock=clock)
+    writer = ListWriter()
+    while clock() < 600:
+        clock.sleep(scheduler.run_once(writer))
+    intervals = {s.location: s.interval for s in scheduler.schedules}
+    assert intervals == {"fast": 10, "flat": 60, "fixed": 30}
+    assert poller.polls["fast"] == 60
+    assert poller.polls["fixed"] == 20
+    assert poller.polls["flat"] < 15
+    assert len(writer) == sum(poller.polls.values())
+
+
+class FakeDHT22():
+    """
+    Stand-in for Adafruit_DHT.read returning scripted results for each pin,
+    where None stands for a failed read
+    """
+    def __init__(self, results):
+        self.results = {pin: list(values) for pin, values in results.items()}
+        self.reads = []
+
+    def __call__(self, sensor, pin):
+        self.reads.append(pin)
+        temperature = self.results[pin].pop(0) if self.results[pin] else None
+        if temperature is None:
+            return None, None
+        return 50.0, temperature
+
+
+def make_dht_reader(fake, clock, **kwargs):
+    """
+    Return a DHTReader using fake for reads and clock for time, recording
+    the sleeps in clock.sleeps
+    """
+    clock.sleeps = []
+
+    def sleep(seconds):
+        clock.sleeps.append(seconds)
+        clock.sleep(seconds)
+
+    return DHTReader(read=fake, clock=clock, sleep=sleep, **kwargs)
+
+
+def test_dht_reader_retries_with_backoff():
+    """
+    Check that failed DHT22 reads are retried with a growing delay, and
+    that retrying stops at the deadline
+    """
+    clock = FakeClock(0.0)
+    fake = FakeDHT22({4: [None, None, 21.5], 17: [None] * 10})
+    reader = make_dht_reader(fake, clock, retries=3, delay=2, backoff=1.5,
+                             deadline=6)
+    assert reader.read(22, 4) == (50.0, 21.5)
+    assert clock.sleeps == [2, 3.0]
+    clock.sleeps.clear()
+    start = clock()
+    assert reader.read(22, 17) == (None, None)
+    assert clock.sleeps == [2, 3.0] and clock() - start == 5.0
+    assert fake.reads == [4, 4, 4, 17, 17, 17]
+
+
+def test_dht_circuit_breaker():
+    """
+    Check that a persistently failing pin is skipped once its circuit
+    opens, retried after the reset timeout and reported by the reader
+    """
+    clock = FakeClock(0.0)
+    fake = FakeDHT22({4: [None, None, None, None, 20.0, 20.5],
+                      24: [19.0] * 10})
+    reader = make_dht_reader(fake, clock, retries=0, failure_threshold=2,
+                             reset_timeout=60)
+    for _ in range(3):
+        assert poll_dht22(22, 4, datetime(2020, 1, 1), reader) is None
+        assert poll_dht22(22, 24, datetime(2020, 1, 1), reader) is not None
+    assert fake.reads.count(4) == 2
+    assert reader.status() == {4: dict(state="open", failures=2),
+                               24: dict(state="closed", failures=0)}
+    clock.sleep(60)
+    assert reader.status()[4]["state"] == "half-open"
+    assert reader.read(22, 4) == (None, None)
+    assert reader.read(22, 4) == (None, None)
+    assert fake.reads.count(4) == 3
+    clock.sleep(60)
+    assert reader.read(22, 4) == (None, None)
+    clock.sleep(60)
+    assert reader.read(22, 4) == (50.0, 20.0)
+    assert reader.read(22, 4) == (50.0, 20.5)
+    assert reader.status()[4] == dict(state="closed", failures=0)
+
+
+def test_maintain_rollups_logs_database_errors(monkeypatch, caplog):
+    """
+    Check that a database error while updating the rollup tables is logged
+    rather than stopping the logger
+    """
+    def failing_apply_retention(*args):
+        raise OperationalError("SELECT ROW_NUMBER() OVER", {},
+                               Exception('near "(": syntax error'))
+
+    monkeypatch.setattr(local_loggers, "apply_retention",
+                        failing_apply_retention)
+    assert not local_loggers.maintain_rollups(keep_days=30)
+    assert "failed to update the rollup tables" in caplog.text
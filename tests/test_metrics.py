@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.metrics` module.
+"""
+
+import pytest
+
+from pi_logger.metrics import Registry, merge, render, timed
+
+
+def test_histogram_buckets():
+    """
+    Check that a histogram counts values cumulatively into its buckets and
+    keeps the sum and count for each set of labels
+    """
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test latency", ["task"],
+                                   buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(value, task="a")
+    with histogram.time(task="b"):
+        pass
+    samples = {(name, tuple(sorted(labels.items()))): value
+               for name, labels, value in histogram.samples()}
+    assert samples[("test_seconds_bucket", (("le", "0.1"), ("task", "a")))] \
+        == 2
+    assert samples[("test_seconds_bucket", (("le", "1.0"), ("task", "a")))] \
+        == 3
+    assert samples[("test_seconds_bucket", (("le", "+Inf"), ("task", "a")))] \
+        == 4
+    assert samples[("test_seconds_sum", (("task", "a"),))] == 5.65
+    assert samples[("test_seconds_count", (("task", "b"),))] == 1
+    with pytest.raises(ValueError):
+        histogram.observe(1.0, location="a")
+
+
+def test_timed_records_failures():
+    """
+    Check that timed observes calls that raise as well as those that return
+    """
+    registry = Registry()
+    histogram = registry.histogram("test_query_seconds", "Test", ["query"])
+
+    @timed(histogram, query="fails")
+    def fails():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        fails()
+    counts = [value for name, _, value in histogram.samples()
+              if name == "test_query_seconds_count"]
+    assert counts == [1]
+
+
+def test_render_merged_processes():
+    """
+    Check the text format of metrics merged from two processes, with
+    escaped labels and gauges read from functions
+    """
+    api, logger = Registry(), Registry()
+    api.counter("test_reads_total", "Reads", ["location"]).inc(
+        2, location='front "door"'
+    )
+    logger.counter("test_reads_total", "Reads", ["location"]).inc(
+        location="back"
+    )
+    size = logger.gauge("test_size_bytes", "Size\nin bytes")
+    size.set_function(lambda: 1024)
+    missing = logger.gauge("test_missing_bytes", "Missing")
+    missing.set_function(lambda: None)
+    text = render(merge(api.collect(process="api"),
+                        logger.collect(process="logger")))
+    assert text == "\n".join([
+        "# HELP test_reads_total Reads",
+        "# TYPE test_reads_total counter",
+        'test_reads_total{location="front \\"door\\"",process="api"} 2',
+        'test_reads_total{location="back",process="logger"} 1',
+        "# HELP test_size_bytes Size\\nin bytes",
+        "# TYPE test_size_bytes gauge",
+        'test_size_bytes{process="logger"} 1024',
+        "# HELP test_missing_bytes Missing",
+        "# TYPE test_missing_bytes gauge",
+    ]) + "\n"
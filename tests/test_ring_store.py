@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.ring_store` module.
+"""
+
+import os
+from operator import itemgetter
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+
+from pi_logger.local_db import (set_up_database, get_recent_readings,
+                                ReadingWriter, SQLiteBackend)
+from pi_logger.ring_store import (RingBuffer, RingBufferBackend,
+                                  RECORD_DTYPE, has_rings)
+
+START = datetime(2020, 1, 1)
+
+
+@pytest.fixture(name="engine")
+def fixture_engine(tmp_path):
+    """
+    Create the test database in a temporary directory
+    """
+    engine = create_engine(f'sqlite:///{tmp_path / "test_ring.db"}')
+    set_up_database(str(tmp_path), engine)
+    yield engine
+    engine.dispose()
+
+
+def make_records(first, n):
+    """
+    Return n records one second apart from START + first seconds, with temp
+    equal to the number of seconds
+    """
+    records = np.zeros(n, dtype=RECORD_DTYPE)
+    seconds = np.arange(first, first + n)
+    records["datetime"] = np.datetime64(START, "us") \
+        + seconds * np.timedelta64(1, "s")
+    records["temp"] = seconds
+    return records
+
+
+def test_ring_buffer_wraps_around(tmp_path):
+    """
+    Check that the oldest records are overwritten once the buffer is full,
+    that range reads are views of the file where possible, and that the
+    records persist when the file is reopened
+    """
+    path = str(tmp_path / "wrap.ring")
+    ring = RingBuffer(path, capacity=10)
+    ring.append(make_records(0, 6))
+    view = ring.read_range(START + timedelta(seconds=1),
+                           START + timedelta(seconds=4))
+    assert view["temp"].tolist() == [2.0, 3.0]
+    assert np.shares_memory(view, ring.records)
+
+    ring.append(make_records(6, 8))
+    assert len(ring) == 10 and ring.count == 14
+    assert ring.read_range()["temp"].tolist() == list(range(4, 14))
+    assert ring.read_range(START + timedelta(seconds=11))["temp"].tolist() \
+        == [12.0, 13.0]
+    ring.flush()
+
+    reopened = RingBuffer(path, readonly=True)
+    assert reopened.capacity == 10
+    assert reopened.read_range()["temp"].tolist() == list(range(4, 14))
+
+
+def test_backend_matches_sqlite(tmp_path, engine):
+    """
+    Check that readings written through a ReadingWriter to the ring buffer
+    backend read back the same as readings stored in SQLite
+    """
+    readings = [dict(datetime=START + timedelta(seconds=i),
+                     location=location, sensortype="mcp3008",
+                     piname="testy", piid="7357", mcdvalue=i,
+                     mcdvoltage=i / 10)
+                for i in range(20) for location in ("soil a", "soil/b")]
+    path = str(tmp_path / "rings")
+    backend = RingBufferBackend(path, capacity=100)
+    for store in (backend, SQLiteBackend(engine)):
+        with ReadingWriter(engine, backend=store) as writer:
+            for reading in readings:
+                writer.add(reading)
+    backend.close()
+
+    since = START + timedelta(seconds=9)
+    reader = RingBufferBackend(path, readonly=True)
+    from_ring = get_recent_readings(since, backend=reader)
+    from_sqlite = get_recent_readings(since, engine=engine,
+                                      backend=SQLiteBackend(engine))
+    for reading in from_sqlite:
+        del reading["id"]
+    key = itemgetter("datetime", "location")
+    assert sorted(from_ring, key=key) == sorted(from_sqlite, key=key)
+    assert len(from_ring) == 20
+    assert from_ring[0]["temp"] is None
+    records = reader.read_range("soil/b", since)
+    assert records["mcdvalue"].tolist() == list(range(10, 20))
+
+
+def test_ring_buffer_drops_stale_records(tmp_path):
+    """
+    Check that records no newer than the last stored record, as after the
+    clock is stepped back or when a batch is saved again, are dropped rather
+    than stopping later records from being stored
+    """
+    ring = RingBuffer(str(tmp_path / "stale.ring"), capacity=10)
+    assert ring.append(make_records(0, 4)) == 4
+    assert ring.append(make_records(0, 4)) == 0
+    assert ring.append(make_records(2, 4)) == 2
+    assert ring.append(make_records(1, 1)) == 0
+    assert ring.append(make_records(6, 2)[::-1]) == 2
+    assert ring.count == 8
+    assert ring.read_range()["temp"].tolist() == list(range(8))
+
+
+def test_backend_filenames(tmp_path):
+    """
+    Check that locations which are the same once made safe for the
+    filesystem get their own files
+    """
+    path = str(tmp_path / "names")
+    backend = RingBufferBackend(path, capacity=10)
+    assert backend.filename("soil a") != backend.filename("soil_a")
+    assert not has_rings(path)
+
+    metadata = dict(location="soil_a", sensortype="mcp3008")
+    assert backend.save_records(metadata, make_records(5, 1)) == 1
+    assert backend.save_records(dict(metadata, location="soil a"),
+                                make_records(0, 4)) == 4
+    backend.close()
+    assert has_rings(path)
+    assert sorted(os.listdir(path)) == sorted(
+        os.path.basename(backend.filename(location)[:-len(".ring")]) + ext
+        for location in ("soil a", "soil_a") for ext in (".json", ".ring"))
+    reader = RingBufferBackend(path, readonly=True)
+    assert reader.read_range("soil a")["temp"].tolist() == [0, 1, 2, 3]
+    assert reader.read_range("soil_a")["temp"].tolist() == [5.0]
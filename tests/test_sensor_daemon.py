@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.sensor_daemon` module.
+Uses a fake polling engine in place of the sensors
+"""
+
+import os
+import threading
+import socketserver
+from datetime import datetime, timedelta
+
+import pytest
+
+from pi_logger.local_db import DeadbandFilter
+from pi_logger.sensor_daemon import (ControlServer, send_command,
+                                     request_poll)
+
+TEST_TIME = datetime(2020, 1, 1, 12, 0)
+
+
+class FakePoller():
+    """
+    Stand-in for local_loggers.PollingEngine returning a fixed reading
+    """
+    def __init__(self):
+        self.polls = 0
+
+    def poll(self, writer, cycle_time=TEST_TIME):
+        """Pretend to poll the sensors"""
+        self.polls += 1
+        writer.add(dict(datetime=cycle_time, location="testsville",
+                        temp=-999.999))
+        writer.add(None)
+        return cycle_time
+
+    def status(self):
+        """Pretend to report the sensors' state"""
+        return dict(dht22={4: dict(state="open", failures=3)})
+
+
+class FakeWriter(list):
+    """
+    Stand-in for local_db.ReadingWriter recording readings and flushes
+    """
+    flushes = 0
+
+    def add(self, data):
+        """Store data if it is not None"""
+        if data is not None:
+            self.append(data)
+
+    def flush(self):
+        """Count flushes"""
+        self.flushes += 1
+
+
+@pytest.fixture(name="control_server")
+def fixture_control_server(tmp_path):
+    """
+    Run a control server on a temporary socket
+    """
+    socket_path = str(tmp_path / "test.sock")
+    server = ControlServer(FakePoller(), FakeWriter(), socket_path).start()
+    yield server
+    server.stop()
+    assert not os.path.exists(socket_path)
+
+
+def test_ping(control_server):
+    """
+    Check that the control server answers a ping
+    """
+    response = send_command("ping", control_server.socket_path)
+    assert response["status"] == "ok"
+
+
+def test_request_poll(control_server):
+    """
+    Check that a poll request polls the sensors, flushes the writer and
+    returns the readings
+    """
+    readings = request_poll(control_server.socket_path)
+    assert readings == [dict(datetime=TEST_TIME.isoformat(),
+                             location="testsville", temp=-999.999)]
+    assert control_server.poller.polls == 1
+    assert control_server.writer.flushes == 1
+    assert len(control_server.writer) == 1
+
+
+def test_request_poll_bypasses_deadband(tmp_path):
+    """
+    Check that an on-demand poll stores its readings even when they are
+    within the deadband of the last stored reading, so that they are the
+    latest readings the API returns
+    """
+    writer = DeadbandFilter(FakeWriter())
+    writer.add(dict(datetime=TEST_TIME - timedelta(minutes=1),
+                    location="testsville", temp=-999.999))
+    server = ControlServer(FakePoller(), writer,
+                           str(tmp_path / "test.sock")).start()
+    try:
+        request_poll(server.socket_path)
+    finally:
+        server.stop()
+    assert [data["datetime"] for data in writer.writer] \
+        == [TEST_TIME - timedelta(minutes=1), TEST_TIME]
+    assert writer.dropped == 0
+    assert writer.last_stored["testsville"]["datetime"] == TEST_TIME
+
+
+def test_unknown_command(control_server):
+    """
+    Check that an unknown command is reported as an error
+    """
+    with pytest.raises(RuntimeError):
+        send_command("explode", control_server.socket_path)
+
+
+def test_no_daemon(tmp_path):
+    """
+    Check that a missing logger is reported as a connection error
+    """
+    with pytest.raises(ConnectionError):
+        request_poll(str(tmp_path / "missing.sock"))
+
+
+@pytest.mark.parametrize("reply", [b"", b'{"status": "o', b"\xff\n",
+                                   b"[]\n"])
+def test_bad_reply(tmp_path, reply):
+    """
+    Check that a missing, truncated or malformed reply, as when the logger
+    exits while handling a command, is reported as a RuntimeError
+    """
+    class ReplyHandler(socketserver.StreamRequestHandler):
+        """Read the command and send reply"""
+        def handle(self):
+            self.rfile.readline()
+            self.wfile.write(reply)
+
+    socket_path = str(tmp_path / "bad.sock")
+    server = socketserver.UnixStreamServer(socket_path, ReplyHandler)
+    thread = threading.Thread(target=server.handle_request, daemon=True)
+    thread.start()
+    with pytest.raises(RuntimeError):
+        send_command("ping", socket_path, timeout=5)
+    thread.join()
+    server.server_close()
+
+
+def test_status(control_server):
+    """
+    Check that the control server reports the state of the sensors
+    """
+    response = send_command("status", control_server.socket_path)
+    assert response["sensors"] == {"dht22": {"4": dict(state="open",
+                                                       failures=3)}}
+
+
+def test_metrics(control_server):
+    """
+    Check that the control server returns the logger's metrics labelled
+    with the process
+    """
+    from pi_logger.metrics import REGISTRY  # pylint: disable=C0415
+    REGISTRY.counter("pi_logger_test_daemon_total", "A test counter").inc()
+    response = send_command("metrics", control_server.socket_path)
+    families = {family[0]: family for family in response["metrics"]}
+    assert families["pi_logger_test_daemon_total"][3] == [
+        ["pi_logger_test_daemon_total", {"process": "logger"}, 1]
+    ]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""
+Tests for `pi_logger.serve` module.
+"""
+
+from types import SimpleNamespace
+
+from pi_logger import serve, api_server
+
+
+def test_gunicorn_options():
+    """
+    Check that the API is served by threaded workers, forked after loading
+    the app
+    """
+    options = serve.gunicorn_options("127.0.0.1", 5099, workers=3, threads=8)
+    assert options["bind"] == "127.0.0.1:5099"
+    assert options["workers"] == 3 and options["threads"] == 8
+    assert options["worker_class"] == "gthread" and options["preload_app"]
+
+
+def test_post_fork_drops_connections(monkeypatch):
+    """
+    Check that a new worker does not reuse database connections opened
+    before forking
+    """
+    disposed = []
+    monkeypatch.setattr(serve, "ENGINE",
+                        SimpleNamespace(dispose=lambda: disposed.append(1)))
+    serve.post_fork(None, SimpleNamespace(pid=1234))
+    assert disposed == [1]
+
+
+def test_falls_back_to_dev_server(monkeypatch):
+    """
+    Check that without gunicorn the development server is run, with live
+    streams limited to half the threads
+    """
+    runs = []
+    monkeypatch.setattr(serve.importlib.util, "find_spec", lambda name: None)
+    monkeypatch.setattr(serve, "set_up_python_logging", lambda **kwargs: None)
+    monkeypatch.setattr(serve, "run_gunicorn", lambda *args: runs.append(
+        "gunicorn"))
+    monkeypatch.setattr(api_server.app, "run",
+                        lambda **kwargs: runs.append(kwargs["port"]))
+    monkeypatch.setattr("sys.argv", ["serve", "--port", "5099",
+                                     "--threads", "8"])
+    # unset, but restored afterwards, as main sets it
+    monkeypatch.setenv("LIVE_MAX_CONNECTIONS", "")
+    monkeypatch.delenv("LIVE_MAX_CONNECTIONS")
+    serve.main()
+    assert runs == [5099]
+    assert serve.os.environ["LIVE_MAX_CONNECTIONS"] == "4"